@@ -19,11 +19,81 @@ config = {
     # ssl_args for https serving the rpc
     # ssl_args = {"keyfile": None, "certfile": None}
 
-    # Cache engines are diskcache, redis, or memory if not specified
+    # Cache engines are diskcache, redis, or memory if not specified.
+    # The memory engine takes "max_bytes" for the total size of the cached
+    # values and "policy" for eviction, which is "lru" or "gdsf" to favour
+    # keeping small entries, e.g.,
+    #     "params": {"max_bytes": int(2*2**30), "policy": "lru"}
+    # Raw data files are then kept in "file_cachedir", limited to
+    # "file_max_bytes" if given.
+    # Workers computing a node hold a lease on it so that other workers
+    # wait for the result instead of computing it again.  Set "lease_time"
+    # to the number of seconds before an abandoned lease expires.
+    # Set "zero_copy" to True to have uncompressed arrays retrieved from
+    # the cache share memory with the cached entry.  These arrays are read
+    # only, so only use it if no reduction step modifies its inputs in place.
     "cache": {
         "engine": "diskcache", 
-        "params": {"size_limit": int(4*2**30)}
+        "params": {"size_limit": int(4*2**30)},
+        # Give each instrument its own cache quota in bytes, keyed by module
+        # id prefix, so that one busy instrument can't evict the results of
+        # the others.  Use "modules" to list the module id patterns for a
+        # partition explicitly, such as the CANDOR steps, which are part of
+        # the ncnr.refl instrument.  Results from other instruments share
+        # the rest of the cache.  For redis, set maxmemory above the total
+        # of the quotas.  Partitions are found from the module id at the
+        # start of each cache key, so results cached by versions from before
+        # the keys carried the module id are not found and are recomputed.
+        # Parsed data files are keyed by the parser, such as
+        # "sansred.steps._read_raw_sans", so list the instrument package
+        # to keep them in the partition too.
+        # "partitions": {
+        #     "ncnr.refl": {"max_bytes": int(1*2**30),
+        #                   "modules": ["ncnr.refl.*", "reflred.*"]},
+        #     "ncnr.sans": {"max_bytes": int(1*2**30),
+        #                   "modules": ["ncnr.sans.*", "sansred.*"]},
+        #     "ncnr.vsans": {"max_bytes": int(1*2**30),
+        #                    "modules": ["ncnr.vsans.*", "vsansred.*"]},
+        #     "candor": {"max_bytes": int(2*2**30),
+        #                "modules": ["ncnr.refl.candor*", "reflred.candor.*"]},
+        # },
+        # "lease_time": 600,
+        # "zero_copy": False,
+        # Keep recently used values in each server process, up to
+        # "l1_size" bytes, in front of the shared cache.
+        # "l1_size": int(256*2**20),
+        # Write results to the cache from a background thread, holding up
+        # to "write_behind" bytes of results waiting to be written.
+        # "write_behind": int(512*2**20),
+        # Set "compression" to "auto" to choose no compression, lz4 or zstd
+        # for each entry from its size and how well a sample compresses,
+        # or to "lz4" or "zstd" to always use that codec.  True is "auto".
+        # zstd needs the zstandard package (pip install reductus[zstd]);
+        # "auto" uses lz4 without it.
+        # Small metadata entries use the zstd dictionary in the file
+        # "zstd_dictionary" if given; see explore/cache_codecs.py to train
+        # one.  Dictionaries must be kept while entries using them remain.
+        # "compression": "auto",
+        # "zstd_dictionary": "/var/cache/reductus/metadata.zdict",
     },
+    # Allow clients to remove cached results with the cache_purge api.
+    # "cache_admin": False,
+    # Evaluate independent template nodes concurrently.  Executor engines
+    # are thread, process, or serial if not specified.
+    # "executor": {
+    #     "engine": "thread",
+    #     "params": {"max_workers": 4}
+    # },
+    # Apply element-wise steps to the datasets in a bundle concurrently.
+    # For the process engine, "chunksize" datasets are sent to each worker
+    # at a time.
+    # "dataset_executor": {
+    #     "engine": "process",
+    #     "params": {"max_workers": 4, "chunksize": 8}
+    # },
+    # Loaders fetch up to "fetch_workers" files from the data sources at
+    # once, keeping that many connections open to each server.
+    # "fetch_workers": 8,
     "data_sources": [
         {
             "name": "local",
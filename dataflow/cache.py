@@ -11,10 +11,19 @@ to retrieve the cache connection, allowing calculations to be memoized.
 """
 import warnings
 import sys
+import json
 import os
 import subprocess
 import time
 import tempfile
+import socket
+import uuid
+import threading
+import atexit
+import weakref
+import traceback
+from fnmatch import fnmatchcase
+from collections import OrderedDict, deque
 
 try:
     # CRUFT: use cPickle for python 2.7
@@ -22,15 +31,28 @@ try:
 except ImportError:
     import pickle
 
+from .codec import encode, decode, encode_bytes, decode_bytes, write_bytes
+from .fakeredis import map_file
+from .profile import add_stat, estimate_nbytes
+
 PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL # use the best
 
-def memory_cache():
+# Leases on keys being computed are stored under the key with this prefix.
+LEASE_PREFIX = "lease:"
+# Tags describing each cached value are stored under this prefix.
+META_PREFIX = "meta:"
+# Seconds before a lease expires, in case the worker holding it has died.
+LEASE_TIME = 600
+# Redis partition size trackers are stored under this prefix.
+PARTITION_PREFIX = "partition:"
+
+def memory_cache(**kwargs):
     from . import fakeredis
-    return fakeredis.MemoryCache()
+    return fakeredis.MemoryCache(**kwargs)
 
-def file_cache(cachedir="~/.reductus/cache"):
+def file_cache(cachedir="~/.reductus/cache", max_bytes=None):
     from . import fakeredis
-    return fakeredis.FileBasedCache(cachedir=cachedir)
+    return fakeredis.FileBasedCache(cachedir=cachedir, max_bytes=max_bytes)
 
 
 # port 6379 is the default port value for the python redis connection
@@ -74,22 +96,37 @@ class CacheManager(object):
     def __init__(self):
         self._cache = None
         self._file_cache = None
-        self._engine = None
+        self._cache_engine = None
         self._use_compression = False
         self._pickle_protocol = PICKLE_PROTOCOL
+        self._zero_copy = False
+        self._l1 = None
+        self._writer = None
+        self._partitions = {}
+        self._partition_patterns = []
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._lease_time = LEASE_TIME
 
     @property
     def engine(self):
-        return self._engine
+        return self._cache_engine
 
-    def use_memory(self):
+    def use_memory(self, **kwargs):
         """
         Set up cache for testing.
+
+        The arguments are passed to :class:`dataflow.fakeredis.MemoryCache`
+        to set the size limit and eviction policy, except for *file_cachedir*
+        and *file_max_bytes* which set the location and size limit of the
+        raw file cache.
         """
         if self._cache is None:
-            cachedir = os.path.join(tempfile.gettempdir(), "reductus_test")
-            self._cache = memory_cache()
-            self._file_cache = file_cache(cachedir=cachedir)
+            default_cachedir = os.path.join(tempfile.gettempdir(), "reductus_test")
+            cachedir = kwargs.pop("file_cachedir", default_cachedir)
+            max_bytes = kwargs.pop("file_max_bytes", None)
+            self._cache = memory_cache(**kwargs)
+            self._file_cache = file_cache(cachedir=cachedir, max_bytes=max_bytes)
             self._cache_engine = "memory"
 
     def use_diskcache(self, **kwargs):
@@ -157,42 +194,973 @@ class CacheManager(object):
             self.use_memory()
         return self._file_cache
 
-    def store_file(self, key, contents):
-        if self._use_compression:
-            import lz4.frame
-            contents = lz4.frame.compress(contents)
-        self._file_cache.set(key, contents)
+    def store_file(self, key, contents, validators=None):
+        """
+        Store the file *contents* under *key*.
+
+        With compression enabled, the codec is chosen as for :meth:`store`,
+        so contents which are already compressed are stored as is.
+
+        *validators* is a dictionary of HTTP headers, such as the ETag and
+        Last-Modified time, used to check whether the file has changed.
+        They are returned by :meth:`file_validators`.
+        """
+        self._file_cache.set(key, encode_bytes(
+            contents, compress=self._use_compression))
+        self._store_validators(key, validators)
+
+    def store_file_stream(self, key, chunks, validators=None):
+        """
+        Store the file contents from the iterable *chunks* under *key*,
+        returning the contents as with :meth:`retrieve_file`.
+
+        The chunks are written straight to the cache file, or to a spool
+        file for redis, so large files are never held in memory.  With
+        compression enabled, the codec is chosen from the first chunk.
+        """
+        compress = self._use_compression
+        if self._cache_engine == "memory":
+            self._file_cache.set(
+                key, lambda fid: write_bytes(fid, chunks, compress=compress))
+            contents = self._file_cache.get_buffer(key)
+        else:
+            with tempfile.TemporaryFile() as fid:
+                write_bytes(fid, chunks, compress=compress)
+                fid.seek(0)
+                if self._cache_engine == "diskcache":
+                    self._file_cache.set(key, fid, read=True)
+                else:
+                    _redis_set_file(self._file_cache, key, fid)
+                # Use the spooled copy rather than fetching it back.
+                contents = map_file(fid)
+        self._store_validators(key, validators)
+        return decode_bytes(contents, compress=compress)
+
+    def _store_validators(self, key, validators):
+        if validators:
+            self._file_cache.set(META_PREFIX+key,
+                                 json.dumps(validators).encode('utf-8'))
+
+    def file_validators(self, key):
+        """
+        Return the validators stored with the file *key*, or an empty
+        dictionary if there are none.
+        """
+        try:
+            data = self._file_cache.get(META_PREFIX+key)
+        except KeyError:
+            return {}
+        if data is None:
+            return {}
+        return json.loads(bytes(data).decode('utf-8'))
 
     def retrieve_file(self, key):
-        contents = self._file_cache.get(key)
-        if self._use_compression:
-            import lz4.frame
-            contents = lz4.frame.decompress(contents)
-        return contents
-
-    def store(self, key, value):
-        string = pickle.dumps(value, protocol=self._pickle_protocol)
-        if self._use_compression:
-            import lz4.frame
-            string = lz4.frame.compress(string)
-        self._cache.set(key, string)
+        """
+        Retrieve the file contents for *key*.
+
+        Uncompressed contents from the file based cache or from diskcache
+        are returned as a read only buffer mapped from the cache file rather
+        than copied.
+        """
+        if self._cache_engine == "memory":
+            contents = self._file_cache.get_buffer(key)
+        elif self._cache_engine == "diskcache":
+            contents = self._file_cache.get(key, read=True)
+            if hasattr(contents, "fileno"):
+                with contents:
+                    contents = map_file(contents)
+        else:
+            contents = self._file_cache.get(key)
+        return decode_bytes(contents, compress=self._use_compression)
+
+    def store(self, key, value, stats=None, tags=None, callback=None):
+        """
+        Store *value* in the cache under *key*.
+
+        The value is serialized with :func:`dataflow.codec.encode`, which
+        writes large arrays as separate buffers.
+
+        If *stats* is a dictionary, the time to pickle, compress and store
+        the value and the number of bytes stored are added to it.
+
+        *tags* is a dictionary describing the value, such as the module id,
+        module version and instrument which produced it.  The tags are
+        stored with the size and time of the entry so that the contents of
+        the cache can be summarized with :meth:`usage` and selectively
+        removed with :meth:`purge`.
+
+        The value is serialized before returning, so later changes to
+        *value* do not change the cached copy.  If write-behind is enabled
+        with :meth:`use_write_behind`, the serialized value is queued and
+        written by a background thread, so the store counters in *stats*
+        are filled in later by that thread.  Use *callback(stats)* to
+        collect them, which is called once the value has been written.
+        *stats* is then only complete when the callback is called.
+        """
+        self.store_many([(key, value)], stats, tags, callback)
+
+    def store_many(self, items, stats=None, tags=None, callback=None):
+        """
+        Store each *(key, value)* in *items*, as for :meth:`store`.
+
+        The values are written with a single request to each cache
+        connection.  *tags* apply to all of the values, the counters for
+        all of the values are added to *stats*, and *callback(stats)* is
+        called once all of them have been written.
+        """
+        if callback is not None and stats is None:
+            stats = {}
+        entries = []
+        for key, value in items:
+            entries.append((key, encode(
+                value, compress=self._use_compression,
+                protocol=self._pickle_protocol, stats=stats)))
+            if self._l1 is not None:
+                self._l1.put(key, value)
+        if self._writer is not None:
+            self._writer.put(entries, stats, tags, callback)
+        else:
+            self._write(entries, stats, tags)
+            if callback is not None:
+                callback(stats)
+
+    def _write(self, entries, stats=None, tags=None):
+        """
+        Write the encoded *(key, string)* pairs in *entries* to the cache.
+        """
+        t0 = time.time()
+        keys = [key for key, _ in entries]
+        for cache, partition, index in self._group(keys):
+            items = []
+            for j in index:
+                key, string = entries[j]
+                items.append((key, string))
+                if tags is not None:
+                    meta = dict(tags, bytes=len(string), time=time.time())
+                    items.append((META_PREFIX+key,
+                                  json.dumps(meta).encode('utf-8')))
+            _set_many(cache, self._cache_engine, items)
+            if partition is not None:
+                if self._cache_engine == "redis":
+                    for j in index:
+                        key, string = entries[j]
+                        _redis_track(cache, partition, key, len(string),
+                                     self._partitions[partition].max_bytes)
+                self._count(PARTITION_PREFIX+partition, "stores", len(index))
+        add_stat(stats, "store_time", time.time() - t0)
+        add_stat(stats, "stored_bytes",
+                 sum(len(string) for _, string in entries))
+        self._count("l2", "stores", len(entries))
 
     def retrieve(self, key):
-        string = self._cache.get(key)
-        if self._use_compression:
-            import lz4.frame
-            string = lz4.frame.decompress(string)
-        value = pickle.loads(string)
+        value = self._queued(key)
+        if value is not None:
+            return value
+        if self._l1 is not None:
+            value = self._l1.get(key)
+            if value is not None:
+                self._count("l1", "hits")
+                return value
+            self._count("l1", "misses")
+        string = self._connection(key).get(key)
+        return self._decode(key, string)
+
+    def retrieve_or_none(self, key):
+        """
+        Retrieve the value for *key*, or None if it is not in the cache.
+
+        This replaces the *exists* followed by *retrieve* pair of calls,
+        and so saves a round trip to the cache server.
+        """
+        return self.retrieve_many([key])[0]
+
+    def retrieve_many(self, keys, stats=None):
+        """
+        Retrieve the values for all *keys* in a single request to the cache.
+
+        Returns a list with the value for each key, or None if the key is
+        not in the cache.
+
+        If *stats* is a list, a dictionary with the time to fetch,
+        decompress and unpickle each value and the number of bytes
+        retrieved is appended to it for each key.  The time for the request
+        is shared evenly amongst the keys.  Keys found in the in-process
+        cache are recorded as *l1_hits*.
+
+        Keys found in the in-process cache or waiting in the write-behind
+        queue are not requested from the shared cache.
+        """
+        keys = list(keys)
+        values = [None]*len(keys)
+        entries = [{} for _ in keys]
+        if self._writer is not None:
+            values = [self._queued(key) for key in keys]
+        if self._l1 is not None:
+            for k, key in enumerate(keys):
+                if values[k] is not None:
+                    continue
+                values[k] = self._l1.get(key)
+                if values[k] is not None:
+                    entries[k]["l1_hits"] = 1
+                    self._count("l1", "hits")
+                else:
+                    self._count("l1", "misses")
+        missing = [k for k, v in enumerate(values) if v is None]
+        t0 = time.time()
+        strings = [None]*len(missing)
+        for cache, partition, index in self._group([keys[k] for k in missing]):
+            found = _get_many(cache, self._cache_engine,
+                              [keys[missing[j]] for j in index])
+            for j, string in zip(index, found):
+                strings[j] = string
+            if partition is not None:
+                hits = [keys[missing[j]] for j, string in zip(index, found)
+                        if string is not None]
+                if hits and self._cache_engine == "redis":
+                    _redis_touch(cache, partition, hits)
+                self._count(PARTITION_PREFIX+partition, "hits", len(hits))
+                self._count(PARTITION_PREFIX+partition, "misses",
+                            len(index) - len(hits))
+        fetch_time = (time.time() - t0)/len(missing) if missing else 0.
+        for k, string in zip(missing, strings):
+            entries[k]["fetch_time"] = fetch_time
+            if string is not None:
+                values[k] = self._decode(keys[k], string, entries[k])
+            else:
+                self._count("l2", "misses")
+        if stats is not None:
+            stats.extend(entries)
+        return values
+
+    def _queued(self, key):
+        """
+        Return the value for *key* from the write-behind queue, or None.
+        """
+        string = self._writer.get(key) if self._writer is not None else None
+        if string is None:
+            return None
+        return decode(string, compress=self._use_compression,
+                      copy=not self._zero_copy)
+
+    def _decode(self, key, string, stats=None):
+        add_stat(stats, "retrieved_bytes", len(string))
+        value = decode(string, compress=self._use_compression,
+                       copy=not self._zero_copy, stats=stats)
+        self._count("l2", "hits")
+        if self._l1 is not None:
+            self._l1.put(key, value)
         return value
 
     def delete(self, key):
-        self._cache.delete(key)
+        queued = self._writer is not None and self._writer.discard(key)
+        if self._l1 is not None:
+            self._l1.discard(key)
+        cache = self._connection(key)
+        if queued and not cache.exists(key):
+            return
+        cache.delete(key)
+        if cache.exists(META_PREFIX+key):
+            cache.delete(META_PREFIX+key)
+        partition = self._partition(key)
+        if partition is not None and self._cache_engine == "redis":
+            _redis_untrack(cache, partition, [key])
+
+    def usage(self, group_by=("instrument", "module")):
+        """
+        Summarize the tagged entries in the cache.
+
+        Returns a dictionary with the number of *entries*, total *bytes*,
+        and the *oldest* and *newest* entry times as unix timestamps, and a
+        *groups* dictionary with the same summary for each value of the
+        *group_by* tags, joined by spaces.  The hit and miss *counters* for
+        this process are included as well.
+
+        Tags for entries which have been evicted from the cache are removed.
+        """
+        def _summary():
+            return {'entries': 0, 'bytes': 0, 'oldest': None, 'newest': None}
+        def _add(summary, meta):
+            summary['entries'] += 1
+            summary['bytes'] += meta.get('bytes', 0)
+            stamp = meta.get('time', None)
+            if stamp is not None:
+                summary['oldest'] = min(stamp, summary['oldest'] or stamp)
+                summary['newest'] = max(stamp, summary['newest'] or stamp)
+
+        total = _summary()
+        groups = {}
+        for key, meta in self._tagged_entries():
+            _add(total, meta)
+            name = " ".join(str(meta.get(tag, None)) for tag in group_by)
+            _add(groups.setdefault(name, _summary()), meta)
+        total['groups'] = groups
+        total['counters'] = self.cache_stats()
+        return total
+
+    def purge(self, **tags):
+        """
+        Remove the entries whose tags match all the given values, such as
+        *purge(instrument="ncnr.refl")* or *purge(module=id, version="0.1")*.
+
+        Returns the number of entries removed.
+        """
+        if not tags:
+            raise TypeError("purge needs at least one tag to match")
+        removed, _ = self.collect(
+            lambda meta: not all(meta.get(tag, None) == value
+                                 for tag, value in tags.items()))
+        return removed
+
+    def collect(self, keep):
+        """
+        Remove the tagged entries for which *keep(tags)* is False.
+
+        Returns the number of entries and the number of bytes removed.
+        """
+        removed = nbytes = 0
+        for key, meta in self._tagged_entries():
+            if not keep(meta):
+                self.delete(key)
+                removed += 1
+                nbytes += meta.get('bytes', 0)
+        return removed, nbytes
+
+    def _tagged_entries(self):
+        """
+        Yield *(key, tags)* for the tagged entries in the cache, removing
+        the tags for entries which are no longer present.
+        """
+        for cache in self._connections():
+            meta_keys = list(_scan_keys(cache, self._cache_engine,
+                                        META_PREFIX))
+            keys = [meta_key[len(META_PREFIX):] for meta_key in meta_keys]
+            present = _exists_many(cache, self._cache_engine, keys)
+            metas = _get_many(cache, self._cache_engine, meta_keys)
+            for key, meta_key, found, meta in zip(keys, meta_keys, present,
+                                                  metas):
+                if meta is None:
+                    continue
+                if not found:
+                    cache.delete(meta_key)
+                    continue
+                yield key, json.loads(bytes(meta).decode('utf-8'))
 
     def file_exists(self, key):
         return self._file_cache.exists(key)
         
     def exists(self, key):
-        return self._cache.exists(key)
+        if self._writer is not None and key in self._writer:
+            return True
+        if self._l1 is not None and key in self._l1:
+            return True
+        return self._connection(key).exists(key)
+
+    def exists_many(self, keys):
+        """
+        Check whether each of *keys* is in the cache using a single request.
+
+        Returns a list of booleans, one for each key.
+        """
+        keys = list(keys)
+        found = [False]*len(keys)
+        if self._writer is not None:
+            found = [key in self._writer for key in keys]
+        if self._l1 is not None:
+            found = [v or key in self._l1 for v, key in zip(found, keys)]
+        missing = [k for k, v in enumerate(found) if not v]
+        for cache, _, index in self._group([keys[k] for k in missing]):
+            checked = _exists_many(cache, self._cache_engine,
+                                   [keys[missing[j]] for j in index])
+            for j, v in zip(index, checked):
+                found[missing[j]] = v
+        return found
+
+    def use_l1(self, max_bytes=int(256*2**20)):
+        """
+        Keep recently used values in process memory in front of the cache.
+
+        Values are held as objects, so hits don't need to be fetched or
+        unpickled.  The cache is bounded by *max_bytes*, measured by the
+        memory used by the values as estimated by
+        :func:`dataflow.profile.estimate_nbytes`, since the serialized size
+        of compressed values can be far smaller.  Stores are written
+        through to the shared cache.  Entries deleted by other processes are not removed
+        from this process, which is safe because values are keyed by
+        fingerprint and never change.
+
+        Values from the in-process cache are shared between evaluations,
+        so reduction steps must not modify their inputs in place.
+
+        Use *max_bytes=0* to turn off the in-process cache.
+        """
+        self._l1 = _ObjectCache(max_bytes) if max_bytes else None
+
+    def use_partitions(self, partitions):
+        """
+        Give the results for each instrument their own share of the cache.
+
+        *partitions* maps a partition name to the maximum number of bytes
+        for the results of the modules in that partition.  By default the
+        name is a module id prefix such as "ncnr.sans", holding the results
+        of all the modules starting with "ncnr.sans.".  Instead of a size,
+        give *{"max_bytes": size, "modules": [pattern, ...]}* to choose the
+        modules explicitly with shell-style patterns, such as
+        "ncnr.refl.candor*" for the CANDOR steps of the reflectometry
+        instrument.  Parsed data files are keyed by the parser, as in
+        "reflred.candor.load_entries", so include patterns such as
+        "reflred.candor.*" to keep them in the partition as well.  When a
+        module matches more than one partition the
+        longest matching pattern is used.  Results from other modules
+        share the rest of the cache.  The partition is found from the
+        module id at the start of the key, as in
+        :func:`dataflow.calc.fingerprint_node`.
+
+        The memory and diskcache engines keep each partition in a separate
+        store with its own size limit and eviction.  Redis keeps the keys
+        in one database, and tracks the size of each partition, removing
+        its least recently used entries when it goes over quota.  Set the
+        redis *maxmemory* above the total of the quotas so that redis does
+        not evict entries across partitions.
+
+        Memory cache partitions start empty.  Diskcache partitions are kept
+        in *partitions/<name>* in the cache directory, and are found again
+        when the same partitions are configured.
+        """
+        self.get_cache()
+        self._partitions = {}
+        patterns = []
+        for name, max_bytes in partitions.items():
+            if isinstance(max_bytes, dict):
+                modules = max_bytes.get("modules", [name, name+".*"])
+                max_bytes = max_bytes["max_bytes"]
+            else:
+                modules = [name, name+".*"]
+            patterns.extend((pattern, name) for pattern in modules)
+            if self._cache_engine == "memory":
+                cache = memory_cache(max_bytes=max_bytes,
+                                     policy=self._cache.policy)
+            elif self._cache_engine == "diskcache":
+                cachedir = os.path.join(self._cache.directory, "partitions",
+                                        name)
+                cache = type(self._cache)(cachedir, size_limit=max_bytes)
+            else:
+                cache = self._cache
+            self._partitions[name] = _Partition(name, max_bytes, cache)
+        self._partition_patterns = sorted(
+            patterns, key=lambda item: len(item[0]), reverse=True)
+
+    def _partition(self, key):
+        """
+        Return the name of the partition holding *key*, or None if it is
+        not in a partition.
+        """
+        if not self._partitions:
+            return None
+        for prefix in (META_PREFIX, LEASE_PREFIX):
+            if key.startswith(prefix):
+                key = key[len(prefix):]
+                break
+        scope = key.rpartition(":")[0]
+        for pattern, name in self._partition_patterns:
+            if fnmatchcase(scope, pattern):
+                return name
+        return None
+
+    def _connection(self, key):
+        """Return the cache connection holding *key*"""
+        partition = self._partition(key)
+        if partition is None:
+            return self._cache
+        return self._partitions[partition].cache
+
+    def _connections(self):
+        """Return the distinct cache connections for the partitions"""
+        connections = [self._cache]
+        for partition in self._partitions.values():
+            if partition.cache is not self._cache:
+                connections.append(partition.cache)
+        return connections
+
+    def _group(self, keys):
+        """
+        Yield *(connection, partition, index)* for each partition used by
+        *keys*, where *index* lists the positions of its keys.
+        """
+        groups = OrderedDict()
+        for k, key in enumerate(keys):
+            groups.setdefault(self._partition(key), []).append(k)
+        for partition, index in groups.items():
+            cache = (self._partitions[partition].cache
+                     if partition is not None else self._cache)
+            yield cache, partition, index
+
+    def use_write_behind(self, max_bytes=int(512*2**20)):
+        """
+        Write values from a background thread so that workers don't wait
+        for them to be written to the cache.
+
+        Values waiting to be written are returned by :meth:`retrieve` and
+        :meth:`exists` in this process, so a worker always sees the values
+        it has stored.  Leases released by this process are held until the
+        value has been written, so that other workers waiting on the lease
+        find the value in the cache.  Values are serialized by :meth:`store`
+        so that steps changing their inputs in place don't change what is
+        written.  :meth:`store` blocks while the serialized size of the
+        queued values exceeds *max_bytes*.
+
+        The queue is flushed when the program exits, or on demand with
+        :meth:`flush`.  Values still queued when the process is killed are
+        lost, and will be computed again when next needed.
+
+        Use *max_bytes=0* to store values synchronously.
+        """
+        self.flush()
+        if self._writer is not None:
+            self._writer.stop()
+        self._writer = _WriteBehind(self, max_bytes) if max_bytes else None
+
+    def flush(self):
+        """
+        Wait for values in the write-behind queue to be written.
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def cache_stats(self):
+        """
+        Return the hit, miss and store counts for each tier of the cache.
+
+        *l1* is the in-process cache and *l2* is the shared cache.  If the
+        cache is partitioned, *partitions* gives the counts for each
+        partition along with its size in *bytes*, number of *entries*, and
+        *max_bytes* quota.  The sizes are for the whole cache, but the counts
+        are for this process.
+        """
+        with self._stats_lock:
+            stats = dict((tier, dict(counts))
+                         for tier, counts in self._stats.items()
+                         if not tier.startswith(PARTITION_PREFIX))
+            counters = dict((tier[len(PARTITION_PREFIX):], dict(counts))
+                            for tier, counts in self._stats.items()
+                            if tier.startswith(PARTITION_PREFIX))
+        if self._partitions:
+            partitions = stats["partitions"] = {}
+            for name, partition in self._partitions.items():
+                entry = counters.get(name, {})
+                entry.update(_partition_size(
+                    partition.cache, self._cache_engine, name))
+                entry["max_bytes"] = partition.max_bytes
+                partitions[name] = entry
+        if self._l1 is not None:
+            l1 = stats.setdefault("l1", {})
+            l1["entries"] = len(self._l1)
+            l1["bytes"] = self._l1.nbytes
+            l1["max_bytes"] = self._l1.max_bytes
+        return stats
+
+    def _count(self, tier, name, n=1):
+        with self._stats_lock:
+            counts = self._stats.setdefault(tier, {})
+            counts[name] = counts.get(name, 0) + n
+
+    def acquire_lease(self, key):
+        """
+        Claim the right to compute the value for *key*.
+
+        Returns a token if the lease was acquired, or None if another worker
+        already holds the lease.  Pass the token to :meth:`release_lease`
+        once the value is stored.  Leases expire after *lease_time* seconds
+        in case the worker holding the lease dies without releasing it.
+
+        Redis leases are set with *SET NX* so they are shared by all
+        servers using the cache.  The diskcache and file cache leases are
+        shared by processes on the same machine, and memory cache leases
+        by threads within the process.
+        """
+        token = "%s:%d:%s"%(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        if _add(self._connection(key), self._cache_engine, LEASE_PREFIX+key,
+                token, self._lease_time):
+            return token
+        return None
+
+    def release_lease(self, key, token):
+        """
+        Release the lease on *key* if it is still held by *token*.
+
+        With write-behind, the lease is released after the queued value for
+        *key* has been written.
+        """
+        if self._writer is not None:
+            self._writer.call(self._release_lease, key, token)
+        else:
+            self._release_lease(key, token)
+
+    def _release_lease(self, key, token):
+        _discard(self._connection(key), self._cache_engine, LEASE_PREFIX+key,
+                 token)
+
+
+class _Partition(object):
+    """
+    Share of the cache for the results of the modules in partition *name*.
+    """
+    def __init__(self, name, max_bytes, cache):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.cache = cache
+
+
+class _ObjectCache(object):
+    """
+    Least recently used cache of values bounded by their size in bytes.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """Return the value for *key*, or None if it is not cached"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value):
+        nbytes = estimate_nbytes(value)
+        with self.lock:
+            self._remove(key)
+            if nbytes > self.max_bytes:
+                return
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def discard(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+
+# Live write-behind queues, flushed when the program exits.
+_WRITERS = weakref.WeakSet()
+
+@atexit.register
+def _stop_writers():
+    for writer in list(_WRITERS):
+        writer.stop()
+
+
+class _WriteBehind(object):
+    """
+    Queue of values to be written to the cache by a background thread.
+
+    Tasks are run in the order they are queued, so a call queued after a
+    store runs once the value has been written.
+    """
+    def __init__(self, manager, max_bytes):
+        self.manager = manager
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # key => (encoded value, nbytes) for values which have not been written
+        self.pending = {}
+        self.tasks = deque()
+        self.busy = False
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="cache-writer")
+        self.thread.daemon = True
+        self.thread.start()
+        _WRITERS.add(self)
+
+    def __contains__(self, key):
+        with self.cond:
+            return key in self.pending
+
+    def get(self, key):
+        """Return the queued encoded value for *key*, or None if not queued"""
+        with self.cond:
+            entry = self.pending.get(key, None)
+            return entry[0] if entry is not None else None
+
+    def put(self, entries, stats, tags, callback=None):
+        """
+        Queue the encoded *(key, string)* pairs in *entries* to be written
+        together.
+        """
+        nbytes = sum(len(string) for _, string in entries)
+        with self.cond:
+            # Always accept values when the queue is empty, so that values
+            # larger than the limit can still be stored.
+            while self.nbytes and self.nbytes + nbytes > self.max_bytes:
+                self.cond.wait()
+            queued = []
+            for key, string in entries:
+                entry = (string, len(string))
+                self.pending[key] = entry
+                queued.append((key, entry))
+            self.nbytes += nbytes
+            self.tasks.append(
+                (self._store, (queued, stats, tags, callback)))
+            self.cond.notify_all()
+
+    def call(self, fn, *args):
+        with self.cond:
+            self.tasks.append((fn, args))
+            self.cond.notify_all()
+
+    def discard(self, key):
+        """Drop the queued value for *key*, returning True if it was queued"""
+        with self.cond:
+            return self.pending.pop(key, None) is not None
+
+    def flush(self):
+        with self.cond:
+            while self.tasks or self.busy:
+                self.cond.wait()
+
+    def stop(self):
+        self.flush()
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.tasks:
+                    self.cond.wait()
+                if not self.tasks:
+                    return
+                fn, args = self.tasks.popleft()
+                self.busy = True
+            try:
+                fn(*args)
+            except Exception:
+                print("cache write failed")
+                traceback.print_exc()
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def _store(self, queued, stats, tags, callback):
+        try:
+            # Skip values deleted or replaced since they were queued.
+            with self.cond:
+                current = [(key, entry[0]) for key, entry in queued
+                           if self.pending.get(key, None) is entry]
+            if current:
+                self.manager._write(current, stats, tags)
+            if callback is not None:
+                callback(stats)
+        finally:
+            with self.cond:
+                for key, entry in queued:
+                    self.nbytes -= entry[1]
+                    if self.pending.get(key, None) is entry:
+                        del self.pending[key]
+
+
+def _get_many(cache, engine, keys):
+    """
+    Fetch the raw values for *keys* from the *cache* connection, returning
+    None for missing keys.
+
+    Redis and the fakeredis caches provide *mget*.  For diskcache, the
+    lookups are done within a single transaction.
+    """
+    if not keys:
+        return []
+    if engine == "diskcache":
+        with cache.transact():
+            return [cache.get(key, default=None) for key in keys]
+    return cache.mget(keys)
+
+def _set_many(cache, engine, items):
+    """
+    Set each *(key, value)* in *items*, using a single request for redis
+    and a single transaction for diskcache.
+    """
+    if engine == "redis":
+        pipe = cache.pipeline(transaction=False)
+        for key, value in items:
+            pipe.set(key, value)
+        pipe.execute()
+    elif engine == "diskcache":
+        with cache.transact():
+            for key, value in items:
+                cache.set(key, value)
+    else:
+        for key, value in items:
+            cache.set(key, value)
+
+def _scan_keys(cache, engine, prefix):
+    """
+    Yield the keys in the *cache* connection which start with *prefix*.
+    """
+    if engine == "redis":
+        for key in cache.scan_iter(match=prefix+"*", count=1000):
+            yield key.decode('utf-8') if isinstance(key, bytes) else key
+    else:
+        for key in list(cache if engine == "diskcache" else cache.keys()):
+            if isinstance(key, str) and key.startswith(prefix):
+                yield key
+
+def _exists_many(cache, engine, keys):
+    """
+    Check for *keys* in the *cache* connection, returning a list of bools.
+
+    Redis checks are sent as a single pipeline.  For diskcache, the checks
+    are done within a single transaction.  The fakeredis caches are in
+    process, so the keys are checked one at a time.
+    """
+    if not keys:
+        return []
+    if engine == "redis":
+        pipe = cache.pipeline(transaction=False)
+        for key in keys:
+            pipe.exists(key)
+        return [bool(v) for v in pipe.execute()]
+    if engine == "diskcache":
+        with cache.transact():
+            return [bool(cache.exists(key)) for key in keys]
+    return [bool(cache.exists(key)) for key in keys]
+
+
+# Compare and delete as a single redis operation
+_REDIS_DISCARD = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+def _add(cache, engine, key, value, expire):
+    """
+    Set *key* to *value* in the *cache* connection if it is not already set,
+    returning True if the key was set.  The key expires after *expire*
+    seconds.
+    """
+    if engine == "redis":
+        return bool(cache.set(key, value, nx=True, px=int(expire*1000)))
+    return bool(cache.add(key, value, expire=expire))
+
+def _discard(cache, engine, key, value):
+    """
+    Delete *key* from the *cache* connection if it is set to *value*.
+    """
+    if engine == "redis":
+        cache.eval(_REDIS_DISCARD, 1, key, value)
+    elif engine == "diskcache":
+        with cache.transact():
+            if cache.get(key, default=None) == value:
+                cache.delete(key)
+    else:
+        cache.discard(key, value)
+
+
+# Size of the pieces appended to a redis entry when storing a file.
+REDIS_CHUNK_SIZE = 8*2**20
+
+def _redis_set_file(cache, key, fid):
+    """
+    Set the redis *key* to the contents of the open file *fid*, sending it
+    a piece at a time under a temporary key which is then renamed.
+    """
+    tmp_key = key + ":tmp-" + uuid.uuid4().hex
+    try:
+        cache.set(tmp_key, b"")
+        while True:
+            chunk = fid.read(REDIS_CHUNK_SIZE)
+            if not chunk:
+                break
+            cache.append(tmp_key, chunk)
+        cache.rename(tmp_key, key)
+    except Exception:
+        cache.delete(tmp_key)
+        raise
+
+
+def _partition_size(cache, engine, name):
+    """
+    Return the number of *entries* and *bytes* in the partition *name*.
+    """
+    if engine == "redis":
+        prefix = PARTITION_PREFIX + name
+        pipe = cache.pipeline(transaction=False)
+        pipe.zcard(prefix+":lru")
+        pipe.get(prefix+":bytes")
+        entries, nbytes = pipe.execute()
+        return {'entries': entries, 'bytes': int(nbytes or 0)}
+    keys = cache if engine == "diskcache" else cache.keys()
+    entries = sum(1 for key in keys
+                  if not key.startswith((META_PREFIX, LEASE_PREFIX)))
+    nbytes = cache.volume() if engine == "diskcache" else cache.nbytes
+    return {'entries': entries, 'bytes': nbytes}
+
+def _redis_track(cache, name, key, nbytes, max_bytes):
+    """
+    Record *key* with size *nbytes* in the redis partition *name*, removing
+    the least recently used keys if the partition is over *max_bytes*.
+    """
+    prefix = PARTITION_PREFIX + name
+    pipe = cache.pipeline(transaction=False)
+    pipe.hget(prefix+":sizes", key)
+    pipe.hset(prefix+":sizes", key, nbytes)
+    pipe.zadd(prefix+":lru", {key: time.time()})
+    pipe.incrby(prefix+":bytes", nbytes)
+    previous, _, _, total = pipe.execute()
+    if previous is not None:
+        total = cache.decrby(prefix+":bytes", int(previous))
+    while total > max_bytes:
+        oldest = cache.zpopmin(prefix+":lru")
+        if not oldest:
+            break
+        evicted = oldest[0][0]
+        if isinstance(evicted, bytes):
+            evicted = evicted.decode('utf-8')
+        size = cache.hget(prefix+":sizes", evicted)
+        pipe = cache.pipeline(transaction=False)
+        pipe.delete(evicted, META_PREFIX+evicted)
+        pipe.hdel(prefix+":sizes", evicted)
+        pipe.decrby(prefix+":bytes", int(size or 0))
+        total = pipe.execute()[-1]
+
+def _redis_touch(cache, name, keys):
+    """
+    Mark *keys* in the redis partition *name* as recently used.
+    """
+    now = time.time()
+    cache.zadd(PARTITION_PREFIX+name+":lru", dict((key, now) for key in keys),
+               xx=True)
+
+def _redis_untrack(cache, name, keys):
+    """
+    Remove *keys* from the size tracker for the redis partition *name*.
+    """
+    prefix = PARTITION_PREFIX + name
+    sizes = cache.hmget(prefix+":sizes", keys)
+    pipe = cache.pipeline(transaction=False)
+    pipe.hdel(prefix+":sizes", *keys)
+    pipe.zrem(prefix+":lru", *keys)
+    pipe.decrby(prefix+":bytes", sum(int(size) for size in sizes if size))
+    pipe.execute()
 
 
 # Singleton cache manager if you only need one cache
@@ -204,3 +1172,137 @@ use_diskcache = CACHE_MANAGER.use_diskcache
 get_cache = CACHE_MANAGER.get_cache_manager
 get_file_cache = CACHE_MANAGER.get_file_cache
 set_test_cache = CACHE_MANAGER.use_memory
+
+
+def test_batched_lookups():
+    manager = CacheManager()
+    manager.use_memory()
+    manager.store("a", {"x": 1})
+    assert manager.exists_many(["a", "b"]) == [True, False]
+    assert manager.retrieve_many(["b", "a"]) == [None, {"x": 1}]
+    assert manager.retrieve_or_none("b") is None
+
+def test_l1_cache():
+    manager = CacheManager()
+    manager.use_memory()
+    manager.use_l1(max_bytes=2000)
+    value = {"x": "a"*700}
+    manager.store("a", value)
+    # Values from the in-process cache are the stored objects.
+    assert manager.retrieve_many(["a"])[0] is value
+    assert manager.cache_stats()["l1"]["hits"] == 1
+    # Values from the shared cache are kept in process for next time.
+    manager._l1.discard("a")
+    first = manager.retrieve("a")
+    assert first == value and first is not value
+    assert manager.retrieve("a") is first
+    # The oldest values are dropped when the size limit is reached.
+    manager.store("b", {"x": "b"*700})
+    manager.store("c", {"x": "c"*700})
+    assert "a" not in manager._l1 and manager.exists("a")
+    assert manager._l1.nbytes <= 2000
+    # Deleted values are removed from both tiers.
+    manager.delete("c")
+    assert manager.exists_many(["b", "c"]) == [True, False]
+    stats = manager.cache_stats()
+    assert stats["l2"]["hits"] == 1 and stats["l2"]["stores"] == 3
+    # Values are charged for their size in memory, not the stored size.
+    import numpy as np
+    manager._use_compression = True
+    manager.store("z", np.zeros(1000))
+    assert "z" not in manager._l1 and manager.exists("z")
+
+def test_write_behind():
+    manager = CacheManager()
+    manager.use_memory()
+    manager.use_write_behind(max_bytes=10000)
+    release = threading.Event()
+    # Hold the writer so that values stay in the queue.
+    manager._writer.call(release.wait)
+    value = {"x": "a"*600}
+    try:
+        manager.store("a", value, tags={"module": "m"})
+        manager.store("b", [1])
+        manager.delete("b")
+        token = manager.acquire_lease("a")
+        manager.release_lease("a", token)
+        # Values waiting to be written are visible to this process, as
+        # they were when stored.
+        value["x"] = "changed"
+        assert manager.retrieve("a") == {"x": "a"*600}
+        assert manager.exists_many(["a", "b"]) == [True, False]
+        assert not manager._cache.exists("a")
+        assert manager._cache.exists(LEASE_PREFIX+"a")
+    finally:
+        release.set()
+    manager.flush()
+    assert manager._cache.exists("a") and not manager._cache.exists("b")
+    manager._l1 = None
+    assert manager.retrieve("a") == {"x": "a"*600}
+    assert not manager._cache.exists(LEASE_PREFIX+"a")
+    assert manager.usage()["entries"] == 1
+    assert manager._writer.nbytes == 0 and not manager._writer.pending
+    manager.use_write_behind(0)
+    assert manager._writer is None
+
+def test_partitions():
+    manager = CacheManager()
+    manager.use_memory(max_bytes=100000)
+    manager.use_partitions({
+        "candor": {"max_bytes": 3000,
+                   "modules": ["ncnr.refl.candor*", "reflred.candor.*"]},
+        "ncnr.refl": 50000,
+        })
+    refl = ["ncnr.refl.join:%d"%k for k in range(3)]
+    for key in refl:
+        manager.store(key, "r"*500, tags={"instrument": "ncnr.refl"})
+    manager.store("other", [1])
+    # Filling the candor partition doesn't evict other modules of the
+    # same instrument.
+    candor = ["ncnr.refl.candor:%d"%k for k in range(5)]
+    candor += ["ncnr.refl.candor_rebin:%d"%k for k in range(5)]
+    for key in candor:
+        manager.store(key, "c"*900, tags={"instrument": "ncnr.refl"})
+    assert manager._partition("ncnr.refl.candor_rebin:0") == "candor"
+    assert manager._partition("reflred.candor.load_entries:0") == "candor"
+    assert manager._partition("ncnr.refl.candidate:0") == "ncnr.refl"
+    assert manager._partition("ncnr.reflx.join:0") is None
+    assert manager.exists_many(refl + ["other"]) == [True]*4
+    found = manager.exists_many(candor)
+    assert found[-1] and not found[0]
+    token = manager.acquire_lease(refl[0])
+    assert token is not None and manager.acquire_lease(refl[0]) is None
+    manager.release_lease(refl[0], token)
+    values = manager.retrieve_many([refl[0], "ncnr.refl.join:x"])
+    assert values == ["r"*500, None]
+    stats = manager.cache_stats()["partitions"]
+    assert stats["ncnr.refl"]["entries"] == 3
+    assert stats["ncnr.refl"]["hits"] == 1 and stats["ncnr.refl"]["misses"] == 1
+    assert stats["candor"]["bytes"] <= 3000
+    assert stats["candor"]["stores"] == 10
+    assert manager.usage()["groups"]["ncnr.refl None"]["entries"] == 3 + sum(found)
+    assert manager.purge(instrument="ncnr.refl") == 3 + sum(found)
+    assert not manager.exists(refl[1])
+
+def test_usage():
+    manager = CacheManager()
+    manager.use_memory()
+    tags = {"instrument": "ncnr.refl", "module": "ncnr.refl.load", "version": "1"}
+    manager.store("a", [1, 2], tags=tags)
+    manager.store("b", [3], tags=dict(tags, module="ncnr.refl.join"))
+    manager.store("c", [4], tags=dict(tags, instrument="ncnr.sans",
+                                      module="ncnr.sans.load"))
+    manager.store("untagged", [5])
+    usage = manager.usage()
+    assert usage["entries"] == 3
+    assert sorted(usage["groups"].keys()) == [
+        "ncnr.refl ncnr.refl.join", "ncnr.refl ncnr.refl.load",
+        "ncnr.sans ncnr.sans.load"]
+    assert usage["bytes"] == sum(g["bytes"] for g in usage["groups"].values())
+    assert manager.usage(group_by=["instrument"])["groups"]["ncnr.refl"]["entries"] == 2
+    # Tags of evicted entries are dropped.
+    manager._cache.delete("b")
+    assert manager.usage()["entries"] == 2
+    assert manager.purge(instrument="ncnr.sans") == 1
+    assert manager.exists_many(["a", "c", "untagged"]) == [True, False, True]
+    assert manager.purge(module="ncnr.refl.load", version="2") == 0
@@ -12,9 +12,13 @@ in the template given its input values.
 from __future__ import print_function
 
 import sys
+import time
 
 import hashlib
 import contextlib
+import pickle
+from concurrent.futures import wait, FIRST_COMPLETED
+from functools import lru_cache
 from inspect import getsource
 
 from .anno_exc import annotate_exception
@@ -22,9 +26,14 @@ from .cache import get_cache
 from .core import lookup_module, lookup_datatype
 from .core import Bundle
 from .automod import validate
+from .parallel import get_executor_manager, get_dataset_executor_manager
+from .profile import Profile, add_stat, estimate_nbytes, peak_rss, timed_call
 
 IS_PY3 = sys.version_info[0] >= 3
 
+# Seconds between checks for a node being computed by another worker.
+LEASE_POLL = 0.2
+
 def find_calculated(template, config):
     """
     Returns a boolean vector indicating whether or not each node in the
@@ -33,11 +42,39 @@ def find_calculated(template, config):
     cache = get_cache()
 
     fingerprints = fingerprint_template(template, config)
-    return [cache.exists(fingerprints[node])
-            for node, _ in enumerate(template.modules)]
+    return cache.exists_many(fingerprints[node]
+                             for node, _ in enumerate(template.modules))
+
+
+def collect_garbage():
+    """
+    Remove cached results made by module versions that no longer exist.
+
+    Changing the version of a module changes the fingerprints of all nodes
+    using it and of everything downstream, so results from the old version
+    can never be retrieved.  Removing them right after a new release leaves
+    the cache space for results that can be used, rather than waiting for
+    them to be evicted after newer entries.
+
+    Only entries for instruments loaded in this process are checked.
+    Entries from other modules of a loaded instrument are kept unless their
+    module is gone or its version has changed.  Results from an unchanged
+    module whose upstream nodes changed version are not found, since their
+    tags do not record their inputs.
+
+    Returns the number of entries and the number of bytes removed.
+    """
+    from .core import _instrument_registry, _module_registry
+    def _current(tags):
+        if tags.get('instrument', None) not in _instrument_registry:
+            return True
+        module = _module_registry.get(tags.get('module', None), None)
+        return module is not None and module.version == tags.get('version', None)
+    return get_cache().collect(_current)
 
 
-def process_template(template, config, target=(None, None)):
+def process_template(template, config, target=(None, None), keep=(),
+                     profile=None):
     """
     Evaluate the template.
 
@@ -48,84 +85,462 @@ def process_template(template, config, target=(None, None)):
     the cached value and use it for subsequent nodes.  If not, then run
     the node action and place the results in the cache.
 
+    Nodes are evaluated as soon as all of their inputs are available.  If
+    a worker pool has been configured with :mod:`dataflow.parallel` then
+    independent nodes are evaluated concurrently, otherwise they are
+    evaluated one at a time in processing order.
+
     If *target* is specified, then return the target as a json serialized
     object containing the list of values on the specified output terminal.
+    Evaluation is demand driven, working backward from the target and
+    stopping at the first cached node on each path, so the cached values
+    of earlier nodes are not retrieved unless they are needed.
+
+    When evaluating a target, intermediate results are released as soon as
+    the last node which uses them has started, so that only the results
+    which are still needed are held in memory.  Use *keep=[node, ...]* to
+    hold on to particular nodes until the evaluation is complete.  The peak
+    memory held by intermediate results is reported when the evaluation
+    completes.
+
+    If *profile* is a :class:`dataflow.profile.Profile`, then the time,
+    memory and cache traffic for each node are recorded in it.
+    With write-behind enabled, the counters for storing results are added
+    as the values are written, so flush the cache before reading them.
     """
+    if profile is None:
+        profile = Profile()
+    if profile.name is None:
+        profile.name = template.name
+        profile.target = list(target)
+    profile.start()
+    try:
+        return _process_template(template, config, target, keep, profile)
+    finally:
+        profile.stop()
+
+def _process_template(template, config, target, keep, profile):
     cache = get_cache()
+    executor = get_executor_manager()
 
     results = {}
     return_node, return_terminal = target
 
     fingerprints = fingerprint_template(template, config)
-    for node, input_wires in template.ordered(target=return_node):
-        node_info = template.modules[node]
-        module = lookup_module(node_info['module'])
-        node_id = "node %d, %s"%(node, node_info['module'])
-        input_terminals = module.inputs
-        module.outputs = module.outputs
-
-        # Build the inputs; if returning an input terminal, put it in the
-        # results set.   This is extra work for the case where the results
-        # have already been computed, but it simplifies the code for the
-        # case where the return target is an input terminal.
-        inputs = _get_inputs(results, input_wires, input_terminals)
-        if return_node == node and return_terminal in inputs:
-            # We are returning inputs, so treat them as if it were outputs.
-            # That means putting them into a bundle so that we can convert
-            # to and from JSON.  But we have to find the terminal first so
-            # that we know the datatype.  Since we are only returning the
-            # inputs, we don't need to compute the node outputs, and we
-            # can return immediately.
-            for terminal in input_terminals:
-                if terminal["id"] == return_terminal:
-                    return _bundle(terminal, inputs[return_terminal])
-
-        # If the module has been flagged "nocache" for debugging, then
-        # clear all cached entries that depend on it.  If we just ignore
-        # them for this evaluation, the cached values will simply pop
-        # back once we turn on caching again.
+    order = template.order(target=return_node)
+
+    # If the module has been flagged "nocache" for debugging, then
+    # clear all cached entries that depend on it.  If we just ignore
+    # them for this evaluation, the cached values will simply pop
+    # back once we turn on caching again.  The dependents are checked
+    # with a single request.
+    dependents = set()
+    for node in order:
+        module = lookup_module(template.modules[node]['module'])
         if not module.cached:
-            for child in template.dependents(node):
-                if cache.exists(fingerprints[child]):
-                    print("clearing cached value for node %d: %s"
-                          %(child, fingerprints[child]))
-                    cache.delete(fingerprints[child])
-
-        # Use cached value if it exists, skipping to the next loop iteration.
-        if cache.exists(fingerprints[node]):
-            print("retrieving cached value for node %d: %s"
-                  %(node, fingerprints[node]))
-            bundles = cache.retrieve(fingerprints[node])
-            results.update((_key(node, k), v) for k, v in bundles.items())
-            continue
-
-        # Fields set for the current node
-        template_fields = node_info.get('config', {})
-        user_fields = config.get(str(node), {})
-
-        # Evaluate the node
-        print("calculating %s %s"%(node, module.id))
-        outputs = _eval_node(node_id, module, inputs, template_fields, user_fields)
-
-        # Collect the outputs
-        bundles = {}
-        for terminal in module.outputs:
-            tid = terminal["id"]
-            bundles[tid] = _bundle(terminal, outputs[tid])
-        #print "caching", module.id, bundles
-        #print "caching",_serialize(bundles, module.outputs)
-        if module.cached:
-            print("caching %s %s %s"%(node, module.id, fingerprints[node]))
-            cache.store(fingerprints[node], bundles)
-        results.update((_key(node, k), v) for k, v in bundles.items())
+            dependents.update(template.dependents(node))
+    dependents = sorted(dependents)
+    if dependents:
+        found = cache.exists_many(fingerprints[child] for child in dependents)
+        for child, exists in zip(dependents, found):
+            if exists:
+                print("clearing cached value for node %d: %s"
+                      %(child, fingerprints[child]))
+                cache.delete(fingerprints[child])
+
+    # If the target is an input terminal then the target node itself is
+    # never evaluated, but its sources are needed.
+    if return_node is None:
+        roots, expand = order, []
+    else:
+        module = lookup_module(template.modules[return_node]['module'])
+        returning_inputs = any(terminal["id"] == return_terminal
+                               for terminal in module.inputs)
+        roots = [return_node]
+        expand = [return_node] if returning_inputs else []
+
+    # Nodes with the same fingerprint compute the same thing, so only the
+    # first of them is evaluated and the others reuse its results.
+    aliases = _find_aliases(fingerprints, order, exclude=expand)
+
+    # Find the nodes which need to be computed and retrieve the cached nodes
+    # which feed into them.
+    compute, fetched = _plan_evaluation(
+        template, fingerprints, order, roots, expand=expand,
+        aliases=aliases, profile=profile)
+
+    # Track the upstream nodes that each node is waiting on.  A node is
+    # ready to evaluate once all of its sources have been evaluated.
+    # Cached nodes don't need their inputs, so they are ready immediately.
+    # Aliased nodes only need the node they are copying.
+    ordered = [node for node in order if node in compute or node in fetched]
+    position = dict((node, k) for k, node in enumerate(ordered))
+    waiting = dict((node, set([aliases[node]]) if node in aliases
+                    else set(wire['source'][0]
+                             for wire in template.inputs(node))
+                    if node in compute else set())
+                   for node in ordered)
+    waiting_on = dict((node, set(sources)) for node, sources in waiting.items())
+    terminals = {}
+    children = dict((node, []) for node in ordered)
+    for node, sources in waiting.items():
+        for source in sources:
+            children[source].append(node)
+    ready = [node for node in ordered if not waiting[node]]
+    running = {}
+
+    # Nodes being computed by another worker, with the time we started
+    # waiting, and the leases we hold on the nodes we are computing.
+    awaiting = {}
+    leases = {}
+
+    # Count the consumers of each node so that its results can be released
+    # once the last one has its inputs.  If returning all results then
+    # everything is kept.
+    consumers = dict((node, len(children[node])) for node in ordered)
+    protected = set(keep) | set([return_node])
+    memory = _MemoryTracker()
+
+    def _consume(node):
+        if return_node is None:
+            return
+        for source in waiting_on[node]:
+            consumers[source] -= 1
+            if consumers[source] == 0 and source not in protected:
+                for key in [_key(source, k) for k in terminals[source]]:
+                    del results[key]
+                memory.remove(source)
+
+    def _release(node):
+        for child in children[node]:
+            waiting[child].discard(node)
+            if not waiting[child]:
+                ready.append(child)
+        ready.sort(key=position.get)
+
+    def _poll_awaiting():
+        # Pick up the results stored by other workers.  If the other worker
+        # has given up its lease without storing a result then claim the
+        # lease and compute the node here.
+        nodes = sorted(awaiting, key=position.get)
+        values = cache.retrieve_many(fingerprints[node] for node in nodes)
+        for node, bundles in zip(nodes, values):
+            if bundles is None:
+                token = cache.acquire_lease(fingerprints[node])
+                if token is None:
+                    continue
+                leases[node] = token
+            else:
+                fetched[node] = bundles
+                _consume(node)
+            record = _profile_node(profile, template, fingerprints, node)
+            record.wait_time = time.time() - awaiting.pop(node)
+            ready.append(node)
+        ready.sort(key=position.get)
 
-    #print list(sorted(results.keys()))
+    try:
+        while ready or running or awaiting:
+            while ready:
+                node = ready.pop(0)
+
+                # Reuse the results of an identical node.
+                if node in aliases:
+                    source = aliases[node]
+                    print("reusing node %d for node %d"%(source, node))
+                    results.update((_key(node, k), results[_key(source, k)])
+                                   for k in terminals[source])
+                    terminals[node] = list(terminals[source])
+                    # The results are shared, so don't count them twice.
+                    memory.add(node, {})
+                    record = _profile_node(profile, template, fingerprints, node)
+                    record.status = "alias"
+                    record.alias_of = source
+                    _consume(node)
+                    _release(node)
+                    continue
+
+                # Use cached value if it exists, skipping to the next node.
+                if node in fetched:
+                    print("retrieving cached value for node %d: %s"
+                          %(node, fingerprints[node]))
+                    bundles = fetched.pop(node)
+                    results.update((_key(node, k), v)
+                                   for k, v in bundles.items())
+                    terminals[node] = list(bundles.keys())
+                    memory.add(node, bundles)
+                    record = _profile_node(profile, template, fingerprints, node)
+                    record.status = "cached"
+                    record.result_bytes = memory.sizes[node]
+                    _release(node)
+                    continue
+
+                input_wires = template.inputs(node)
+                node_info = template.modules[node]
+                module = lookup_module(node_info['module'])
+                node_id = "node %d, %s"%(node, node_info['module'])
+                input_terminals = module.inputs
+                record = _profile_node(profile, template, fingerprints, node)
+
+                # Build the inputs; if returning an input terminal, put it
+                # in the results set.
+                inputs = _get_inputs(results, input_wires, input_terminals)
+                if return_node == node and return_terminal in inputs:
+                    # We are returning inputs, so treat them as if it were
+                    # outputs.  That means putting them into a bundle so
+                    # that we can convert to and from JSON.  But we have to
+                    # find the terminal first so that we know the datatype.
+                    # Since we are only returning the inputs, we don't need
+                    # to compute the node outputs, and we can return
+                    # immediately.  Only the ancestors of the target are
+                    # evaluated, and they have all finished since the
+                    # target inputs are ready, so nothing else is running.
+                    record.status = "input"
+                    for terminal in input_terminals:
+                        if terminal["id"] == return_terminal:
+                            return _bundle(terminal, inputs[return_terminal])
+
+                # If another worker is already computing this node then
+                # wait for its result rather than computing it again.
+                if module.cached and node not in leases:
+                    token = cache.acquire_lease(fingerprints[node])
+                    if token is None:
+                        print("waiting for %s %s computed elsewhere"
+                              %(node, module.id))
+                        awaiting[node] = time.time()
+                        continue
+                    leases[node] = token
+
+                # Fields set for the current node
+                template_fields = node_info.get('config', {})
+                user_fields = config.get(str(node), {})
+
+                # Evaluate the node.  Element-wise modules are cached one
+                # dataset at a time so that only the datasets whose inputs
+                # have changed need to be recomputed.
+                if module.cached and _is_elementwise(module):
+                    input_fps = _get_input_fingerprints(
+                        results, input_wires, input_terminals, fingerprints,
+                        template, config)
+                    action_args = _resolve_args(
+                        node_id, module, inputs, template_fields, user_fields)
+                    element_fps = _element_fingerprints(
+                        module, action_args, input_fps)
+                    stats = {}
+                    partial = _retrieve_elements(
+                        cache, module, element_fps, stats)
+                    record.add_stats(stats)
+                    missing = [k for k, v in enumerate(partial) if v is None]
+                    print("calculating %s %s (%d of %d datasets)"
+                          %(node, module.id, len(missing), len(partial)))
+                    record.status = ("partial" if len(missing) < len(partial)
+                                     else "computed")
+                    record.datasets = len(partial)
+                    record.datasets_computed = len(missing)
+                    future = executor.submit(
+                        timed_call, _apply_action_by_id, module.id,
+                        [action_args[k] for k in missing])
+                    running[future] = (node, element_fps, partial, missing)
+                else:
+                    print("calculating %s %s"%(node, module.id))
+                    record.status = "computed"
+                    future = executor.submit(
+                        timed_call, _eval_node_by_id, node_id, module.id,
+                        inputs, template_fields, user_fields)
+                    running[future] = (node, None, None, None)
+
+                # The inputs have been handed to the action, so upstream
+                # results may no longer be needed.
+                del inputs
+                _consume(node)
+
+            if awaiting and not running:
+                time.sleep(LEASE_POLL)
+            if awaiting:
+                done, _ = wait(running, timeout=LEASE_POLL,
+                               return_when=FIRST_COMPLETED)
+                _poll_awaiting()
+            elif running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+            else:
+                break
+
+            for future in sorted(done, key=lambda f: position[running[f][0]]):
+                node, element_fps, partial, missing = running.pop(future)
+                module = lookup_module(template.modules[node]['module'])
+                record = _profile_node(profile, template, fingerprints, node)
+                value, timing = future.result()
+                record.add_stats(timing)
+                if element_fps is None:
+                    outputs = value
+                else:
+                    for k, result in zip(missing, value):
+                        partial[k] = result
+                    outputs, slices = _gather_outputs(module, partial)
+
+                # Collect the outputs
+                bundles = {}
+                for terminal in module.outputs:
+                    tid = terminal["id"]
+                    bundles[tid] = _bundle(terminal, outputs[tid])
+                    if element_fps is not None:
+                        bundles[tid].fingerprints = _output_fingerprints(
+                            terminal, element_fps, slices)
+                if module.cached:
+                    print("caching %s %s %s"
+                          %(node, module.id, fingerprints[node]))
+                    tags = {'module': module.id, 'version': module.version,
+                            'instrument': template.instrument}
+                    # With write-behind, the store counters are added to
+                    # the profile when the writer gets to the value.
+                    cache.store(fingerprints[node], bundles, tags=tags,
+                                callback=record.add_stats)
+                    # Record where each dataset can be found so that later
+                    # evaluations can reuse it with different neighbours.
+                    if element_fps is not None:
+                        cache.store_many(
+                            [(fp, (fingerprints[node], location))
+                             for fp, location in zip(element_fps, slices)],
+                            tags=dict(tags, kind="dataset"),
+                            callback=record.add_stats)
+                    cache.release_lease(fingerprints[node], leases.pop(node))
+                results.update((_key(node, k), v) for k, v in bundles.items())
+                terminals[node] = list(bundles.keys())
+                memory.add(node, bundles)
+                record.result_bytes = memory.sizes[node]
+                _release(node)
+    finally:
+        # Don't leave queued work behind if a node raised an exception.
+        for future in running:
+            future.cancel()
+        for node, token in leases.items():
+            cache.release_lease(fingerprints[node], token)
+
+    print("peak memory %s"%memory.summary())
+    profile.peak_memory = memory.peak
 
     if return_node is None:
         return results
     else:
         return results[_key(return_node, return_terminal)]
 
+def _plan_evaluation(template, fingerprints, order, roots, expand=(),
+                     aliases=None, profile=None):
+    """
+    Find the nodes needed to evaluate the *roots* of the template.
+
+    Starting from the roots, walk backward through the template.  Nodes
+    which are cached are retrieved rather than computed, so their inputs
+    are not needed.  Nodes in *expand* are always computed.  Nodes in
+    *aliases* are computed by copying the node they alias.  The cache
+    state of every other node in *order* is checked with one request, and
+    the cached values are retrieved with one more.
+
+    Returns *(compute, fetched)*, with *compute* the set of nodes to compute
+    and *fetched* a dictionary of *{node: bundles}* retrieved from the cache.
+    The cache traffic for the retrieved nodes is recorded in *profile*.
+    """
+    cache = get_cache()
+    if aliases is None:
+        aliases = {}
+    distinct = [node for node in order if node not in aliases]
+    keys = [fingerprints[node] for node in distinct]
+    cached = dict(zip(distinct, cache.exists_many(keys)))
+    for node in distinct:
+        module = lookup_module(template.modules[node]['module'])
+        if not module.cached or node in expand:
+            cached[node] = False
+
+    while True:
+        compute, fetch = set(), []
+        remaining = list(roots)
+        while remaining:
+            node = remaining.pop()
+            if node in compute or node in fetch:
+                continue
+            if node in aliases:
+                compute.add(node)
+                remaining.append(aliases[node])
+            elif cached[node]:
+                fetch.append(node)
+            else:
+                compute.add(node)
+                remaining.extend(wire['source'][0]
+                                 for wire in template.inputs(node))
+
+        # Entries may be evicted between checking and retrieving them, in
+        # which case they need to be computed after all.
+        stats = []
+        values = cache.retrieve_many(
+            (fingerprints[node] for node in fetch), stats)
+        if profile is not None:
+            for node, entry in zip(fetch, stats):
+                _profile_node(profile, template, fingerprints, node).add_stats(
+                    entry)
+        missing = [node for node, v in zip(fetch, values) if v is None]
+        if not missing:
+            return compute, dict(zip(fetch, values))
+        for node in missing:
+            cached[node] = False
+
+
+def _find_aliases(fingerprints, order, exclude=()):
+    """
+    Find the nodes which have the same fingerprint as an earlier node.
+
+    Returns *{node: first node}* for each repeated node in *order*.  Nodes
+    in *exclude* are neither aliased nor aliases.
+    """
+    first = {}
+    aliases = {}
+    for node in order:
+        if node in exclude:
+            continue
+        fp = fingerprints[node]
+        if fp in first:
+            aliases[node] = first[fp]
+        else:
+            first[fp] = node
+    return aliases
+
+
+def _profile_node(profile, template, fingerprints, node):
+    """
+    Return the profile record for *node*.
+    """
+    return profile.node(node, template.modules[node]['module'],
+                        fingerprints[node])
+
+
+class _MemoryTracker(object):
+    """
+    Track the memory held by intermediate results during an evaluation.
+
+    The size of each node result is estimated from the arrays, strings and
+    containers it references.  Memory shared between nodes is counted for
+    each node, so the estimate is an upper bound.
+    """
+    def __init__(self):
+        self.sizes = {}
+        self.live = 0
+        self.peak = 0
+
+    def add(self, node, bundles):
+        size = estimate_nbytes(bundles)
+        self.sizes[node] = size
+        self.live += size
+        self.peak = max(self.peak, self.live)
+
+    def remove(self, node):
+        self.live -= self.sizes.pop(node, 0)
+
+    def summary(self):
+        text = "%.1f MiB held in intermediate results"%(self.peak/2**20)
+        rss = peak_rss()
+        if rss is not None:
+            text += ", %.1f MiB process peak RSS"%(rss/2**20)
+        return text
+
+
 def _bundle(terminal, values):
     """
     Build a bundle for the terminal values.  The bundle has to carry the
@@ -173,6 +588,210 @@ def _get_inputs(results, input_wires, input_terminals):
     return inputs
 
 
+def _get_input_fingerprints(results, input_wires, input_terminals,
+                            fingerprints, template, config):
+    """
+    Lookup the fingerprints of the datasets on each input terminal.
+
+    *fingerprints* are the node fingerprints for the *template* evaluated
+    with *config*.
+
+    Returns *{terminal: [fingerprint, ...]}*, in the same order as the
+    datasets returned by :func:`_get_inputs`.
+    """
+    input_fps = dict((terminal["id"], []) for terminal in input_terminals)
+    for wire in input_wires:
+        source_node, source_terminal = wire["source"]
+        target_node, target_terminal = wire["target"]
+        bundle = results[_key(source_node, source_terminal)]
+        if bundle.fingerprints is None:
+            bundle.fingerprints = _source_fingerprints(
+                template, config, source_node, source_terminal, bundle.values)
+        if bundle.fingerprints is None:
+            bundle.fingerprints = _bundle_fingerprints(
+                bundle, fingerprints[source_node], source_terminal)
+        input_fps[target_terminal].extend(bundle.fingerprints)
+    return input_fps
+
+
+def tag_source(datasets, source):
+    """
+    Record where each of *datasets* came from, for use in dataset
+    fingerprints.
+
+    *source* is a fingerprint for the file the datasets were read from,
+    which changes whenever the file or the code reading it changes.  The
+    datasets are tagged with the source and their index within the file.
+    Datasets which don't accept attributes are left untagged.
+    """
+    for j, dataset in enumerate(datasets):
+        try:
+            dataset.source_fingerprint = "%s:%d"%(source, j)
+        except AttributeError:
+            pass
+
+
+def _source_fingerprints(template, config, node, terminal, values):
+    """
+    Return the fingerprint for each dataset produced by a loader on
+    *terminal* of *node*, or None if they can't be identified.
+
+    Each dataset is identified by the source recorded with :func:`tag_source`
+    when the file was read, along with the loader and its settings other
+    than the file list.  Adding a file to the loader then leaves the
+    fingerprints of the datasets from the other files unchanged, so the
+    element-wise steps which follow only compute the new datasets.
+    """
+    module = lookup_module(template.modules[node]['module'])
+    if module.inputs:
+        return None
+    sources = [getattr(value, 'source_fingerprint', None) for value in values]
+    if any(source is None for source in sources):
+        return None
+    fields = template.modules[node].get('config', {}).copy()
+    fields.update(config.get(str(node), {}))
+    file_fields = set(field["id"] for field in module.fields
+                      if field["datatype"] == "fileinfo")
+    fields = dict((k, v) for k, v in fields.items() if k not in file_fields)
+    parts = [module.id, module.version, _Ordered(fields), terminal]
+    # The same file may be listed twice, so count repeated sources.
+    seen = {}
+    fingerprints = []
+    for source in sources:
+        seen[source] = seen.get(source, 0) + 1
+        fingerprints.append(generate_fingerprint(
+            parts + [source, str(seen[source])]))
+    return fingerprints
+
+
+def _bundle_fingerprints(bundle, node_fp, terminal):
+    """
+    Return the fingerprint for each dataset in the bundle on *terminal*
+    of the node with fingerprint *node_fp*.
+
+    This is used for bundles whose datasets don't have a known source,
+    with the fingerprint derived from the node fingerprint and the position
+    of the dataset in the bundle.  Any change to the node then changes the
+    fingerprints of all of its datasets.
+    """
+    return [generate_fingerprint([node_fp, terminal, str(j)])
+            for j in range(len(bundle.values))]
+
+
+def _is_elementwise(module):
+    """
+    Return True if the module action is called once for each dataset.
+
+    This is determined by the first input terminal.  See :func:`_eval_node`.
+    """
+    return bool(module.inputs) and module.inputs[0]["length"] != 0
+
+
+def _element_fingerprints(module, action_args, input_fps):
+    """
+    Create a fingerprint for each call to the action of an element-wise
+    module.
+
+    *action_args* is the list of argument sets returned by
+    :func:`_resolve_args`, and *input_fps* contains the dataset fingerprints
+    for each input terminal as returned by :func:`_get_input_fingerprints`.
+
+    The fingerprint depends on the field values for that call and the
+    fingerprints of the datasets it receives, but not on the other datasets
+    in the bundle.  As for :func:`fingerprint_node`, the fingerprints are
+    prefixed by the module id.
+    """
+    input_ids = set(terminal["id"] for terminal in module.inputs)
+    fingerprints = []
+    for k, args in enumerate(action_args):
+        fields = dict((name, value) for name, value in args.items()
+                      if name not in input_ids)
+        parts = [module.id, module.version, _Ordered(fields)]
+        for terminal in module.inputs:
+            tid = terminal["id"]
+            fps = input_fps[tid]
+            if not fps:
+                selected = []
+            elif terminal["length"] == 0:
+                selected = fps
+            elif len(fps) == len(action_args):
+                selected = [fps[k]]
+            else:
+                selected = [fps[0]]
+            parts.append(tid)
+            parts.extend(selected)
+        fingerprints.append(module.id + ":" + generate_fingerprint(parts))
+    return fingerprints
+
+
+def _output_fingerprints(terminal, element_fps, slices):
+    """
+    Derive the fingerprints of the output datasets on *terminal* from the
+    fingerprints of the action calls which produced them.
+    """
+    tid = terminal["id"]
+    fingerprints = []
+    for fp, location in zip(element_fps, slices):
+        start, stop = location[tid]
+        if terminal["length"] == 0:
+            fingerprints.extend(generate_fingerprint([fp, tid, str(j)])
+                                for j in range(stop - start))
+        else:
+            fingerprints.append(generate_fingerprint([fp, tid]))
+    return fingerprints
+
+
+def _retrieve_elements(cache, module, element_fps, stats=None):
+    """
+    Lookup the cached results for each call to an element-wise action.
+
+    The cache entry for each call records the fingerprint of the node
+    which computed it and the location of the outputs within that node,
+    so the datasets are retrieved from the cached node bundles rather
+    than being stored twice.
+
+    Returns a list with the action result for each call, or None if the
+    call needs to be computed.  The cache traffic is added to *stats*.
+    """
+    entries = []
+    pointers = cache.retrieve_many(element_fps, entries)
+    node_fps = list(set(p[0] for p in pointers if p is not None))
+    sources = dict(zip(node_fps, cache.retrieve_many(node_fps, entries)))
+    for entry in entries:
+        for name, value in entry.items():
+            add_stat(stats, name, value)
+    partial = []
+    for pointer in pointers:
+        bundles = sources[pointer[0]] if pointer is not None else None
+        if bundles is None:
+            partial.append(None)
+            continue
+        location = pointer[1]
+        result = []
+        for terminal in module.outputs:
+            tid = terminal["id"]
+            start, stop = location[tid]
+            values = bundles[tid].values
+            if terminal["length"] == 0:
+                result.append(values[start:stop])
+            else:
+                result.append(values[start])
+        partial.append(result)
+    return partial
+
+
+def _eval_node_by_id(node_id, module_id, inputs, template_fields, user_fields):
+    """
+    Run the action for the node given the module id.
+
+    This is the task sent to the worker pool.  Modules hold a reference to
+    the action function, so look them up by id in the worker rather than
+    sending them along with the inputs.
+    """
+    module = lookup_module(module_id)
+    return _eval_node(node_id, module, inputs, template_fields, user_fields)
+
+
 def _eval_node(node_id, module, inputs, template_fields, user_fields):
     """
     Run the action for the node.
@@ -201,6 +820,23 @@ def _eval_node(node_id, module, inputs, template_fields, user_fields):
     # a bundle.  With mixed single input/multiple output, all outputs
     # are concatenated into one bundle.
 
+    action_args = _resolve_args(node_id, module, inputs,
+                                template_fields, user_fields)
+    results = _apply_action(module, action_args)
+    outputs, _ = _gather_outputs(module, results)
+    return outputs
+
+
+def _resolve_args(node_id, module, inputs, template_fields, user_fields):
+    """
+    Determine the action arguments for each call to the module action.
+
+    The arguments are described in :func:`_eval_node`.
+
+    Returns a list of *{name: value}*, with one set of arguments for each
+    dataset in the bundle for element-wise modules, or a single set of
+    arguments for modules which take the whole bundle.
+    """
     # Check arity of module. This is determined by the first input terminal.
     multiple = not module.inputs or module.inputs[0]["length"] == 0
     bundle_length = 1 if multiple else len(inputs[module.inputs[0]["id"]])
@@ -249,26 +885,57 @@ def _eval_node(node_id, module, inputs, template_fields, user_fields):
         else:
             raise ValueError("Need one value of %s for each dataset"%name)
 
-    # Allocate slots for results
-    outputs = dict((terminal["id"], []) for terminal in module.outputs)
+    return [dict((name, values[k]) for name, values in fields.items())
+            for k in range(bundle_length)]
+
+
+def _apply_action_by_id(module_id, action_args):
+    """
+    Apply the module action to each set of arguments given the module id.
+
+    This is the task sent to the worker pool for element-wise modules.
+    """
+    return _apply_action(lookup_module(module_id), action_args)
+
+
+def _apply_action(module, action_args):
+    """
+    Call the module action for each set of arguments in *action_args*,
+    returning the list of results.
+
+    If there is more than one set of arguments, the calls are fanned out
+    across the dataset pool if one is configured.
+    """
+    if len(action_args) > 1:
+        executor = get_dataset_executor_manager()
+        return executor.map(_do_action_by_id,
+                            [module.id]*len(action_args), action_args)
+    else:
+        return [_do_action(module, **args) for args in action_args]
 
-    for k in range(bundle_length):
-        # set up inputs
-        action_args = dict((name, values[k]) for name, values in fields.items())
 
-        # perform action
-        #print "args", node_id, k, action_args
-        result = _do_action(module, **action_args)
+def _gather_outputs(module, results):
+    """
+    Collect the action results into output terminal bundles.
 
-        #print node_id,result
-        # Gather outputs
+    Returns *outputs* as *{terminal: [data, ...]}* and *slices* as a list
+    containing *{terminal: (start, stop)}* for each result, giving the
+    location of that result within the output terminal.
+    """
+    outputs = dict((terminal["id"], []) for terminal in module.outputs)
+    slices = []
+    for result in results:
+        location = {}
         for terminal, data in zip(module.outputs, result):
+            values = outputs[terminal["id"]]
+            start = len(values)
             if terminal["length"] == 0:
-                outputs[terminal["id"]].extend(data)
+                values.extend(data)
             else:
-                outputs[terminal["id"]].append(data)
-
-    return outputs
+                values.append(data)
+            location[terminal["id"]] = (start, len(values))
+        slices.append(location)
+    return outputs, slices
 
 
 def _validate_par(node_id, par, value):
@@ -283,6 +950,16 @@ def _validate_par(node_id, par, value):
         raise
 
 
+def _do_action_by_id(module_id, action_args):
+    """
+    Perform the action for the module given the module id.
+
+    This is the task sent to the dataset pool, with the module looked up
+    by id in the worker.
+    """
+    return _do_action(lookup_module(module_id), **action_args)
+
+
 def _do_action(module, **action_args):
     """
     Perform the module action, returning the results as a list.
@@ -331,27 +1008,146 @@ def fingerprint_template(template, config):
 def fingerprint_node(module, node_config, inputs_fp):
     """
     Create a unique sha1 hash for a module based on its attributes and inputs.
+
+    The hash is computed incrementally from the ordered form of the config,
+    without building the config string.  Fingerprints are memoized by module
+    id, version, config and input fingerprints, so repeated requests for
+    the same template only need to check that the config is unchanged.
+
+    The hash is prefixed by the module id, as in "ncnr.refl.join:<sha1>",
+    so that the cache can place results in per-instrument partitions.
+    Entries cached under the earlier unprefixed fingerprints are no longer
+    found, so they are recomputed and the old entries are left to be
+    evicted.
     """
     config = module.get('config', {}).copy()
     config.update(node_config)
-    config_str = str(_format_ordered(config))
-    current_module_version = lookup_module(module['module']).version
-    parts = [module['module'], current_module_version, config_str] + inputs_fp
-    return generate_fingerprint(parts)
+    module_id = module['module']
+    current_module_version = lookup_module(module_id).version
+    config_key = _config_key(config)
+    memo_key = ((module_id, current_module_version, config_key,
+                 tuple(inputs_fp))
+                if config_key is not None else None)
+    fp = _FINGERPRINT_MEMO.get(memo_key) if memo_key is not None else None
+    if fp is None:
+        fp = module_id + ":" + generate_fingerprint(
+            [module_id, current_module_version, _Ordered(config)] + inputs_fp)
+        if memo_key is not None:
+            _FINGERPRINT_MEMO.put(memo_key, fp)
+    return fp
 
 def generate_fingerprint(parts):
     """
     Generate a fingerprint from string parts.
+
+    Parts can also be wrapped in :class:`_Ordered`, in which case the
+    ordered form of the value is hashed as if it were *str(_format_ordered(v))*.
+    """
+    digest = hashlib.sha1()
+    write = _digest_writer(digest)
+    for k, part in enumerate(parts):
+        if k:
+            write(":")
+        if isinstance(part, _Ordered):
+            _write_ordered(write, part.value)
+        else:
+            write(part)
+    return digest.hexdigest()
+
+
+class _Ordered(object):
+    """
+    Marker for a part of a fingerprint which is hashed in ordered form.
+    """
+    def __init__(self, value):
+        self.value = value
+
+
+def _digest_writer(digest):
+    """
+    Return a function which feeds text into *digest*.
     """
-    key = ":".join(parts)
     if IS_PY3:
-        key = key.encode('utf-8')
-    fp = hashlib.sha1(key).hexdigest()
-    return fp
+        return lambda text: digest.update(text.encode('utf-8'))
+    return digest.update
+
+class _DigestFile(object):
+    """
+    File-like object which feeds everything written to it into a digest.
+    """
+    def __init__(self, digest):
+        self.write = digest.update
+
+class _ConfigPickler(pickle.Pickler):
+    """
+    Pickler which writes functions as their source rather than their name,
+    so that the pickle changes when the function is redefined.
+    """
+    def persistent_id(self, obj):
+        if callable(obj) and not isinstance(obj, type):
+            return _getsource(obj)
+        return None
+
+def _config_key(config):
+    """
+    Return a digest of the pickled config for memoizing fingerprints, or
+    None if the config cannot be pickled.
+
+    Pickling is much faster than formatting the config, but the pickle
+    depends on the insertion order of dictionaries, so it is only used to
+    recognize a config which has been seen before, not as the fingerprint
+    itself.  Functions in the config are pickled as their source, as they
+    are fingerprinted by :func:`_format_ordered`.
+    """
+    digest = hashlib.sha1()
+    try:
+        _ConfigPickler(_DigestFile(digest),
+                       protocol=pickle.HIGHEST_PROTOCOL).dump(config)
+    except Exception:
+        return None
+    return digest.digest()
+
+
+class _FingerprintMemo(object):
+    """
+    Bounded least recently used map from node description to fingerprint.
+    """
+    def __init__(self, size=4096):
+        from collections import OrderedDict
+        import threading
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+_FINGERPRINT_MEMO = _FingerprintMemo()
+
+
+# Values which are formatted as themselves.  These are checked first since
+# python 3.11 defines __getstate__ for all objects, which formatted every
+# string as ['str', None] so that configs differing only in their strings
+# had the same fingerprint.  Fingerprints from python 3.11 and later change
+# as a result; those from earlier versions are unchanged.
+_PRIMITIVES = (str, bytes, int, float, complex, bool, type(None))
 
 # new methods that keep everything ordered
 def _format_ordered(value):
-    if isinstance(value, dict):
+    if isinstance(value, _PRIMITIVES):
+        return value
+    elif isinstance(value, dict):
         return list((k, _format_ordered(v)) for k, v in sorted(value.items()))
     elif isinstance(value, list):
         return [_format_ordered(v) for v in value]
@@ -359,7 +1155,7 @@ def _format_ordered(value):
         return tuple(_format_ordered(v) for v in value)
     elif callable(value):
         print("fingerprinting function %s"%str(value))
-        return getsource(value)
+        return _getsource(value)
     elif hasattr(value, '__getstate__'):
         print("fingerprinting class using getstate %s"%str(value))
         return [value.__class__.__name__, _format_ordered(value.__getstate__())]
@@ -369,6 +1165,64 @@ def _format_ordered(value):
     else:
         return value
 
+def _write_ordered(write, value):
+    """
+    Write *str(_format_ordered(value))* piece by piece using *write(text)*.
+
+    *value* should be a container; top level strings are written as
+    their repr rather than as themselves.
+    """
+    if isinstance(value, _PRIMITIVES):
+        write(repr(value))
+    elif isinstance(value, dict):
+        write("[")
+        for k, (key, item) in enumerate(sorted(value.items())):
+            write(", (" if k else "(")
+            write(repr(key))
+            write(", ")
+            _write_ordered(write, item)
+            write(")")
+        write("]")
+    elif isinstance(value, list):
+        write("[")
+        for k, item in enumerate(value):
+            if k:
+                write(", ")
+            _write_ordered(write, item)
+        write("]")
+    elif isinstance(value, tuple):
+        write("(")
+        for k, item in enumerate(value):
+            if k:
+                write(", ")
+            _write_ordered(write, item)
+        write(",)" if len(value) == 1 else ")")
+    elif callable(value):
+        write(repr(_getsource(value)))
+    elif hasattr(value, '__getstate__'):
+        write("[%r, "%value.__class__.__name__)
+        _write_ordered(write, value.__getstate__())
+        write("]")
+    elif hasattr(value, '__dict__'):
+        write("[%r, "%value.__class__.__name__)
+        _write_ordered(write, value.__dict__)
+        write("]")
+    else:
+        write(repr(value))
+
+def _getsource(fn):
+    """
+    Return the source code for *fn*, caching the result.
+    """
+    try:
+        return _getsource_cached(fn)
+    except TypeError: # unhashable callable
+        return getsource(fn)
+
+@lru_cache(maxsize=256)
+def _getsource_cached(fn):
+    return getsource(fn)
+
 
 # ===== Test support ===
 @contextlib.contextmanager
@@ -496,3 +1350,24 @@ def test_format_ordered():
         actual = _format_ordered(u)
         print("%s => %r =? %r"%(str(u), actual, o))
         assert actual == o
+
+def test_generate_fingerprint():
+    # Incremental hashing gives the same fingerprint as formatting the
+    # config as a string.
+    def ufn(a): return a
+    class A(object):
+        def __init__(self):
+            self.x, self.a = 2, 3
+    configs = [
+        {},
+        {'x': 2, 'a': [1, 2.5, None, True]},
+        {'files': [{'path': "a/b'c", 'mtime': 1}]*3, 'tup': (1,), 'e': ()},
+        {'fn': ufn, 'obj': A(), 'nested': {'t': (1, 'u', {'z': -1})}},
+        ]
+    for config in configs:
+        expected = hashlib.sha1(":".join(
+            ["mod", "1.0", str(_format_ordered(config)), "out", "fp"]
+            ).encode('utf-8')).hexdigest()
+        actual = generate_fingerprint(
+            ["mod", "1.0", _Ordered(config), "out", "fp"])
+        assert actual == expected, (config, actual, expected)
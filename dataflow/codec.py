@@ -0,0 +1,435 @@
+"""
+Serialization of cached values.
+
+Values are pickled with protocol 5 so that large contiguous buffers, such
+as the numpy arrays holding detector images and data columns, are kept
+out of the pickle stream.  Each buffer is written to the frame as is, so
+no copy is made of the array data when encoding, and on decoding the
+arrays refer directly to the memory returned by the cache.  Buffers can
+be compressed independently, which avoids compressing the whole pickle
+as one large block and gives each array its own chance to shrink.
+
+The frame is::
+
+    header: magic b"RDF\\x01", part count (uint32)
+    table: for each part, stored length, raw length (uint64), codec (uint32)
+    parts: pickle stream followed by the out-of-band buffers, each part
+           starting on a 64 byte boundary
+
+Values stored in the cache by earlier versions are plain pickles, possibly
+lz4 compressed, and are still decoded.
+
+The codec is chosen separately for each part.  With *compress="auto"*,
+small parts are stored raw, parts which don't shrink when a sample is
+compressed (such as the contents of NeXus zip files) are stored raw, small
+metadata pickles use zstd with a trained dictionary if one is loaded, and
+the remaining parts use lz4, or zstd if lz4 does poorly on the sample.
+zstd requires the optional *zstandard* package (pip install reductus[zstd]);
+without it, lz4 is used, though :func:`dataflow.configure.apply_config`
+refuses a config which asks for zstd by name.
+
+Raw file contents are stored with :func:`encode_bytes`, which writes a
+single part frame::
+
+    header: magic b"RDB\x01", codec (uint32), raw length (uint64)
+    data: starting on a 64 byte boundary
+"""
+import struct
+import time
+import itertools
+
+try:
+    # CRUFT: use cPickle for python 2.7
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .profile import add_stat
+
+MAGIC = b"RDF\x01"
+_HEADER = struct.Struct("<4sI")
+_PART = struct.Struct("<QQI4x")
+ALIGNMENT = 64
+
+BLOB_MAGIC = b"RDB\x01"
+_BLOB = struct.Struct("<4sIQ")
+
+# Codec ids for the parts of the frame
+RAW = 0
+LZ4 = 1
+ZSTD = 2
+ZSTD_DICT = 3
+CODEC_NAMES = {RAW: "raw", LZ4: "lz4", ZSTD: "zstd", ZSTD_DICT: "zstd_dict"}
+
+# Buffers smaller than this are left in the pickle stream.
+MIN_BUFFER_SIZE = 4096
+# Parts smaller than this are not worth compressing.
+MIN_COMPRESS_SIZE = 256
+# Parts up to this size use the zstd dictionary if there is one.
+DICT_MAX_SIZE = 16384
+# Size of the sample compressed to estimate the compression ratio.
+SAMPLE_SIZE = 65536
+# Parts are stored raw if the sample is larger than this fraction when
+# compressed, or use zstd if it is larger than the zstd fraction.
+RAW_RATIO = 0.9
+ZSTD_RATIO = 0.5
+ZSTD_LEVEL = 3
+
+# Loaded zstd dictionaries by dictionary id, and the one used for encoding.
+_DICTIONARIES = {}
+_ACTIVE_DICTIONARY = None
+
+
+def encode(value, compress=False, protocol=pickle.HIGHEST_PROTOCOL,
+           stats=None):
+    """
+    Convert *value* to bytes for storing in the cache.
+
+    *compress* selects the codec for each part of the frame.  It is one of
+    False for no compression, "lz4", "zstd", or "auto" to choose the codec
+    from the size of the part and how well a sample compresses.  True is
+    the same as "auto".  Parts are stored raw if the codec doesn't make
+    them smaller.  If *protocol* is less
+    than 5, then out-of-band buffers are not available and the value is
+    stored as a plain pickle as in earlier versions.
+
+    Pickle and compression times are added to the *stats* dictionary.
+    """
+    t0 = time.time()
+    if protocol < 5:
+        # CRUFT: pickle protocol 5 requires python 3.8
+        string = pickle.dumps(value, protocol=protocol)
+        t1 = time.time()
+        if compress:
+            # CRUFT: plain pickles are always lz4 compressed
+            import lz4.frame
+            string = lz4.frame.compress(string)
+        add_stat(stats, "pickle_time", t1 - t0)
+        add_stat(stats, "compress_time", time.time() - t1)
+        return string
+
+    buffers = []
+    def _collect(buffer):
+        view = buffer.raw()
+        if view.nbytes < MIN_BUFFER_SIZE:
+            return True  # keep small buffers in band
+        buffers.append(view)
+        return False
+    stream = pickle.dumps(value, protocol=protocol, buffer_callback=_collect)
+    t1 = time.time()
+    parts = [_compress(part, compress)
+             for part in [memoryview(stream)] + buffers]
+    t2 = time.time()
+
+    table = [_HEADER.pack(MAGIC, len(parts))]
+    table.extend(_PART.pack(len(data), raw_length, codec)
+                 for data, raw_length, codec in parts)
+    offset = sum(len(entry) for entry in table)
+    frame = table
+    for data, _, _ in parts:
+        padding = -offset % ALIGNMENT
+        frame.append(b"\0"*padding)
+        frame.append(data)
+        offset += padding + len(data)
+    result = b"".join(frame)
+    add_stat(stats, "pickle_time", t1 - t0 + time.time() - t2)
+    add_stat(stats, "compress_time", t2 - t1)
+    return result
+
+
+def decode(data, compress=False, copy=False, stats=None):
+    """
+    Convert bytes from the cache back to a value.
+
+    Arrays in uncompressed buffers refer directly to *data*.  If *data* is
+    immutable, as it is for bytes, then these arrays are read only.  Use
+    *copy=True* to give each array its own writable memory.  Compressed
+    buffers are decompressed into new writable memory.
+
+    *compress* is only used for plain pickles from earlier versions, which
+    don't record whether they are compressed.  Each part of a frame
+    records its own codec.
+
+    Decompression and unpickle times are added to the *stats* dictionary.
+    """
+    t0 = time.time()
+    view = memoryview(data)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        # CRUFT: values stored before the framed format was introduced
+        if compress:
+            import lz4.frame
+            data = lz4.frame.decompress(data)
+        t1 = time.time()
+        value = pickle.loads(data)
+        add_stat(stats, "decompress_time", t1 - t0)
+        add_stat(stats, "unpickle_time", time.time() - t1)
+        return value
+
+    _, count = _HEADER.unpack_from(view, 0)
+    offset = _HEADER.size
+    table = []
+    for _ in range(count):
+        table.append(_PART.unpack_from(view, offset))
+        offset += _PART.size
+    parts = []
+    for stored_length, raw_length, codec in table:
+        offset += -offset % ALIGNMENT
+        part = _decompress(view[offset:offset+stored_length], codec, copy)
+        if len(part) != raw_length:
+            raise ValueError("corrupt cache entry")
+        parts.append(part)
+        offset += stored_length
+    t1 = time.time()
+    value = pickle.loads(parts[0], buffers=parts[1:])
+    add_stat(stats, "decompress_time", t1 - t0)
+    add_stat(stats, "unpickle_time", time.time() - t1)
+    return value
+
+
+def encode_bytes(data, compress=False, stats=None):
+    """
+    Frame the raw file contents *data* for storing in the cache.
+
+    *compress* selects the codec as for :func:`encode`.  The compression
+    time is added to the *stats* dictionary.
+    """
+    t0 = time.time()
+    data, raw_length, codec = _compress(memoryview(data), compress)
+    header = _BLOB.pack(BLOB_MAGIC, codec, raw_length)
+    padding = b"\0"*(-len(header) % ALIGNMENT)
+    result = b"".join((header, padding, data))
+    add_stat(stats, "compress_time", time.time() - t0)
+    return result
+
+
+def write_bytes(fid, chunks, compress=False, stats=None):
+    """
+    Write the framed file contents from the iterable *chunks* to *fid*.
+
+    This produces the same frame as :func:`encode_bytes` on the joined
+    chunks, but without holding the whole contents in memory.  The codec
+    is chosen from the first chunk, with lz4 used in place of zstd since
+    zstd is not streamed.  *fid* must be seekable so that the length can
+    be written to the header at the end.
+
+    Returns the number of bytes written.
+    """
+    t0 = time.time()
+    start = fid.tell()
+    header_size = _BLOB.size + (-_BLOB.size % ALIGNMENT)
+    fid.write(b"\0"*header_size)
+    chunks = iter(chunks)
+    first = next(chunks, b"")
+    codec = RAW if _choose_codec(memoryview(first), compress) == RAW else LZ4
+    if codec == LZ4:
+        import lz4.frame
+        compressor = lz4.frame.LZ4FrameCompressor()
+        fid.write(compressor.begin())
+        write = lambda data: fid.write(compressor.compress(data))
+    else:
+        write = fid.write
+    raw_length = 0
+    for chunk in itertools.chain([first], chunks):
+        raw_length += len(chunk)
+        write(chunk)
+    if codec == LZ4:
+        fid.write(compressor.flush())
+    end = fid.tell()
+    fid.seek(start)
+    fid.write(_BLOB.pack(BLOB_MAGIC, codec, raw_length))
+    fid.seek(end)
+    add_stat(stats, "compress_time", time.time() - t0)
+    return end - start
+
+
+def decode_bytes(data, compress=False, stats=None):
+    """
+    Return the file contents from the cache entry *data*.
+
+    Uncompressed contents are returned as a view of *data*, so a memory
+    mapped entry is not read until it is used.  Entries stored by earlier
+    versions have no header, and are lz4 compressed if *compress* is True.
+    """
+    t0 = time.time()
+    view = memoryview(data)
+    if bytes(view[:len(BLOB_MAGIC)]) != BLOB_MAGIC:
+        # CRUFT: file contents stored before the framed format
+        if compress:
+            import lz4.frame
+            data = lz4.frame.decompress(data)
+        add_stat(stats, "decompress_time", time.time() - t0)
+        return data
+    _, codec, raw_length = _BLOB.unpack_from(view, 0)
+    offset = _BLOB.size + (-_BLOB.size % ALIGNMENT)
+    result = _decompress(view[offset:], codec, copy=False)
+    if len(result) != raw_length:
+        raise ValueError("corrupt cache entry")
+    add_stat(stats, "decompress_time", time.time() - t0)
+    return result
+
+
+def load_dictionary(data):
+    """
+    Use the zstd dictionary *data* to compress small parts.
+
+    Dictionaries loaded previously are kept for decoding the entries which
+    were compressed with them.  Use *data=None* to stop using a dictionary
+    for compression.
+    """
+    global _ACTIVE_DICTIONARY
+    if data is None:
+        _ACTIVE_DICTIONARY = None
+        return
+    if zstandard is None:
+        raise ImportError("zstd dictionaries require the zstandard package")
+    dictionary = zstandard.ZstdCompressionDict(data)
+    _DICTIONARIES[dictionary.dict_id()] = dictionary
+    _ACTIVE_DICTIONARY = dictionary
+
+
+def train_dictionary(values, size=112640, protocol=pickle.HIGHEST_PROTOCOL):
+    """
+    Return a zstd dictionary of *size* bytes trained on the pickle streams
+    of *values*.  Use :func:`load_dictionary` to load it.
+    """
+    if zstandard is None:
+        raise ImportError("zstd dictionaries require the zstandard package")
+    samples = []
+    for value in values:
+        stream = pickle.dumps(value, protocol=protocol,
+                              buffer_callback=lambda buffer: False)
+        if len(stream) <= DICT_MAX_SIZE:
+            samples.append(stream)
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+def _choose_codec(view, compress):
+    """
+    Return the codec for the bytes in *view* given the *compress* option.
+    """
+    if not compress or view.nbytes < MIN_COMPRESS_SIZE:
+        return RAW
+    if compress == "lz4":
+        return LZ4
+    elif compress == "zstd":
+        return ZSTD if zstandard is not None else LZ4
+    elif compress is not True and compress != "auto":
+        raise ValueError("unknown compression %r"%(compress,))
+    zstd = zstandard is not None
+    if (zstd and _ACTIVE_DICTIONARY is not None
+            and view.nbytes <= DICT_MAX_SIZE):
+        return ZSTD_DICT
+    import lz4.frame
+    sample = view[:SAMPLE_SIZE]
+    ratio = len(lz4.frame.compress(sample))/sample.nbytes
+    if ratio > RAW_RATIO:
+        return RAW
+    elif zstd and ratio > ZSTD_RATIO:
+        return ZSTD
+    return LZ4
+
+
+def _compress(view, compress):
+    """
+    Return *(data, raw length, codec)* for one part of the frame.
+    """
+    raw_length = view.nbytes
+    codec = _choose_codec(view, compress)
+    if codec == LZ4:
+        import lz4.frame
+        data = lz4.frame.compress(view)
+    elif codec == ZSTD:
+        data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(view)
+    elif codec == ZSTD_DICT:
+        data = zstandard.ZstdCompressor(
+            level=ZSTD_LEVEL, dict_data=_ACTIVE_DICTIONARY).compress(view)
+    if codec != RAW and len(data) < raw_length:
+        return data, raw_length, codec
+    return view, raw_length, RAW
+
+
+def _decompress(view, codec, copy):
+    if codec == LZ4:
+        import lz4.frame
+        return lz4.frame.decompress(view, return_bytearray=True)
+    elif codec == ZSTD:
+        return bytearray(zstandard.ZstdDecompressor().decompress(view))
+    elif codec == ZSTD_DICT:
+        dict_id = zstandard.get_frame_parameters(view).dict_id
+        if dict_id not in _DICTIONARIES:
+            raise ValueError("zstd dictionary %d is not loaded"%dict_id)
+        decompressor = zstandard.ZstdDecompressor(
+            dict_data=_DICTIONARIES[dict_id])
+        return bytearray(decompressor.decompress(view))
+    elif codec == RAW:
+        return bytearray(view) if copy else view
+    raise ValueError("unknown cache codec %d"%codec)
+
+
+def test_codec():
+    import numpy as np
+    value = {
+        'big': np.repeat(np.arange(100.), 100),
+        'small': np.arange(10),
+        'strided': np.arange(20000.)[::2],
+        'text': "abc",
+        }
+    for compress in (False, True):
+        for copy in (False, True):
+            data = encode(value, compress=compress)
+            assert data[:len(MAGIC)] == MAGIC
+            result = decode(data, compress=compress, copy=copy)
+            assert sorted(result.keys()) == sorted(value.keys())
+            for key in ('big', 'small', 'strided'):
+                assert (result[key] == value[key]).all()
+            assert result['text'] == "abc"
+            writeable = copy or compress
+            assert result['big'].flags.writeable == writeable
+    # Uncompressed arrays are views on the stored bytes.
+    data = encode(value)
+    result = decode(data)
+    assert not result['big'].flags.owndata
+    # Plain pickles from earlier versions can still be read.
+    assert decode(pickle.dumps([1, 2])) == [1, 2]
+
+def test_codec_selection():
+    import os
+    import numpy as np
+    noise = os.urandom(20000)
+    zeros = np.zeros(20000)
+    assert _choose_codec(memoryview(b"x"*100), "auto") == RAW
+    assert _choose_codec(memoryview(noise), "auto") == RAW
+    assert _choose_codec(memoryview(zeros).cast("B"), "auto") == LZ4
+    assert _choose_codec(memoryview(zeros).cast("B"), "lz4") == LZ4
+    # Incompressible parts are stored raw whatever the codec.
+    _, _, codec = _compress(memoryview(noise), "lz4")
+    assert codec == RAW
+    data = encode({"noise": noise, "zeros": zeros}, compress="auto")
+    result = decode(data)
+    assert result["noise"] == noise and (result["zeros"] == 0).all()
+    # File contents are framed, with raw contents returned as a view.
+    for compress in (False, "auto"):
+        for contents in (noise, zeros.tobytes()):
+            blob = encode_bytes(contents, compress=compress)
+            assert bytes(decode_bytes(blob, compress=compress)) == contents
+    assert len(encode_bytes(zeros.tobytes(), compress="auto")) < 20000
+    # File contents from earlier versions have no header.
+    import lz4.frame
+    assert decode_bytes(lz4.frame.compress(noise), compress=True) == noise
+    assert decode_bytes(noise) == noise
+    # Streamed contents give the same frame as the joined chunks.
+    import io
+    for compress in (False, "auto"):
+        for contents in (noise, zeros.tobytes()):
+            fid = io.BytesIO()
+            chunks = [contents[k:k+3000] for k in range(0, len(contents), 3000)]
+            write_bytes(fid, chunks, compress=compress)
+            blob = fid.getvalue()
+            assert bytes(decode_bytes(blob, compress=compress)) == contents
+            assert (len(blob) < len(contents)) == (contents is not noise
+                                                   and bool(compress))
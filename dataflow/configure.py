@@ -3,6 +3,8 @@ import copy
 
 from .core import load_instrument
 from .cache import get_cache
+from . import codec
+from .parallel import get_executor_manager, get_dataset_executor_manager
 from . import fetch
 from configurations import default
 
@@ -36,6 +38,20 @@ def load_config(name="config", fallback=True):
         else:
             raise
 
+def _configure_executor(executor_manager, executor_config):
+    """
+    Set up the worker pool for *executor_manager* from the config section.
+    """
+    if executor_config:
+        executor_engine = executor_config.get("engine", None)
+        executor_params = executor_config.get("params", {})
+        if executor_engine == "thread":
+            executor_manager.use_threads(**executor_params)
+        elif executor_engine == "process":
+            executor_manager.use_processes(**executor_params)
+        else:
+            executor_manager.use_serial()
+
 def apply_config(user_config=None, user_overrides=None):
     if user_config is not None:
         config = copy.deepcopy(user_config)
@@ -49,21 +65,44 @@ def apply_config(user_config=None, user_overrides=None):
     fetch.FILE_HELPERS = {
         source["name"]: source.get("file_helper_url", None)
         for source in fetch.DATA_SOURCES}
+    fetch.set_fetch_workers(config.get("fetch_workers", fetch.FETCH_WORKERS))
 
     cache_config = config.get('cache', False)
     if cache_config:
         cache_engine = cache_config.get("engine", None)
         cache_params = cache_config.get("params", {})
         cache_compression = cache_config.get("compression", False)
+        # zstd is optional, but don't quietly fall back to lz4 when it is
+        # asked for by name.
+        if ((cache_compression == "zstd"
+             or cache_config.get("zstd_dictionary", None))
+                and codec.zstandard is None):
+            raise ImportError(
+                "zstd cache compression requires the zstandard package;"
+                " install it with pip install reductus[zstd]")
         cache_manager = get_cache()
         if cache_engine == "diskcache":
             cache_manager.use_diskcache(**cache_params)
         elif cache_engine == "redis":
             cache_manager.use_redis(**cache_params)
         else:
-            cache_manager.use_memory()
+            cache_manager.use_memory(**cache_params)
 
         cache_manager._use_compression = cache_compression
+        cache_manager._zero_copy = cache_config.get("zero_copy", False)
+        cache_manager.use_partitions(cache_config.get("partitions", {}))
+        cache_manager.use_l1(cache_config.get("l1_size", 0))
+        cache_manager.use_write_behind(cache_config.get("write_behind", 0))
+        if "lease_time" in cache_config:
+            cache_manager._lease_time = cache_config["lease_time"]
+        if cache_config.get("zstd_dictionary", None):
+            with open(cache_config["zstd_dictionary"], "rb") as fid:
+                codec.load_dictionary(fid.read())
+
+    _configure_executor(get_executor_manager(),
+                        config.get('executor', False))
+    _configure_executor(get_dataset_executor_manager(),
+                        config.get('dataset_executor', False))
 
     # Load refl instrument if nothing specified in config.
     # Note: instrument names do not match instrument ids.
@@ -16,7 +16,7 @@ except ImportError: # CRUFT: pre-3.7 support
 
 from numpy import NaN, inf
 
-from .deps import processing_order
+from .deps import topological_order
 
 TEMPLATE_VERSION = '1.0'
 
@@ -377,56 +377,46 @@ class Template(object):
     def order(self, target=None):
         """
         Return the module ids in processing order.
+
+        If *target* is specified, only include modules required to
+        evaluate the target.
         """
-        if target is None:
-            # Order to evaluate all nodes
-            pairs = [(w['source'][0], w['target'][0]) for w in self.wires]
-            n = len(self.modules)
-        else:
-            pairs = []
-            n = 0
-            remaining = set([target])
-            processed = set()
-            while remaining:
-                target = remaining.pop()
-                sources = [w['source'][0] for w in self.inputs(target)]
-                pairs.extend((source, target) for source in sources)
-                processed.add(target)
-                remaining |= set(sources) - processed
-            if not pairs:  # No dependencies; calculate node only
-                return [target]
-        return processing_order(pairs, n)
+        return list(self._graph().order(target))
 
     def dependents(self, id):
         """
         Retrieve the list of nodes that depend on a particular node, including
         the node itself.
-
-        Note: Algorithm is O(n^2) or worse, so be prepared to rewrite if
-        performance is an issue.
         """
-        #print "wires", [(w['source'][0], w['target'][0]) for w in self.wires]
-        remaining = set([id])
+        children = self._graph().children
+        remaining = [id]
         processed = set([id])
         while remaining:
-            # pick an unprocessed node
             parent = remaining.pop()
-            # find which nodes depend on it
-            children = set(w['target'][0] for w in self.wires
-                           if w['source'][0] == parent)
-            # remember to process those that are not already listed
-            remaining |= children - processed
-            # list the new nodes as descendents
-            processed |= children
-            #print "deps",id,parent,children,remaining,processed
+            for child in children.get(parent, ()):
+                if child not in processed:
+                    processed.add(child)
+                    remaining.append(child)
         return processed
 
     def inputs(self, id):
         """
         Retrieve the data objects that go into the inputs of a module
         """
-        wires = [w for w in self.wires if w['target'][0] == id]
-        return wires
+        return list(self._graph().inputs.get(id, ()))
+
+    def _graph(self):
+        """
+        Return the wiring index for the template, building it on first use.
+
+        The index is rebuilt if modules or wires are added or removed.
+        Wires should not be rewired in place after the template is used.
+        """
+        key = (id(self.wires), len(self.wires), len(self.modules))
+        graph = self.__dict__.get('_graph_index', None)
+        if graph is None or graph.key != key:
+            graph = self._graph_index = _TemplateGraph(self, key)
+        return graph
 
     def ordered(self, target=None):
         """
@@ -455,7 +445,9 @@ class Template(object):
         return self.__getstate__()
 
     def __getstate__(self):
-        return self.__dict__
+        # Leave out the wiring index, which is rebuilt on demand.
+        return dict((k, v) for k, v in self.__dict__.items()
+                    if k != '_graph_index')
 
     def __setstate__(self, state):
         # As the template definition changes we need to increment the version
@@ -469,6 +461,49 @@ class Template(object):
         self.__dict__ = state
 
 
+class _TemplateGraph(object):
+    """
+    Adjacency index for the wires of a template.
+
+    *inputs* maps each node to the wires that feed it, *children* maps
+    each node to the nodes that it feeds, and *parents* maps each node to
+    the nodes that feed it.  Processing orders are memoized by target.
+    """
+    def __init__(self, template, key):
+        self.key = key
+        self.inputs = {}
+        self.children = {}
+        self.parents = {}
+        for w in template.wires:
+            source, target = w['source'][0], w['target'][0]
+            self.inputs.setdefault(target, []).append(w)
+            self.children.setdefault(source, []).append(target)
+            self.parents.setdefault(target, set()).add(source)
+        self.n = len(template.modules)
+        self._orders = {}
+
+    def order(self, target):
+        order = self._orders.get(target, None)
+        if order is None:
+            if target is None:
+                # Order to evaluate all nodes
+                if any(k >= self.n for k in self.children):
+                    raise ValueError("Not all dependencies are in the set")
+                nodes = range(self.n)
+            else:
+                nodes = set([target])
+                remaining = [target]
+                while remaining:
+                    node = remaining.pop()
+                    for source in self.parents.get(node, ()):
+                        if source not in nodes:
+                            nodes.add(source)
+                            remaining.append(source)
+            order = tuple(topological_order(nodes, self.children))
+            self._orders[target] = order
+        return order
+
+
 class Instrument(object):
     """
     An instrument is a set of modules and standard templates to be used
@@ -641,9 +676,19 @@ class DataType(object):
         return exporters
 
 class Bundle(object):
-    def __init__(self, datatype, values):
+    """
+    The list of datasets flowing over a wire, and their datatype.
+
+    *fingerprints*, if known, gives a unique fingerprint for each dataset,
+    which is used to cache element-wise calculations one dataset at a time.
+    """
+    fingerprints = None
+
+    def __init__(self, datatype, values, fingerprints=None):
         self.datatype = datatype
         self.values = values
+        if fingerprints is not None:
+            self.fingerprints = fingerprints
 
     def todict(self):
         values = [v.todict() for v in self.values]
@@ -5,6 +5,8 @@ Dependency calculator.
 """
 from __future__ import print_function
 
+import heapq
+
 def processing_order(pairs, n=0):
     """
     Order the work in a workflow.
@@ -31,47 +33,52 @@ def processing_order(pairs, n=0):
         Permutation which satisfies the partial order requirements.
 
     """
-    order = _dependencies(pairs)
+    children = {}
+    items = set()
+    for a, b in pairs:
+        children.setdefault(a, []).append(b)
+        items.add(a)
+        items.add(b)
     if n:
-        if any(id >= n for id in order):
+        if any(id >= n for id in items):
             raise ValueError("Not all dependencies are in the set")
-        rest = set(range(n)) - set(order)
-    else:
-        rest = set(k for p in pairs for k in p) - set(order)
-    #print "order",order,"from",pairs
-    return order + list(rest)
+        items = range(n)
+    return topological_order(items, children)
+
 
+def topological_order(items, children):
+    # type: (Iterable[int], Dict[int, List[int]]) -> List[int]
+    """
+    Order *items* so that each item comes before its *children*.
+
+    Uses Kahn's algorithm, which is linear in the number of items and
+    edges.  Edges to items which are not in *items* are ignored, so the
+    full adjacency of a graph can be used to order a subgraph.  Ties are
+    broken by taking the smallest ready item first, so the order is
+    reproducible.
 
-def _dependencies(pairs):
-    # type: (List[Tuple[int, int]]) -> List[int]
-    emptyset = set()
+    Raises ValueError if there are cyclic dependencies.
+    """
+    items = set(items)
+    indegree = dict((item, 0) for item in items)
+    for item in items:
+        for child in children.get(item, ()):
+            if child in indegree:
+                indegree[child] += 1
+    ready = [item for item, count in indegree.items() if count == 0]
+    heapq.heapify(ready)
     order = []  # type: List[int]
-    pairs = [(a, b) for a, b in pairs]
-    if not pairs:
-        return order
-
-    # Break pairs into left set and right set
-    left, right = (set(s) for s in zip(*pairs))
-    while pairs:
-        #print "within",pairs
-        # Find which items only occur on the right
-        independent = right - left
-        if independent == emptyset:
-            cycleset = ", ".join(str(s) for s in left)
-            raise ValueError("Cyclic dependencies amongst %s" % cycleset)
-
-        # The possibly resolvable items are those that depend on the independents
-        dependent = set(a for a, b in pairs if b in independent)
-        pairs = [(a, b) for a, b in pairs if b not in independent]
-        if not pairs:
-            resolved = dependent
-        else:
-            left, right = (set(s) for s in zip(*pairs))
-            resolved = dependent - left
-        #print "independent",independent,"dependent",dependent,"resolvable",resolved
-        order += resolved
-        #print("new order",order)
-    order.reverse()
+    while ready:
+        item = heapq.heappop(ready)
+        order.append(item)
+        for child in children.get(item, ()):
+            if child in indegree:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    heapq.heappush(ready, child)
+    if len(order) != len(items):
+        cycleset = ", ".join(str(s) for s in sorted(items - set(order)))
+        raise ValueError("Cyclic dependencies amongst %s" % cycleset)
     return order
 
 
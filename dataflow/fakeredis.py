@@ -2,23 +2,44 @@
 Redis-like interface to an in-memory cache
 
 :class:`MemoryCache` provides a minimal redis-like interface to an in memory
-cache.  If the *pylru* package is available, then this provides a least
-recently used cache, otherwise the cache grows without bound.
+cache.  The cache is bounded by the total size of the stored values, evicting
+entries as needed to stay within the limit.
 """
 from __future__ import print_function
 
 import os
+import sys
+import time
+import heapq
+import mmap
+import struct
+import shutil
+import hashlib
+import tempfile
+import itertools
 import threading
-import warnings
+from collections import OrderedDict
+try:
+    from urllib.parse import quote, unquote
+except ImportError: # CRUFT: python 2.7
+    from urllib import quote, unquote
 
-def lrucache(size):
-    try:
-        #raise ImportError("no pylru")
-        import pylru
-        return pylru.lrucache(size)
-    except ImportError:
-        warnings.warn("pylru not available; using simple cache with no size limit")
-        return {}
+# Default size limit for the memory cache in bytes
+MAX_BYTES = 2**30
+
+def _sizeof(value):
+    """
+    Size of a cached value.  Cached values are normally serialized strings,
+    or lists of strings for the *rpush* interface.
+    """
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    elif isinstance(value, memoryview):
+        return value.nbytes
+    elif isinstance(value, list):
+        return sum(_sizeof(v) for v in value)
+    else:
+        return sys.getsizeof(value)
 
 
 class MemoryCache(object):
@@ -27,122 +48,683 @@ class MemoryCache(object):
 
     Use this for running tests without having to start up the redis server.
 
-    *size* is the number of elements to cache (ignored if the pylru package
-    is not available).
+    *max_bytes* is the total size of the values to keep, with the size of
+    a value given by its length for strings, or the total length of the
+    items for lists.  *size*, if given, also limits the number of entries.
+
+    When the cache is full, entries are evicted using the *policy*, which
+    is "lru" to drop the least recently used entry, or "gdsf" (greedy dual
+    size frequency) to prefer dropping entries which are large and rarely
+    used, keeping more of the small entries in the cache.
     """
-    def __init__(self, size=1000):
-        self.cache = lrucache(size)
+    def __init__(self, size=None, max_bytes=MAX_BYTES, policy="lru"):
+        if policy not in ("lru", "gdsf"):
+            raise ValueError("unknown cache policy %r"%policy)
+        self.size = size
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.cache = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.lock = threading.RLock()
+        # greedy dual size frequency state
+        self._clock = 0.
+        self._freq = {}
+        self._priority = {}
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def info(self):
+        """Return the number of entries and memory used, like redis INFO"""
+        with self.lock:
+            return {
+                'keys': len(self.cache),
+                'used_memory': self.nbytes,
+                'maxmemory': self.max_bytes,
+                'maxmemory_policy': self.policy,
+                }
 
     def exists(self, key):
         return key in self.cache
 
     def keys(self):
-        return self.cache.keys()
+        with self.lock:
+            return list(self.cache.keys())
 
     def delete(self, *key):
-        for k in key:
-            del self.cache[k]
+        with self.lock:
+            for k in key:
+                if k not in self.cache:
+                    raise KeyError(k)
+                self._remove(k)
 
     def set(self, key, value):
-        self.cache[key] = value
+        """
+        Set *key* to *value*, evicting other entries to make room.
+
+        Values larger than *max_bytes* are not stored, since they would
+        evict everything else and then themselves.  Any old value for *key*
+        is still removed.
+        """
+        size = _sizeof(value)
+        with self.lock:
+            if key in self.cache:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self.cache[key] = value
+            self.sizes[key] = size
+            self.nbytes += size
+            self._touch(key)
+            self._evict()
 
     def get(self, key):
         """Note: doesn't provide default value for missing key like dict.get"""
-        return self.cache[key]
+        with self.lock:
+            value = self.cache[key]
+            self._touch(key)
+            return value
+
+    def mget(self, keys):
+        """Return the list of values for *keys*, with None for missing keys"""
+        with self.lock:
+            return [self.get(k) if k in self.cache else None for k in keys]
+
+    def add(self, key, value, expire=None):
+        """
+        Set *key* to *value* if it is not already set, returning True if the
+        key was set.  *expire* is ignored since entries only live as long as
+        the process.
+        """
+        with self.lock:
+            if key in self.cache:
+                return False
+            self.set(key, value)
+            return True
+
+    def discard(self, key, value):
+        """Delete *key* if it is set to *value*"""
+        with self.lock:
+            if key in self.cache and self.cache[key] == value:
+                self._remove(key)
 
     __delitem__ = delete
     __setitem__ = set
     __getitem__ = get
 
     def rpush(self, key, value):
-        if key not in self.cache:
-            self.cache[key] = [value]
-        else:
-            self.cache[key].append(value)
+        with self.lock:
+            if key not in self.cache:
+                self.set(key, [value])
+            else:
+                self.cache[key].append(value)
+                size = _sizeof(value)
+                self.sizes[key] += size
+                self.nbytes += size
+                self._touch(key)
+                self._evict()
 
     def lrange(self, key, low, high):
         """Note: returned range includes high index, not high-1 like lists"""
-        return self.cache[key][low:(high+1 if high != -1 else None)]
+        return self.get(key)[low:(high+1 if high != -1 else None)]
+
+    def _touch(self, key):
+        if self.policy == "lru":
+            self.cache.move_to_end(key)
+        else:
+            self._freq[key] = self._freq.get(key, 0) + 1
+            priority = self._clock + self._freq[key]/max(self.sizes[key], 1)
+            self._priority[key] = priority
+            heapq.heappush(self._heap, (priority, next(self._counter), key))
+            if len(self._heap) > 4*len(self.cache) + 64:
+                # Drop stale heap entries for keys which have been touched
+                # since they were pushed.
+                self._heap = [entry for entry in self._heap
+                              if self._priority.get(entry[2]) == entry[0]]
+                heapq.heapify(self._heap)
+
+    def _evict(self):
+        while self.cache and (self.nbytes > self.max_bytes
+                              or (self.size and len(self.cache) > self.size)):
+            if self.policy == "lru":
+                key = next(iter(self.cache))
+            else:
+                while True:
+                    priority, _, key = heapq.heappop(self._heap)
+                    if self._priority.get(key) == priority:
+                        break
+                # Age the remaining entries relative to new arrivals.
+                self._clock = priority
+            self._remove(key)
+
+    def _remove(self, key):
+        del self.cache[key]
+        self.nbytes -= self.sizes.pop(key)
+        self._freq.pop(key, None)
+        self._priority.pop(key, None)
+
+def map_file(fid):
+    """
+    Return a read only memory map of the open file *fid* as a memoryview.
+
+    The map stays valid after the file is closed.
+    """
+    if os.fstat(fid.fileno()).st_size == 0:
+        return memoryview(b"")
+    return memoryview(mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ))
+
 
 class FileBasedCache(object):
     """
     Disk-based cache with redis interface.
 
-    Use this for running tests without having to start up the redis server.
+    Use this for running tests without having to start up the redis server,
+    or for the raw file cache on machines without redis.
+
+    Entries are spread over 256 subdirectories of *cachedir* according to
+    the hash of the key, so that directories stay small as the cache grows.
+    Each entry is written to a temporary file which is then renamed into
+    place, so readers never see a partially written entry, even from other
+    processes.  Use :meth:`get_buffer` to read an entry through a memory
+    map rather than copying it into memory.
+
+    *max_bytes* is the total size of the entries to keep, and *size* is the
+    number of entries.  If the cache grows beyond either limit, the least
+    recently used entries are removed until it is back below *low_water*
+    of the limit.  Use None for no limit.  Other processes sharing the
+    directory are only noticed when the cache is scanned for eviction, so
+    the limits are approximate.  Entries created by :meth:`add`, such as
+    leases, are neither counted nor evicted, and are not listed by
+    :meth:`keys`.
+
+    Keys which are too long for a file name are stored under their hash,
+    with the key written to a companion file so that it can be listed.
+
+    Entries left by earlier versions, which stored each key directly in
+    *cachedir*, are moved into the subdirectories when the cache is opened.
     """
-    def __init__(self, size=1000, cachedir='~/.reductus/cache'):
+    def __init__(self, size=None, cachedir='~/.reductus/cache',
+                 max_bytes=None, low_water=0.8):
         self.size = size
+        self.max_bytes = max_bytes
+        self.low_water = low_water
         self.lock = threading.Lock()
         self.cachedir = os.path.expanduser(cachedir)
         if not os.path.exists(self.cachedir):
-            os.mkdir(self.cachedir)
+            os.makedirs(self.cachedir)
+        self.nbytes = self.nkeys = 0
+        self._migrate()
+        if size is not None or max_bytes is not None:
+            entries = list(self._scan())
+            self.nbytes = sum(entry[1] for entry in entries)
+            self.nkeys = len(entries)
+
+    def _path(self, key, prefix=""):
+        """
+        Return the path to the file for *key*.  List entries use the prefix
+        "+" and entries created by :meth:`add` use "!".  Long keys are
+        replaced by "=" and the hash of the key.  None of these characters
+        are produced by quoting the key.
+        """
+        name = key if isinstance(key, bytes) else str(key).encode('utf-8')
+        digest = hashlib.sha1(name).hexdigest()
+        filename = quote(name, safe='')
+        if len(filename) > MAX_NAME:
+            filename = "=" + digest
+        return os.path.join(self.cachedir, digest[:2], prefix + filename)
+
+    def _migrate(self):
+        """
+        Move the entries stored directly in *cachedir* by earlier versions
+        into the subdirectories.  Old lists, which are directories of
+        numbered files, are stored again as lists.  Entries which have
+        since been replaced are dropped.
+        """
+        for entry in os.scandir(self.cachedir):
+            if len(entry.name) == 2 and entry.is_dir():
+                continue
+            key = entry.name
+            try:
+                if entry.is_dir():
+                    items = os.listdir(entry.path)
+                    if not all(item.isdigit() for item in items):
+                        # Not an old list, so leave it alone.
+                        continue
+                    if self._find(key) is None:
+                        for item in sorted(items, key=int):
+                            item_path = os.path.join(entry.path, item)
+                            with open(item_path, "rb") as fid:
+                                self.rpush(key, fid.read())
+                    shutil.rmtree(entry.path)
+                elif self._find(key) is None:
+                    path = self._path(key)
+                    _makedirs(os.path.dirname(path))
+                    os.replace(entry.path, path)
+                    self._save_key(path, key)
+                else:
+                    os.remove(entry.path)
+            except (IOError, OSError):
+                # Another process is moving the same entry.
+                pass
+
+    def _find(self, key):
+        """Return the path to the data, list or add file for *key*, or None"""
+        for prefix in ("", "+", "!"):
+            path = self._path(key, prefix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _scan(self):
+        """
+        Yield *(path, size, mtime)* for every entry in the cache, except for
+        those created by :meth:`add`.
+        """
+        for shard in os.listdir(self.cachedir):
+            shard_dir = os.path.join(self.cachedir, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_dir):
+                continue
+            for entry in os.scandir(shard_dir):
+                if entry.name.startswith(("#", "!", "~")):
+                    continue
+                try:
+                    info = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, info.st_size, info.st_mtime
 
     def exists(self, key):
-        return os.path.exists(os.path.join(self.cachedir, key))
+        return self._find(key) is not None
 
     def keys(self):
-        return os.listdir(self.cachedir)
+        keys = []
+        for path, _, _ in self._scan():
+            name = os.path.basename(path).lstrip("+")
+            if not name.startswith("="):
+                keys.append(unquote(name))
+                continue
+            try:
+                with open(_key_path(path), "rb") as fid:
+                    keys.append(fid.read().decode('utf-8'))
+            except (IOError, OSError):
+                # The entry is being written or removed.
+                pass
+        return keys
 
     def delete(self, *key):
         for k in key:
-            kp = os.path.join(self.cachedir, k)
-            if os.path.isdir(kp):
-                for f in os.listdir(kp):
-                    os.remove(os.path.join(kp, f))
-                os.rmdir(kp)
-            else:
-                os.remove(kp)
+            path = self._find(k)
+            if path is not None:
+                self._remove(path)
 
     def set(self, key, value):
-        #open(os.path.join(self.cachedir, key), "wb").write(pickle.dumps(value))
-        with self.lock:
-            open(os.path.join(self.cachedir, key), "wb").write(value)
+        """
+        Set *key* to *value*.  *value* may be a function *write(fid)* which
+        writes the value to the open cache file, so that large values can
+        be streamed into the cache without holding them in memory.
+        """
+        path = self._path(key)
+        self._write(path, value)
+        # A plain value replaces a list with the same key.
+        list_path = self._path(key, "+")
+        if os.path.exists(list_path):
+            self._remove(list_path)
+        self._save_key(path, key)
 
     def get(self, key):
         """Note: doesn't provide default value for missing key like dict.get"""
+        return bytes(self.get_buffer(key))
+
+    def get_buffer(self, key):
+        """
+        Return a read only buffer with the value for *key*.
+
+        The buffer is a memory map of the cache file, so it is not read
+        into memory until it is used.  The map stays valid if the entry
+        is replaced or deleted while it is in use.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fid:
+                view = map_file(fid)
+        except (IOError, OSError):
+            return self._get_added(key)
+        self._touch(path)
+        return view
+
+    def _get_added(self, key):
         try:
-            #ret = pickle.loads(open(os.path.join(self.cachedir, key), "rb").read())
-            ret = open(os.path.join(self.cachedir, key), "rb").read()
-        except IOError:
+            with open(self._path(key, "!"), "rb") as fid:
+                return memoryview(fid.read())
+        except (IOError, OSError):
             raise KeyError(key)
+
+    def mget(self, keys):
+        """Return the list of values for *keys*, with None for missing keys"""
+        ret = []
+        for key in keys:
+            try:
+                ret.append(self.get(key))
+            except KeyError:
+                ret.append(None)
         return ret
 
+    def add(self, key, value, expire=None):
+        """
+        Set *key* to *value* if it is not already set, returning True if the
+        key was set.  The file is created exclusively, so this is safe
+        between processes.  Entries older than *expire* seconds are
+        replaced.
+
+        These entries are used as locks, so they are not evicted.  They
+        should be removed with :meth:`discard` or :meth:`delete`.
+        """
+        path = self._path(key, "!")
+        _makedirs(os.path.dirname(path))
+        self._save_key(path, key)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_WRONLY|os.O_CREAT|os.O_EXCL)
+            except OSError:
+                # Remove an expired entry and try again.
+                try:
+                    age = time.time() - os.path.getmtime(path)
+                    if expire is None or age < expire:
+                        return False
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            with os.fdopen(fd, "wb") as fid:
+                fid.write(_as_bytes(value))
+            return True
+        return False
+
+    def discard(self, key, value):
+        """Delete *key* if it is set to *value*"""
+        with self.lock:
+            try:
+                if bytes(self._get_added(key)) == _as_bytes(value):
+                    self._unlink(self._path(key, "!"))
+            except (KeyError, OSError):
+                pass
+
     __delitem__ = delete
     __setitem__ = set
     __getitem__ = get
     __contains__ = exists
 
     def rpush(self, key, value):
+        """
+        Append *value* to the list at *key*.
+
+        Lists are stored as a sequence of length-prefixed records in a
+        single file which is opened for append, so adding to a list takes
+        the same time no matter how long it is.
+        """
+        path = self._path(key, "+")
+        if os.path.exists(self._path(key)):
+            raise KeyError(key)
+        _makedirs(os.path.dirname(path))
+        self._save_key(path, key)
+        value = _as_bytes(value)
+        record = _RECORD.pack(len(value)) + value
         with self.lock:
-            keydir = os.path.join(self.cachedir, key)
-            if not os.path.isdir(keydir):
-                if os.path.exists(keydir):
-                    raise KeyError(key)
-                os.mkdir(keydir)
-                new_filenum = 0
-            else:
-                filenums = map(int, os.listdir(keydir))
-                if len(filenums) == 0:
-                    new_filenum = 0
-                else:
-                    new_filenum = max(filenums) + 1
-            open(os.path.join(keydir, str(new_filenum)), "wb").write(value)
+            new = not os.path.exists(path)
+            with open(path, "ab") as fid:
+                fid.write(record)
+            self._added(len(record), new)
 
     def lrange(self, key, low, high):
         """Note: returned range includes high index, not high-1 like lists"""
-        keydir = os.path.join(self.cachedir, key)
-        if not os.path.isdir(keydir):
+        path = self._path(key, "+")
+        try:
+            with open(path, "rb") as fid:
+                data = fid.read()
+        except (IOError, OSError):
             raise KeyError(key)
+        items = []
+        offset = 0
+        while offset + _RECORD.size <= len(data):
+            length, = _RECORD.unpack_from(data, offset)
+            offset += _RECORD.size
+            items.append(data[offset:offset+length])
+            offset += length
+        return items[low:(high+1 if high != -1 else None)]
+
+    def _write(self, path, value):
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix="#")
+        try:
+            with os.fdopen(fd, "wb") as fid:
+                if callable(value):
+                    value(fid)
+                else:
+                    fid.write(value)
+                nbytes = fid.tell()
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = None
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
         with self.lock:
-            filenums = sorted(map(int, os.listdir(keydir)))
-            lookups = filenums[low:(high+1 if high != -1 else None)]
-            return [open(os.path.join(keydir, str(n)), "rb").read() for n in lookups]
+            if old_size is not None:
+                self.nbytes -= old_size
+            self._added(nbytes, old_size is None)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            self._unlink(path)
+        except OSError:
+            return
+        if os.path.basename(path).startswith("!"):
+            # Entries from add() are not counted.
+            return
+        with self.lock:
+            self.nbytes -= size
+            self.nkeys -= 1
+
+    def _unlink(self, path):
+        os.remove(path)
+        if os.path.basename(path).lstrip("+!").startswith("="):
+            try:
+                os.remove(_key_path(path))
+            except OSError:
+                pass
+
+    def _save_key(self, path, key):
+        """
+        Write the key for an entry stored under the hash of the key.
+        """
+        if not os.path.basename(path).lstrip("+!").startswith("="):
+            return
+        key_path = _key_path(path)
+        if os.path.exists(key_path):
+            return
+        _makedirs(os.path.dirname(key_path))
+        name = key if isinstance(key, bytes) else str(key).encode('utf-8')
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(key_path), prefix="#")
+        with os.fdopen(fd, "wb") as fid:
+            fid.write(name)
+        os.replace(tmp, key_path)
+
+    def _touch(self, path):
+        # Track use with the modification time, since access times are
+        # often turned off.  Only needed for eviction.
+        if self.size is not None or self.max_bytes is not None:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+
+    def _added(self, nbytes, new):
+        # Called with the lock held.
+        self.nbytes += nbytes
+        self.nkeys += 1 if new else 0
+        if ((self.max_bytes is not None and self.nbytes > self.max_bytes)
+                or (self.size is not None and self.nkeys > self.size)):
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held.  Rescan the cache to pick up the
+        # entries written by other processes, then remove the oldest
+        # entries until the cache is below the low water mark.
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        nbytes = sum(entry[1] for entry in entries)
+        nkeys = len(entries)
+        max_bytes = (self.max_bytes*self.low_water
+                     if self.max_bytes is not None else None)
+        max_keys = self.size*self.low_water if self.size is not None else None
+        for path, size, _ in entries:
+            if ((max_bytes is None or nbytes <= max_bytes)
+                    and (max_keys is None or nkeys <= max_keys)):
+                break
+            try:
+                self._unlink(path)
+            except OSError:
+                # Files in use can't be removed on windows.
+                continue
+            nbytes -= size
+            nkeys -= 1
+        self.nbytes, self.nkeys = nbytes, nkeys
 
     def __repr__(self):
         return "<%s.%s %s>" % (
             self.__class__.__module__, self.__class__.__name__, self.cachedir)
 
 
+_RECORD = struct.Struct("<Q")
+
+# Longest file name for an entry.  Most file systems allow 255 bytes, which
+# leaves room for the prefixes.
+MAX_NAME = 200
+
+def _key_path(path):
+    """Return the path to the file holding the key for a hashed entry"""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "~" + name.lstrip("+!"))
+
+def _as_bytes(value):
+    return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another process may have created it.
+            if not os.path.isdir(path):
+                raise
+
+
+def test_memory_cache():
+    for policy in ("lru", "gdsf"):
+        cache = MemoryCache(max_bytes=1000, policy=policy)
+        cache.set("small", b"s"*10)
+        cache.set("big", b"b"*600)
+        cache.get("small")
+        cache.set("new", b"n"*300)
+        assert cache.info()["used_memory"] == 910
+        cache.set("bigger", b"B"*600)
+        # The small entry is recently used and cheap to keep.
+        assert cache.exists("small") and not cache.exists("big")
+        assert cache.nbytes <= 1000
+        assert cache.mget(["small", "big"]) == [b"s"*10, None]
+        cache.rpush("list", b"x"*100)
+        cache.rpush("list", b"y"*100)
+        assert cache.lrange("list", 0, -1) == [b"x"*100, b"y"*100]
+        assert cache.nbytes <= 1000
+        cache.delete("small")
+        assert not cache.exists("small")
+    # Entries which are too big for the cache are not kept, and don't
+    # evict the entries already there.
+    cache = MemoryCache(max_bytes=100)
+    cache.set("a", b"a"*40)
+    cache.set("b", b"b"*40)
+    cache.set("huge", b"h"*200)
+    assert cache.keys() == ["a", "b"] and cache.nbytes == 80
+    cache.set("a", b"h"*200)
+    assert cache.keys() == ["b"] and cache.nbytes == 40
+    # The number of entries can be limited as well.
+    cache = MemoryCache(size=2)
+    for k in range(3):
+        cache.set(k, b"v")
+    assert cache.keys() == [1, 2]
+
+def test_file_cache():
+    cachedir = tempfile.mkdtemp()
+    try:
+        # Entries from the old flat layout are moved when opened.
+        with open(os.path.join(cachedir, "old"), "wb") as fid:
+            fid.write(b"old value")
+        os.mkdir(os.path.join(cachedir, "oldlist"))
+        for k, item in enumerate((b"1", b"2")):
+            with open(os.path.join(cachedir, "oldlist", str(k)), "wb") as fid:
+                fid.write(item)
+        cache = FileBasedCache(cachedir=cachedir)
+        assert cache.get("old") == b"old value"
+        assert cache.lrange("oldlist", 0, -1) == [b"1", b"2"]
+        assert sorted(os.path.basename(p) for p, _, _ in cache._scan()) == [
+            "+oldlist", "old"]
+        assert all(len(name) == 2 for name in os.listdir(cachedir))
+        cache.delete("old", "oldlist")
+        cache = FileBasedCache(cachedir=cachedir, max_bytes=1000)
+        cache.set("a/b:c", b"x"*300)
+        assert cache.get("a/b:c") == b"x"*300
+        assert bytes(cache.get_buffer("a/b:c")[:3]) == b"xxx"
+        assert cache.keys() == ["a/b:c"]
+        assert cache.mget(["a/b:c", "missing"]) == [b"x"*300, None]
+        # Entries are replaced whole.
+        cache.set("a/b:c", b"y"*200)
+        assert cache.get("a/b:c") == b"y"*200 and cache.nbytes == 200
+        # Lists can be appended one item at a time.
+        cache.rpush("list", b"1")
+        cache.rpush("list", b"22")
+        assert cache.lrange("list", 0, -1) == [b"1", b"22"]
+        assert cache.lrange("list", 1, 1) == [b"22"]
+        assert sorted(cache.keys()) == ["a/b:c", "list"]
+        # Least recently used entries are removed when the cache is full.
+        os.utime(cache._path("a/b:c"), (0, 0))
+        cache.set("d", b"d"*500)
+        cache.set("e", b"e"*400)
+        assert not cache.exists("a/b:c") and cache.exists("e")
+        assert cache.nbytes <= 1000
+        cache.delete("list", "missing")
+        assert not cache.exists("list")
+        # Leases are created exclusively.
+        assert cache.add("lease", "token") and not cache.add("lease", "other")
+        cache.discard("lease", "token")
+        assert not cache.exists("lease")
+        # Leases are not counted, and survive eviction.
+        nbytes = cache.nbytes
+        assert cache.add("lease", "token") and cache.nbytes == nbytes
+        os.utime(cache._path("lease", "!"), (0, 0))
+        cache.set("f", b"f"*900)
+        assert cache.exists("lease") and cache.get("lease") == b"token"
+        assert "lease" not in cache.keys()
+        # Keys too long for a file name are stored under their hash.
+        long_key = "http://example.com/" + "x/"*300
+        cache.set(long_key, b"long")
+        cache.rpush(long_key + "+", b"1")
+        assert cache.get(long_key) == b"long"
+        assert {long_key, long_key + "+"} <= set(cache.keys())
+        cache.delete(long_key)
+        assert not cache.exists(long_key) and long_key not in cache.keys()
+    finally:
+        import shutil
+        shutil.rmtree(cachedir)
+
 def demo():
     class Expensive(object):
         def __del__(self):
@@ -44,14 +44,19 @@ import datetime
 import time
 from posixpath import basename, join, sep
 import os
+import sys
 import hashlib
+import io
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 import urllib
 
 import pytz
 
-from .calc import _format_ordered, generate_fingerprint
+from .calc import _format_ordered, _Ordered, generate_fingerprint, tag_source
 from .cache import get_cache
 from .doi_resolve import get_target
 from .lib.iso8601 import seconds_since_epoch
@@ -63,7 +68,31 @@ DATA_SOURCES = []
 FILE_HELPERS = []
 DEFAULT_DATA_SOURCE = "ncnr"
 
-SESSION = requests.Session()
+# Number of files fetched at once by url_get_many, which is also the number
+# of connections kept open to each server.
+FETCH_WORKERS = 8
+
+# Size of the pieces of a download written to the file cache at a time.
+CHUNK_SIZE = 2**20
+
+def _make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+SESSION = _make_session(FETCH_WORKERS)
+
+def set_fetch_workers(workers):
+    """
+    Set the number of files fetched at once by :func:`url_get_many`, and
+    size the connection pool to match.
+    """
+    global FETCH_WORKERS, SESSION
+    if workers != FETCH_WORKERS:
+        FETCH_WORKERS = workers
+        SESSION = _make_session(workers)
 
 def check_datasource(source):
     datasource = next((x for x in DATA_SOURCES if x['name'] == source), {})
@@ -81,59 +110,314 @@ def check_datasource(source):
     return source_url
 
 
+def _fileinfo_fingerprint(fileinfo):
+    # fingerprint the get, leaving off entries information:
+    fileinfo_minimal = {'path': fileinfo['path'],
+                        'mtime': fileinfo.get('mtime', None)}
+    config_str = str(_format_ordered(fileinfo_minimal))
+    return generate_fingerprint(("url_get", config_str))
+
+
+def url_get_many(fileinfos, mtime_check=True, workers=None):
+    """
+    Fetch the contents of each file in *fileinfos*, returning the list of
+    contents in the same order.
+
+    Files are fetched with :func:`url_get`, so files already in the cache
+    are not fetched again, and fetched files are added to the cache.  Up
+    to *workers* files are fetched at once, defaulting to *FETCH_WORKERS*.
+    Files listed more than once are only fetched once.  If any fetch
+    fails, the first error is raised once the others have finished.
+    """
+    fileinfos = list(fileinfos)
+    distinct = {}
+    for fileinfo in fileinfos:
+        distinct.setdefault(_fileinfo_fingerprint(fileinfo), fileinfo)
+    workers = min(workers or FETCH_WORKERS, len(distinct))
+    if workers <= 1:
+        contents = dict((fp, url_get(fileinfo, mtime_check=mtime_check))
+                        for fp, fileinfo in distinct.items())
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = dict(
+                (fp, pool.submit(url_get, fileinfo, mtime_check=mtime_check))
+                for fp, fileinfo in distinct.items())
+            contents = dict((fp, future.result())
+                            for fp, future in futures.items())
+    return [contents[_fileinfo_fingerprint(fileinfo)] for fileinfo in fileinfos]
+
+
+def url_parse_many(fileinfos, parser, mtime_check=True, with_entries=False,
+                   version=None, **kwargs):
+    """
+    Return *parser(name, fid, \\*\\*kwargs)* for each file in *fileinfos*,
+    where *name* is the file name and *fid* is a file object with the
+    contents.  If *with_entries* is True, the entries listed in the
+    fileinfo are passed to the parser as *entries*.
+
+    Parsed results are kept in the cache, keyed by the file fingerprint,
+    the parser, the source of the package defining the parser, the entries
+    and *kwargs*, so any template loading the same files skips both the
+    download and the parsing.  Use *version* to invalidate the parsed
+    results when code outside the parser package changes what it returns.
+    Files requested without an mtime are revalidated with the server
+    first, and local files are parsed each time.
+
+    Parsed datasets are tagged with their source using
+    :func:`dataflow.calc.tag_source`.  Parsed results retrieved from the
+    cache are shared with other loaders
+    when the in-process cache is enabled, so they must not be modified.
+    """
+    cache = get_cache()
+    fileinfos = list(fileinfos)
+    local = [fileinfo.get("source", DEFAULT_DATA_SOURCE) == 'local'
+             for fileinfo in fileinfos]
+    contents = [None]*len(fileinfos)
+    # Files without an mtime may have changed, so check them first.
+    revalidate = [k for k, fileinfo in enumerate(fileinfos)
+                  if fileinfo.get('mtime', None) is None and not local[k]]
+    fetched = url_get_many([fileinfos[k] for k in revalidate],
+                           mtime_check=mtime_check)
+    for k, content in zip(revalidate, fetched):
+        contents[k] = content
+
+    keys = [None if local[k] else _parse_key(fileinfo, parser, version,
+                                             with_entries, kwargs)
+            for k, fileinfo in enumerate(fileinfos)]
+    cached = [k for k, key in enumerate(keys) if key is not None]
+    results = [None]*len(fileinfos)
+    for k, value in zip(cached, cache.retrieve_many(keys[k] for k in cached)):
+        results[k] = value
+
+    missing = [k for k, value in enumerate(results) if value is None]
+    download = [k for k in missing if contents[k] is None]
+    for k, content in zip(download, url_get_many(
+            [fileinfos[k] for k in download], mtime_check=mtime_check)):
+        contents[k] = content
+    for k in missing:
+        fileinfo = fileinfos[k]
+        args = dict(kwargs)
+        if with_entries:
+            args['entries'] = fileinfo.get('entries', None)
+        with open_content(contents[k]) as fid:
+            results[k] = parser(basename(fileinfo['path']), fid, **args)
+        if keys[k] is not None:
+            # Identify the parsed datasets so that later steps only need
+            # to compute the datasets from new files.
+            if isinstance(results[k], list):
+                tag_source(results[k], keys[k])
+            tags = {'kind': 'parsed', 'loader': _parser_id(parser)}
+            cache.store(keys[k], results[k], tags=tags)
+    return results
+
+
+def _parse_key(fileinfo, parser, version, with_entries, kwargs):
+    """
+    Return the cache key for the results of *parser* on *fileinfo*.
+
+    The key starts with the parser id, as in
+    "reflred.candor.load_entries:<sha1>", so that the cache can place the
+    parsed entries in the partition for the instrument.
+    """
+    fp = _fileinfo_fingerprint(fileinfo)
+    validators = (get_cache().file_validators(fp)
+                  if fileinfo.get('mtime', None) is None else None)
+    entries = fileinfo.get('entries', None) if with_entries else None
+    return _parser_id(parser) + ":" + generate_fingerprint((
+        "url_parse", fp, _parser_id(parser),
+        _package_version(parser.__module__), str(version),
+        _Ordered(entries), _Ordered(kwargs), _Ordered(validators)))
+
+
+def _parser_id(parser):
+    return "%s.%s"%(parser.__module__, parser.__qualname__)
+
+
+@lru_cache(maxsize=64)
+def _package_version(module_name):
+    """
+    Return a hash of the source of the package defining a parser.
+
+    The parser often calls readers elsewhere in its package, such as the
+    loader module for an instrument, so any change to the package source
+    (including the version of a loader step) invalidates parsed results.
+    """
+    package = sys.modules[module_name.split('.')[0]]
+    paths = getattr(package, '__path__', None)
+    if paths is None:
+        files = [package.__file__]
+    else:
+        files = sorted(os.path.join(root, name)
+                       for path in paths
+                       for root, _, names in os.walk(path)
+                       for name in names if name.endswith('.py'))
+    digest = hashlib.sha1()
+    for filename in files:
+        with open(filename, 'rb') as fid:
+            digest.update(fid.read())
+    return digest.hexdigest()
+
+
+def open_content(content):
+    """
+    Return a read only file object for the file *content* returned from
+    :func:`url_get`.
+
+    Unlike *BytesIO*, the contents are not copied, so a file memory mapped
+    from the cache is only read from disk as the loader needs it.
+    """
+    return _ContentFile(content)
+
+
+class _ContentFile(io.RawIOBase):
+    def __init__(self, content):
+        self._view = memoryview(content).cast("B")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        start = min(self._pos, len(self._view))
+        end = min(start + len(buffer), len(self._view))
+        buffer[:end-start] = self._view[start:end]
+        self._pos = end
+        return end - start
+
+    def readall(self):
+        start = min(self._pos, len(self._view))
+        self._pos = len(self._view)
+        return self._view[start:].tobytes()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("negative seek position %d"%offset)
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view.release()
+        super(_ContentFile, self).close()
+
+
 def url_get(fileinfo, mtime_check=True):
+    """
+    Return the contents of the file described by *fileinfo*.
+
+    Files from remote sources are kept in the file cache.  If *mtime_check*
+    is True and *fileinfo* gives an mtime, then the last-modified header
+    must match the mtime.  The headers are checked before the body is
+    read, so a mismatched file is not downloaded.
+
+    Files requested without an mtime may change on the server, so the
+    cached copy is revalidated using the ETag and Last-Modified headers
+    stored with it.  If the server responds 304 Not Modified, then the
+    cached copy is returned without downloading the file again.
+    """
     path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-    # fingerprint the get, leaving off entries information:
     cache = get_cache()
-    fileinfo_minimal = {'path': path, 'mtime': mtime}
-    config_str = str(_format_ordered(fileinfo_minimal))
-    fp = generate_fingerprint(("url_get", config_str))
+    fp = _fileinfo_fingerprint(fileinfo)
+    source = fileinfo.get("source", DEFAULT_DATA_SOURCE)
+    isLocal = (source == 'local')
+    validators = None
     if cache.file_exists(fp):
-        ret = cache.retrieve_file(fp)
-        print("getting " + path + " from cache!")
-    else:
-        source = fileinfo.get("source", DEFAULT_DATA_SOURCE)
-        name = basename(path)
-        isLocal = (source == 'local')
-        #    path = urllib.request.pathname2url(os.path.abspath(path))
-        source_url = check_datasource(source)
-        full_url = join(source_url, urllib.parse.quote(path.strip(sep), safe='/:'))
-        print("loading", full_url, name)
-        req = None  # Need placeholder for req in case SESSION.get fails.
-        try:
-            if isLocal:
-                t_repo = datetime.datetime.fromtimestamp(int(os.stat(path).st_mtime), pytz.utc)
-            else:
-                req = SESSION.get(full_url)
-                req.raise_for_status()
-                url_mtime = req.headers.get('last-modified', None)
-                url_time_struct = time.strptime(url_mtime, '%a, %d %b %Y %H:%M:%S %Z')
-                t_repo = datetime.datetime(*url_time_struct[:6], tzinfo=pytz.utc)
-
-            # Check timestamp if requested and if timestamp is provided
-            if mtime_check and mtime is not None:
-                t_request = datetime.datetime.fromtimestamp(mtime, pytz.utc)
-                if t_request != t_repo:
-                    print("request mtime = %s, repo mtime = %s"%(t_request, t_repo))
-                    compare = "older" if t_request < t_repo else "newer"
-                    raise ValueError("Requested mtime is %s than repository mtime for %r"
-                                     % (compare, path))
-
-            if isLocal:
-                with open(path, 'rb') as localfile:
-                    ret = localfile.read()
-                # no caching for local files.
-            else:
-                ret = req.content
-                print("caching " + path)
-                cache.store_file(fp, ret)
-
-        except requests.HTTPError as exc:
-            raise ValueError("Could not open %r\n%s"%(path, str(exc)))
-        except FileNotFoundError as exc:
-            raise ValueError("Could not find %r\n%s"%(path, str(exc)))
-        finally:
-            if req is not None:
-                req.close()
+        if mtime is None and not isLocal:
+            validators = cache.file_validators(fp)
+        if not validators:
+            print("getting " + path + " from cache!")
+            return cache.retrieve_file(fp)
+
+    name = basename(path)
+    #    path = urllib.request.pathname2url(os.path.abspath(path))
+    source_url = check_datasource(source)
+    full_url = join(source_url, urllib.parse.quote(path.strip(sep), safe='/:'))
+    print("loading", full_url, name)
+    req = None  # Need placeholder for req in case SESSION.get fails.
+    try:
+        if isLocal:
+            t_repo = datetime.datetime.fromtimestamp(int(os.stat(path).st_mtime), pytz.utc)
+        else:
+            # Only the headers are read until the body is requested.
+            req = SESSION.get(full_url, stream=True,
+                              headers=_conditional_headers(validators))
+            if req.status_code == 304:
+                print("getting " + path + " from cache (not modified)")
+                return cache.retrieve_file(fp)
+            req.raise_for_status()
+            t_repo = _last_modified(req.headers)
+
+        # Check timestamp if requested and if timestamp is provided
+        if mtime_check and mtime is not None:
+            t_request = datetime.datetime.fromtimestamp(mtime, pytz.utc)
+            if t_repo is None:
+                raise ValueError("No last-modified time to check for %r" % path)
+            if t_request != t_repo:
+                print("request mtime = %s, repo mtime = %s"%(t_request, t_repo))
+                compare = "older" if t_request < t_repo else "newer"
+                raise ValueError("Requested mtime is %s than repository mtime for %r"
+                                 % (compare, path))
+
+        if isLocal:
+            with open(path, 'rb') as localfile:
+                ret = localfile.read()
+            # no caching for local files.
+        else:
+            # Write the body to the cache as it arrives rather than reading
+            # it into memory, then use the cache file as the contents.
+            print("caching " + path)
+            ret = cache.store_file_stream(
+                fp, req.iter_content(CHUNK_SIZE),
+                validators=_validators(req.headers))
+
+    except requests.HTTPError as exc:
+        raise ValueError("Could not open %r\n%s"%(path, str(exc)))
+    except FileNotFoundError as exc:
+        raise ValueError("Could not find %r\n%s"%(path, str(exc)))
+    finally:
+        if req is not None:
+            req.close()
 
     return ret
+
+
+def _last_modified(headers):
+    """
+    Return the last-modified time in *headers* as a UTC datetime, or None
+    if there is no last-modified header.
+    """
+    url_mtime = headers.get('last-modified', None)
+    if url_mtime is None:
+        return None
+    url_time_struct = time.strptime(url_mtime, '%a, %d %b %Y %H:%M:%S %Z')
+    return datetime.datetime(*url_time_struct[:6], tzinfo=pytz.utc)
+
+
+def _validators(headers):
+    """
+    Return the ETag and Last-Modified headers for revalidating the file.
+    """
+    return dict((key, headers[key]) for key in ('etag', 'last-modified')
+                if headers.get(key, None) is not None)
+
+
+def _conditional_headers(validators):
+    """
+    Return the request headers for revalidating a file with *validators*.
+    """
+    headers = {}
+    if validators:
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last-modified' in validators:
+            headers['If-Modified-Since'] = validators['last-modified']
+    return headers
@@ -1,40 +1,136 @@
-import io
 import os
+import shutil
+import tempfile
 from zipfile import ZipFile, is_zipfile
 
 import h5py
 
 from . import hzf_readonly_stripped as hzf
 
+ZIP_MAGIC = b"PK\x03\x04"
+# Size of the pieces copied when unpacking a zipped hdf5 file.
+CHUNK_SIZE = 2**20
+
 def h5_open_zip(filename, file_obj=None, **kw):
     """
     Open a NeXus file, even if it is in a zip file,
     or if it is a NeXus-zip file.
 
-    If the filename ends in '.zip', it will be unzipped to a temporary
-    directory before opening and deleted on :func:`closezip`.  If opened
-    for writing, then the file will be created in a temporary directory,
-    then zipped and deleted on :func:`closezip`.
+    If the file is a zip file containing a single hdf5 file, the member
+    is unpacked into an anonymous temporary file, which is closed and
+    removed when the returned hdf5 file is closed.
+
+    If the zip file contains '.attrs', it is assumed to be a NeXus-zip
+    file and is opened with that library.
 
-    If it is a zipfile but doesn't end in '.zip', it is assumed
-    to be a NeXus-zip file and is opened with that library.
+    Zip files are recognized from their first bytes, falling back to
+    :func:`zipfile.is_zipfile` for archives which don't start with a
+    member, such as those with a prepended stub.  Files on disk are
+    opened by h5py directly, and *file_obj* is passed to h5py as is, so
+    the file is read as needed rather than copied into memory.
 
     Arguments are the same as for :func:`open`.
     """
     if file_obj is None:
-        file_obj = io.BytesIO(open(filename, mode='rb', buffering=-1).read())
-    is_zip = is_zipfile(file_obj) # is_zipfile(file_obj) doens't work in py2.6
-    if is_zip and '.attrs' in ZipFile(file_obj).namelist():
-        # then it's a nexus-zip file, rather than
-        # a zipped hdf5 nexus file
-        f = hzf.File(filename, file_obj)
+        with open(filename, mode='rb') as fid:
+            is_zip = _is_zip(fid)
+        if not is_zip:
+            return h5py.File(filename, **kw)
+        # The zip file opens the file itself, and closes it with the zip.
+        zf = ZipFile(filename)
     else:
-        if is_zip:
-            zf = ZipFile(file_obj)
-            members = zf.namelist()
-            assert len(members) == 1
-            file_obj = io.BytesIO(zf.read(members[0]))
-            filename = members[0]
-
-        f = h5py.File(file_obj, **kw)
-    return f
+        is_zip = _is_zip(file_obj)
+        if not is_zip:
+            return h5py.File(file_obj, **kw)
+        zf = ZipFile(file_obj)
+
+    if '.attrs' in zf.namelist():
+        # then it's a nexus-zip file, rather than
+        # a zipped hdf5 nexus file, which reads from the open zip file
+        return hzf.File(filename, zf)
+    with zf:
+        tmp = _unpack(zf)
+    try:
+        return _UnpackedFile(tmp, **kw)
+    except Exception:
+        tmp.close()
+        raise
+
+def _is_zip(fid):
+    """
+    Return True if the open file *fid* is a zip file, leaving the file
+    position unchanged.
+    """
+    start = fid.tell()
+    try:
+        if fid.read(len(ZIP_MAGIC)) == ZIP_MAGIC:
+            return True
+        return is_zipfile(fid)
+    finally:
+        fid.seek(start)
+
+class _UnpackedFile(h5py.File):
+    """
+    hdf5 file read from the temporary file *tmp*, which is closed along
+    with the hdf5 file.
+    """
+    def __init__(self, tmp, **kw):
+        h5py.File.__init__(self, tmp, **kw)
+        self._tmp = tmp
+
+    def close(self):
+        try:
+            h5py.File.close(self)
+        finally:
+            self._tmp.close()
+
+def _unpack(zf):
+    """
+    Copy the only member of the zip file *zf* into a temporary file, a
+    piece at a time, returning the open file positioned at the start.
+    """
+    members = zf.namelist()
+    assert len(members) == 1
+    tmp = tempfile.TemporaryFile()
+    try:
+        with zf.open(members[0]) as fid:
+            shutil.copyfileobj(fid, tmp, CHUNK_SIZE)
+    except Exception:
+        tmp.close()
+        raise
+    tmp.seek(0)
+    return tmp
+
+def test_h5_open_zip():
+    import io
+    from zipfile import ZIP_DEFLATED
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "data.nxs.h5")
+        with h5py.File(path, "w") as h5:
+            h5["entry/x"] = list(range(1000))
+        zip_path = os.path.join(tmpdir, "data.zip")
+        with ZipFile(zip_path, "w", ZIP_DEFLATED) as zf:
+            zf.write(path, "data.nxs.h5")
+        with open(zip_path, "rb") as fid:
+            zipped = fid.read()
+        # A zip file with a prepended stub doesn't start with a member.
+        stub_path = os.path.join(tmpdir, "stub.zip")
+        with open(stub_path, "wb") as fid:
+            fid.write(b"#!stub\n" + zipped)
+        for target, file_obj in ((path, None), (zip_path, None),
+                                 (zip_path, io.BytesIO(zipped)),
+                                 (stub_path, None)):
+            h5 = h5_open_zip(target, file_obj)
+            try:
+                assert h5["entry/x"][-1] == 999
+            finally:
+                h5.close()
+            if target != path:
+                assert h5._tmp.closed
+        with h5_open_zip(zip_path) as h5:
+            tmp = h5._tmp
+        assert tmp.closed
+    finally:
+        shutil.rmtree(tmpdir)
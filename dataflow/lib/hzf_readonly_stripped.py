@@ -116,7 +116,10 @@ class File(Node):
         Node.__init__(self, parent_node=None, path="/")
         if file_obj is None:
             file_obj = builtin_open(filename, mode='rb')
-        self.zipfile = zipfile.ZipFile(file_obj)
+        if isinstance(file_obj, zipfile.ZipFile):
+            self.zipfile = file_obj
+        else:
+            self.zipfile = zipfile.ZipFile(file_obj)
         self.attrs = self.makeAttrs()
         self.filename = filename
         self.mode = "r"
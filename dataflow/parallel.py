@@ -0,0 +1,256 @@
+"""
+Concurrent evaluation of template nodes.
+
+By default the nodes of a template are evaluated one after the other.
+Independent branches of the template, such as the specular, background
+and slit scan loaders of a reflectometry reduction, can instead be
+evaluated at the same time using a pool of threads or processes.
+
+A singleton :class:`ExecutorManager` is available for programs that only
+need a single shared pool.  Call *use_threads(max_workers)* or
+*use_processes(max_workers)* during program configuration to set up the
+pool, otherwise nodes are evaluated serially in the calling thread.  The
+calculation library will call *get_executor()* to retrieve the pool.
+
+A second manager controls the pool used within a node when the action
+is applied separately to each dataset in a bundle.  Configure it with
+*use_dataset_threads(max_workers)* or *use_dataset_processes(max_workers,
+chunksize)*.  The two pools are kept separate so that a node running in
+the node pool can wait on its datasets without starving the pool.
+
+Process pools use the "fork" start method so that the workers inherit the
+instrument definitions registered in the parent.  They are not available
+on platforms without fork.
+"""
+import os
+import threading
+from concurrent.futures import Executor, Future
+
+# Thread-local set of the pools whose tasks are running in the current
+# thread.  Nested template evaluations (loaders which call process_template
+# for each file, for example) must not submit work back to the pool that
+# is running them, or the pool can deadlock waiting for itself.
+_WORKER_STATE = threading.local()
+
+def _active_pools():
+    pools = getattr(_WORKER_STATE, 'pools', None)
+    if pools is None:
+        pools = _WORKER_STATE.pools = set()
+    return pools
+
+def in_worker(owner=None):
+    """
+    Return True if the current thread is executing a pool task.
+
+    If *owner* is given, only check for tasks from that manager.
+    """
+    pools = _active_pools()
+    return owner in pools if owner is not None else bool(pools)
+
+def _run_task(owner, fn, *args, **kwargs):
+    """
+    Run *fn* with the worker flag set for *owner*.  This is a module level
+    function so that it can be sent to a process pool.
+    """
+    pools = _active_pools()
+    nested = owner in pools
+    pools.add(owner)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        if not nested:
+            pools.discard(owner)
+
+
+class SerialExecutor(Executor):
+    """
+    Executor which runs each task immediately in the calling thread.
+
+    The returned future is already complete, so code written for a pool
+    will evaluate the tasks in submission order.
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+        return future
+
+
+SERIAL_EXECUTOR = SerialExecutor()
+
+class ExecutorManager(object):
+    """
+    Manage the worker pool used to evaluate template nodes.
+    """
+    def __init__(self):
+        self._executor = None
+        self._engine = "serial"
+        self._max_workers = None
+        self._chunksize = 1
+        self._pid = None
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @property
+    def max_workers(self):
+        return self._max_workers
+
+    @property
+    def chunksize(self):
+        return self._chunksize
+
+    def use_serial(self):
+        """
+        Evaluate nodes one at a time in the calling thread.
+        """
+        self.shutdown()
+        self._engine = "serial"
+
+    def use_threads(self, max_workers=None):
+        """
+        Evaluate independent nodes using a pool of threads.
+
+        Threads are cheap to start and share the in-memory cache, but only
+        help for nodes which release the GIL, such as loaders waiting on
+        the network or numpy heavy calculations.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        self.shutdown()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._engine = "thread"
+        self._max_workers = max_workers
+        self._pid = os.getpid()
+
+    def use_processes(self, max_workers=None, chunksize=1):
+        """
+        Evaluate independent nodes using a pool of processes.
+
+        Inputs and outputs of each node are pickled to send them between
+        processes, so this is only worthwhile for nodes that are expensive
+        to compute relative to the size of their data.
+
+        *chunksize* is the number of items sent to a worker at a time
+        by :meth:`map`.  Larger chunks reduce the number of round trips
+        to the workers at the cost of coarser load balancing.
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        self.shutdown()
+        context = multiprocessing.get_context("fork")
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=context)
+        self._engine = "process"
+        self._max_workers = max_workers
+        self._chunksize = chunksize
+        self._pid = os.getpid()
+
+    def shutdown(self):
+        """
+        Release the worker pool, waiting for running tasks to complete.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self._executor = None
+        self._engine = "serial"
+        self._max_workers = None
+        self._chunksize = 1
+        self._pid = None
+
+    def get_executor(self):
+        """
+        Return the executor for evaluating nodes.
+
+        Returns the serial executor if no pool is configured, if called
+        from a task that is already running inside the pool, or if called
+        from a forked worker process which cannot use the parent's pool.
+        """
+        if (self._executor is None or in_worker(id(self))
+                or self._pid != os.getpid()):
+            return SERIAL_EXECUTOR
+        return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Submit *fn(\\*args, \\*\\*kwargs)* to the executor, returning a future.
+        """
+        executor = self.get_executor()
+        if executor is SERIAL_EXECUTOR:
+            return executor.submit(fn, *args, **kwargs)
+        return executor.submit(_run_task, id(self), fn, *args, **kwargs)
+
+    def map(self, fn, *iterables):
+        """
+        Return the list *[fn(\\*args) for args in zip(\\*iterables)]*,
+        evaluating the items concurrently if a pool is configured.
+
+        Results are returned in the order of the inputs.  For process
+        pools, items are sent to the workers in groups of *chunksize*.
+        """
+        executor = self.get_executor()
+        if executor is SERIAL_EXECUTOR:
+            return list(map(fn, *iterables))
+        owners = [id(self)]*min(len(v) for v in iterables)
+        return list(executor.map(_run_task, owners, [fn]*len(owners),
+                                 *iterables, chunksize=self._chunksize))
+
+
+# Singleton executor managers if you only need one pool of each kind
+EXECUTOR_MANAGER = ExecutorManager()
+DATASET_EXECUTOR_MANAGER = ExecutorManager()
+
+# direct access to singleton methods
+use_serial = EXECUTOR_MANAGER.use_serial
+use_threads = EXECUTOR_MANAGER.use_threads
+use_processes = EXECUTOR_MANAGER.use_processes
+get_executor = EXECUTOR_MANAGER.get_executor
+use_dataset_serial = DATASET_EXECUTOR_MANAGER.use_serial
+use_dataset_threads = DATASET_EXECUTOR_MANAGER.use_threads
+use_dataset_processes = DATASET_EXECUTOR_MANAGER.use_processes
+
+
+def get_executor_manager():
+    """
+    Return the singleton executor manager for template nodes.
+    """
+    return EXECUTOR_MANAGER
+
+def get_dataset_executor_manager():
+    """
+    Return the singleton executor manager for datasets within a node.
+    """
+    return DATASET_EXECUTOR_MANAGER
+
+
+def test_serial_executor():
+    future = SERIAL_EXECUTOR.submit(lambda a, b: a + b, 1, b=2)
+    assert future.done() and future.result() == 3
+    future = SERIAL_EXECUTOR.submit(lambda: 1/0)
+    assert isinstance(future.exception(), ZeroDivisionError)
+
+def test_nested_submit_is_serial():
+    manager = ExecutorManager()
+    manager.use_threads(max_workers=1)
+    try:
+        # With a single worker, a task which waits on a nested submission
+        # to the same pool would deadlock unless it is run inline.
+        def outer():
+            return manager.submit(lambda: 5).result()
+        assert manager.submit(outer).result(timeout=10) == 5
+    finally:
+        manager.shutdown()
+    assert manager.engine == "serial"
+
+def test_map_order():
+    manager = ExecutorManager()
+    manager.use_threads(max_workers=4)
+    try:
+        assert manager.map(pow, range(20), [2]*20) == [k**2 for k in range(20)]
+    finally:
+        manager.shutdown()
+    assert manager.map(pow, range(3), [3]*3) == [0, 1, 8]
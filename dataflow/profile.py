@@ -0,0 +1,220 @@
+"""
+Execution profile for template evaluation.
+
+Pass a :class:`Profile` to *process_template* to record what happened at
+each node: whether it was retrieved from the cache or computed, how long
+the action took, how long it took to serialize and store the result, and
+how much memory the result uses.  The profile can be converted to a
+dictionary with *todict()* so that it can be returned to the client or
+written to a log for aggregation across server processes.
+"""
+from __future__ import print_function
+
+import sys
+import time
+import threading
+
+# Counters accumulated by the cache manager when storing and retrieving.
+CACHE_STATS = (
+    "pickle_time", "compress_time", "store_time", "stored_bytes",
+    "fetch_time", "decompress_time", "unpickle_time", "retrieved_bytes",
+    )
+
+# Store counters arrive from the cache writer thread when write-behind is
+# enabled, so updates to the records are serialized.
+_STATS_LOCK = threading.Lock()
+
+
+class NodeProfile(object):
+    """
+    Execution record for one node of a template.
+
+    *status* is "cached" if the node was retrieved from the cache,
+    "computed" if the action was run, "partial" if an element-wise action
+    was only run on the datasets missing from the cache, "alias" if the
+    results of the identical node *alias_of* were reused, or "input" if
+    the inputs of the node were returned without running it.
+
+    *wall_time* and *cpu_time* are the seconds spent in the action.  CPU
+    time is for the thread that ran the node, so it does not include work
+    sent to the dataset pool.  *peak_rss_delta* is the increase in the peak
+    resident memory of the process running the node, in bytes.
+    *wait_time* is the time spent waiting for another worker which was
+    already computing the node.
+
+    *result_bytes* is the estimated memory used by the node outputs.  The
+    remaining fields, listed in :data:`CACHE_STATS`, are the times in
+    seconds and the serialized sizes in bytes for cache traffic.
+    """
+    def __init__(self, node, module=None, fingerprint=None):
+        self.node = node
+        self.module = module
+        self.fingerprint = fingerprint
+        self.status = None
+        self.alias_of = None
+        self.datasets = None
+        self.datasets_computed = None
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        self.peak_rss_delta = 0
+        self.wait_time = 0.
+        self.result_bytes = 0
+        for name in CACHE_STATS:
+            setattr(self, name, 0)
+
+    @property
+    def cache_hit(self):
+        return self.status == "cached"
+
+    def add_stats(self, stats):
+        """
+        Accumulate the timing and size counters in the *stats* dictionary.
+
+        This may be called from the cache writer thread.
+        """
+        with _STATS_LOCK:
+            for name, value in stats.items():
+                setattr(self, name, getattr(self, name, 0) + value)
+
+    def todict(self):
+        state = dict(self.__dict__)
+        state['cache_hit'] = self.cache_hit
+        return state
+
+
+class Profile(object):
+    """
+    Execution record for a template evaluation.
+
+    *nodes* is the list of :class:`NodeProfile` records in the order that
+    the nodes were started.  *wall_time* and *cpu_time* are for the whole
+    evaluation, and *peak_memory* is the estimated peak memory held in
+    intermediate results, in bytes.
+    """
+    def __init__(self, name=None, target=None):
+        self.name = name
+        self.target = target
+        self.nodes = []
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        self.peak_memory = 0
+        self._index = {}
+        self._start = None
+
+    def node(self, node, module=None, fingerprint=None):
+        """
+        Return the record for *node*, creating it if it does not exist.
+        """
+        record = self._index.get(node, None)
+        if record is None:
+            record = self._index[node] = NodeProfile(node, module, fingerprint)
+            self.nodes.append(record)
+        return record
+
+    def start(self):
+        self._start = (time.time(), time.process_time())
+
+    def stop(self):
+        if self._start is not None:
+            wall, cpu = self._start
+            self.wall_time += time.time() - wall
+            self.cpu_time += time.process_time() - cpu
+            self._start = None
+
+    def todict(self):
+        return {
+            'name': self.name,
+            'target': self.target,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'peak_memory': self.peak_memory,
+            'nodes': [record.todict() for record in self.nodes],
+            }
+
+    def summary(self):
+        """
+        Return a table of node timings as a string.
+        """
+        lines = ["%4s %-30s %-8s %9s %9s %9s %10s"%(
+            "node", "module", "status", "wall(s)", "cpu(s)", "cache(s)",
+            "stored")]
+        for r in self.nodes:
+            cache_time = sum(getattr(r, name) for name in CACHE_STATS
+                             if name.endswith("_time"))
+            lines.append("%4d %-30s %-8s %9.3f %9.3f %9.3f %10d"%(
+                r.node, r.module, r.status, r.wall_time, r.cpu_time,
+                cache_time, r.stored_bytes))
+        lines.append("total wall %.3f s, cpu %.3f s, peak memory %.1f MiB"%(
+            self.wall_time, self.cpu_time, self.peak_memory/2**20))
+        return "\n".join(lines)
+
+
+def add_stat(stats, name, value):
+    """
+    Add *value* to the *name* counter in *stats*, ignoring None *stats*.
+    """
+    if stats is not None:
+        stats[name] = stats.get(name, 0) + value
+
+
+def timed_call(fn, *args):
+    """
+    Call *fn(\\*args)*, returning the result and a dictionary with the
+    wall time, thread CPU time and increase in peak memory for the call.
+
+    This is a module level function so that it can be sent to a process
+    pool along with *fn*.
+    """
+    # CRUFT: thread_time is not available before python 3.7
+    cpu_clock = getattr(time, 'thread_time', time.process_time)
+    rss = peak_rss()
+    wall, cpu = time.time(), cpu_clock()
+    result = fn(*args)
+    timing = {
+        'wall_time': time.time() - wall,
+        'cpu_time': cpu_clock() - cpu,
+        'peak_rss_delta': (peak_rss() - rss) if rss is not None else 0,
+        }
+    return result, timing
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of the process in bytes, or None if
+    it is not available on this platform.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    return rss if sys.platform == 'darwin' else rss*1024
+
+
+def estimate_nbytes(value, seen=None):
+    """
+    Estimate the number of bytes referenced by *value*.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if hasattr(value, 'nbytes') and hasattr(value, 'dtype'):
+        # numpy arrays, counting object arrays element by element
+        if value.dtype.hasobject:
+            return value.nbytes + sum(estimate_nbytes(v, seen)
+                                      for v in value.flat)
+        return value.nbytes
+    elif isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    elif isinstance(value, dict):
+        return sum(estimate_nbytes(k, seen) + estimate_nbytes(v, seen)
+                   for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return sum(estimate_nbytes(v, seen) for v in value)
+    elif hasattr(value, '__dict__') and not isinstance(value, type):
+        return estimate_nbytes(value.__dict__, seen)
+    else:
+        return sys.getsizeof(value)
@@ -2,7 +2,6 @@ import os
 import json
 from posixpath import basename, join
 from copy import copy, deepcopy
-from io import BytesIO
 import numpy as np
 from time import time,strftime
 
@@ -72,15 +71,16 @@ def LoadDCS(filelist=None, check_timestamps=True):
 
     2018-04-25 Brian Maranville
     """
-    from dataflow.fetch import url_get
+    from dataflow.fetch import url_get_many, open_content
     from .dcsdata import readDCS
     if filelist is None:
         filelist = []
     data = []
-    for fileinfo in filelist:
+    contents = url_get_many(filelist, mtime_check=check_timestamps)
+    for fileinfo, content in zip(filelist, contents):
         path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
         name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
+        fid = open_content(content)
         entry = readDCS(name, fid)
         data.append(entry)
 
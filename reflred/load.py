@@ -1,47 +1,67 @@
 from os.path import basename
-from io import BytesIO
+from copy import copy
 
-from dataflow.fetch import url_get
+from dataflow.fetch import url_get, url_parse_many, open_content
 
 
 def load_from_string(filename, data, entries=None, loader=None):
     """
     Load a nexus file from a string, e.g., as returned from url.read().
     """
-    with BytesIO(data) as fd:
+    with open_content(data) as fd:
         entries = loader(filename, fd, entries=entries)
     return entries
 
 def url_load(fileinfo, check_timestamps=True, loader=None):
+    content = url_get(fileinfo, mtime_check=check_timestamps)
+    return content_load(fileinfo, content, loader=loader)
+
+def content_load(fileinfo, content, loader=None):
+    """
+    Load the entries from the *content* fetched for *fileinfo*.
+    """
     path, entries = fileinfo['path'], fileinfo.get('entries', None)
     filename = basename(path)
-    content = url_get(fileinfo, mtime_check=check_timestamps)
+    return load_from_string(filename, content, entries=entries,
+                            loader=file_loader(filename, loader))
+
+def file_loader(filename, loader=None):
+    """
+    Return the loader for *filename*, or *loader* if it is given.
+    """
     if loader is not None:
-        return load_from_string(filename, content, entries=entries,
-                                loader=loader)
+        return loader
     elif filename.endswith('.raw') or filename.endswith('.ras'):
         from . import xrawref
-        return load_from_string(filename, content, entries=entries,
-                                loader=xrawref.load_entries)
+        return xrawref.load_entries
     elif filename.endswith('.nxs.cdr'):
         from . import candor
-        return load_from_string(filename, content, entries=entries,
-                                loader=candor.load_entries)
+        return candor.load_entries
     else:
         from . import nexusref
-        return load_from_string(filename, content, entries=entries,
-                                loader=nexusref.load_entries)
+        return nexusref.load_entries
 
 def url_load_list(files=None, check_timestamps=True, loader=None):
+    """
+    Load the entries from each file in *files*.
+
+    Parsed entries are cached, so files already loaded by another template
+    are not parsed again.  The entries returned are copies, so the steps
+    may set attributes on them without changing the cached entries.
+    """
     if files is None:
         return []
-    result = [
-        entry
-        for fileinfo in files
-        for entry in url_load(
-            fileinfo, check_timestamps=check_timestamps, loader=loader,
-            )
-        ]
+    loaders = [file_loader(basename(fileinfo['path']), loader)
+               for fileinfo in files]
+    parsed = [None]*len(files)
+    for current in set(loaders):
+        index = [k for k, v in enumerate(loaders) if v is current]
+        results = url_parse_many(
+            [files[k] for k in index], current,
+            mtime_check=check_timestamps, with_entries=True)
+        for k, entries in zip(index, results):
+            parsed[k] = entries
+    result = [copy(entry) for entries in parsed for entry in entries]
     return result
 
 def setup_fetch():
@@ -9,7 +9,6 @@ from __future__ import print_function
 
 from posixpath import basename, join
 from copy import copy, deepcopy
-from io import BytesIO
 from collections import OrderedDict
 
 import numpy as np
@@ -84,15 +83,16 @@ def LoadDIV(filelist=None, variance=0.0001):
 
     2018-04-21 Brian Maranville
     """
-    from dataflow.fetch import url_get
+    from dataflow.fetch import url_get_many, open_content
     from .sans_vaxformat import readNCNRSensitivity
 
     output = []
     if filelist is not None:
-        for fileinfo in filelist:
+        contents = url_get_many(filelist, mtime_check=False)
+        for fileinfo, content in zip(filelist, contents):
             path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
             name = basename(path)
-            fid = BytesIO(url_get(fileinfo, mtime_check=False))
+            fid = open_content(content)
             sens_raw = readNCNRSensitivity(fid)
             sens = SansData(Uncertainty(sens_raw, sens_raw * variance))
             sens.metadata = OrderedDict([
@@ -127,38 +127,44 @@ def LoadRawSANS(filelist=None, check_timestamps=True):
 
     2018-04-23 Brian Maranville
     """
-    from dataflow.fetch import url_get
-    from .loader import readSANSNexuz
+    from dataflow.fetch import url_parse_many
     if filelist is None:
         filelist = []
     data = []
-    for fileinfo in filelist:
-        path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-        name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
-        if name.upper().endswith(".DIV"):
-            sens_raw = readNCNRSensitivity(fid)
-            detectors = [{"detector": {"data": {"value": Uncertainty(sens_raw, sens_raw * 0.0001)}}}]
-            metadata = OrderedDict([
-                ("run.filename", name),
-                ("analysis.groupid", -1),
-                ("analysis.intent", "DIV"),
-                ("analysis.filepurpose", "Sensitivity"),
-                ("run.experimentScanID", name), 
-                ("sample.description", "PLEX"),
-                ("entry", "entry"),
-                ("sample.labl", "PLEX"),
-                ("run.configuration", "DIV"),
-            ])
-            sens = RawSANSData(metadata=metadata, detectors=detectors)
-            entries = [sens]
-        else:
-            entries = readSANSNexuz(name, fid)
-        
-        data.extend(entries)
+    parsed = url_parse_many(filelist, _read_raw_sans,
+                            mtime_check=check_timestamps)
+    for entries in parsed:
+        # The parsed entries are shared through the cache, so give later
+        # steps copies whose metadata they can update.
+        for entry in entries:
+            entry = copy(entry)
+            entry.metadata = entry.metadata.copy()
+            data.append(entry)
 
     return data
 
+def _read_raw_sans(name, fid):
+    from .loader import readSANSNexuz
+    if name.upper().endswith(".DIV"):
+        sens_raw = readNCNRSensitivity(fid)
+        detectors = [{"detector": {"data": {"value": Uncertainty(sens_raw, sens_raw * 0.0001)}}}]
+        metadata = OrderedDict([
+            ("run.filename", name),
+            ("analysis.groupid", -1),
+            ("analysis.intent", "DIV"),
+            ("analysis.filepurpose", "Sensitivity"),
+            ("run.experimentScanID", name), 
+            ("sample.description", "PLEX"),
+            ("entry", "entry"),
+            ("sample.labl", "PLEX"),
+            ("run.configuration", "DIV"),
+        ])
+        sens = RawSANSData(metadata=metadata, detectors=detectors)
+        entries = [sens]
+    else:
+        entries = readSANSNexuz(name, fid)
+    return entries
+
 @cache
 @module
 def patch(data, patches=None):
@@ -52,6 +52,7 @@ dist = setup(
         ],
     extras_require={
         'masked_curve_fit': ['numdifftools'],
+        'zstd': ['zstandard'],
         },
     tests_require=['pytest'],
     )
@@ -0,0 +1,547 @@
+"""
+Tests for template evaluation in dataflow.calc.
+
+A toy instrument is registered with loaders and element-wise steps
+operating on simple numeric values so that the scheduling and caching
+logic can be checked without instrument data files.
+"""
+from __future__ import print_function
+
+import time
+import threading
+
+from dataflow import core as df
+from dataflow import parallel
+from dataflow.automod import make_modules, make_template
+from dataflow.cache import get_cache, set_test_cache
+from dataflow.calc import process_template, find_calculated, tag_source
+
+INSTRUMENT = "test.calc"
+
+# Record the actions called so that tests can check what was computed.
+CALLS = []
+_CALLS_LOCK = threading.Lock()
+
+def _record(name, *args):
+    with _CALLS_LOCK:
+        CALLS.append((name,) + args)
+
+# Set to a threading.Barrier to make the loaders wait for each other, which
+# can only succeed if they are running at the same time.
+BARRIER = None
+
+
+class Value(object):
+    def __init__(self, x=0):
+        self.x = x
+
+    def todict(self):
+        return {'x': self.x}
+
+    def fromdict(self, state):
+        self.x = state['x']
+
+    def get_plottable(self):
+        return self.todict()
+
+    def get_metadata(self):
+        return self.todict()
+
+
+def load(start=0, count=1, delay=0.0):
+    """
+    Create a sequence of values.
+
+    **Inputs**
+
+    start (int) : first value
+
+    count (int) : number of values
+
+    delay (float) : seconds to wait before returning
+
+    **Returns**
+
+    output (value[]) : values start, start+1, ...
+
+    2026-10-17 Reductus
+    """
+    _record("load", start, count)
+    if BARRIER is not None:
+        BARRIER.wait()
+    time.sleep(delay)
+    return [Value(start + k) for k in range(count)]
+
+def load_files(filelist=None):
+    """
+    Create a value for each file, taking the value from the file name.
+
+    **Inputs**
+
+    filelist (fileinfo[]) : files to load
+
+    **Returns**
+
+    output (value[]) : one value for each file
+
+    2026-10-17 Reductus
+    """
+    _record("load_files", len(filelist or []))
+    data = []
+    for fileinfo in filelist or []:
+        value = Value(int(fileinfo['path']))
+        tag_source([value], fileinfo['path'])
+        data.append(value)
+    return data
+
+def scale(data, factor=2):
+    """
+    Scale each value.
+
+    **Inputs**
+
+    data (value) : value to scale
+
+    factor (int) : scale factor
+
+    **Returns**
+
+    output (value) : scaled value
+
+    2026-10-17 Reductus
+    """
+    _record("scale", data.x, factor)
+    return Value(data.x * factor)
+
+def scale_each(data, factor=2):
+    """
+    Scale each value by its own factor.
+
+    **Inputs**
+
+    data (value) : value to scale
+
+    factor (int*) : scale factor for each dataset
+
+    **Returns**
+
+    output (value) : scaled value
+
+    2026-10-17 Reductus
+    """
+    _record("scale", data.x, factor)
+    return Value(data.x * factor)
+
+def total(data):
+    """
+    Add all values together.
+
+    **Inputs**
+
+    data (value[]*) : values to add
+
+    **Returns**
+
+    output (value) : sum of the values
+
+    2026-10-17 Reductus
+    """
+    _record("total", len(data))
+    return Value(sum(d.x for d in data))
+
+
+def _define_instrument():
+    if INSTRUMENT in df._instrument_registry:
+        return df.lookup_instrument(INSTRUMENT)
+    modules = make_modules([load, load_files, scale, scale_each, total],
+                           prefix=INSTRUMENT+'.')
+    value = df.DataType(INSTRUMENT+".value", Value)
+    instrument = df.Instrument(
+        id=INSTRUMENT,
+        name='test instrument',
+        menu=[('steps', modules)],
+        datatypes=[value],
+        )
+    df.register_instrument(instrument)
+    return instrument
+
+def _template(diagram):
+    instrument = _define_instrument()
+    return make_template(
+        name="test", description="test template", diagram=diagram,
+        instrument=instrument, version='1.0')
+
+def _reset():
+    set_test_cache()
+    backend = get_cache().get_cache()
+    for key in list(backend.keys()):
+        backend.delete(key)
+    del CALLS[:]
+
+BRANCHES = [
+    ["load => a", {"start": 1, "count": 3, "delay": 0.3}],
+    ["load => b", {"start": 10, "count": 3, "delay": 0.3}],
+    ["scale => sa", {"data": "a.output"}],
+    ["scale => sb", {"data": "b.output", "factor": 3}],
+    ["total", {"data": "sa.output, sb.output"}],
+]
+
+def test_serial():
+    _reset()
+    template = _template(BRANCHES)
+    result = process_template(template, {}, target=(4, "output"))
+    assert [v.x for v in result.values] == [2*(1+2+3) + 3*(10+11+12)]
+    assert find_calculated(template, {}) == [True]*5
+    # Everything is cached so a second evaluation does no work.
+    del CALLS[:]
+    process_template(template, {}, target=(4, "output"))
+    assert CALLS == []
+
+def test_threads():
+    global BARRIER
+    _reset()
+    template = _template(BRANCHES)
+    parallel.use_threads(max_workers=2)
+    # The two loaders wait for each other, so they must run concurrently.
+    BARRIER = threading.Barrier(2, timeout=10)
+    try:
+        result = process_template(template, {}, target=(4, "output"))
+    finally:
+        BARRIER = None
+        parallel.use_serial()
+    assert [v.x for v in result.values] == [2*(1+2+3) + 3*(10+11+12)]
+
+def test_return_input_terminal():
+    _reset()
+    template = _template(BRANCHES)
+    result = process_template(template, {}, target=(4, "data"))
+    assert [v.x for v in result.values] == [2, 4, 6, 30, 33, 36]
+
+def test_dataset_pool():
+    # Element-wise steps map over the bundle in the dataset pool and keep
+    # the datasets in order.
+    diagram = [
+        ["load", {"start": 1, "count": 20}],
+        ["scale", {"data": "-.output", "factor": 5}],
+    ]
+    for engine in ("thread", "process"):
+        _reset()
+        template = _template(diagram)
+        if engine == "thread":
+            parallel.use_dataset_threads(max_workers=4)
+        else:
+            parallel.use_dataset_processes(max_workers=2, chunksize=4)
+        try:
+            result = process_template(template, {}, target=(1, "output"))
+        finally:
+            parallel.use_dataset_serial()
+        assert [v.x for v in result.values] == [5*k for k in range(1, 21)]
+
+def test_element_cache():
+    # Per-dataset field values only invalidate the datasets they change,
+    # in that step and in the element-wise steps that follow.
+    _reset()
+    diagram = [
+        ["load", {"start": 1, "count": 4}],
+        ["scale_each => s1", {"data": "-.output", "factor": [5]}],
+        ["scale => s2", {"data": "-.output", "factor": 2}],
+    ]
+    template = _template(diagram)
+    result = process_template(template, {}, target=(2, "output"))
+    assert [v.x for v in result.values] == [10, 20, 30, 40]
+    del CALLS[:]
+    config = {"1": {"factor": [5, 5, 3, 5]}}
+    result = process_template(template, config, target=(2, "output"))
+    assert [v.x for v in result.values] == [10, 20, 18, 40]
+    assert [c for c in CALLS if c[0] == "scale"] == [
+        ("scale", 3, 3), ("scale", 9, 2)]
+    # Changing a loader without sources gives new fingerprints to all of
+    # its datasets.
+    del CALLS[:]
+    result = process_template(template, {"0": {"count": 5}},
+                              target=(2, "output"))
+    assert [v.x for v in result.values] == [10, 20, 30, 40, 50]
+    assert len([c for c in CALLS if c[0] == "scale"]) == 10
+
+def _files(*names):
+    return [{"source": "test", "path": name, "mtime": 1} for name in names]
+
+def test_element_cache_sources():
+    # Datasets tagged with their source keep their fingerprints when files
+    # are added to the loader, so only the new file is computed.
+    _reset()
+    diagram = [
+        ["load_files", {"filelist": _files("1", "2", "3")}],
+        ["scale => s1", {"data": "-.output", "factor": 5}],
+        ["scale => s2", {"data": "-.output", "factor": 2}],
+    ]
+    template = _template(diagram)
+    result = process_template(template, {}, target=(2, "output"))
+    assert [v.x for v in result.values] == [10, 20, 30]
+    del CALLS[:]
+    config = {"0": {"filelist": _files("1", "4", "2", "3")}}
+    result = process_template(template, config, target=(2, "output"))
+    assert [v.x for v in result.values] == [10, 40, 20, 30]
+    assert [c for c in CALLS if c[0] == "scale"] == [
+        ("scale", 4, 5), ("scale", 20, 2)]
+    # Removing a file computes nothing but the loader.
+    del CALLS[:]
+    config = {"0": {"filelist": _files("3", "1")}}
+    result = process_template(template, config, target=(2, "output"))
+    assert [v.x for v in result.values] == [30, 10]
+    assert [c[0] for c in CALLS] == ["load_files"]
+
+def test_nocache():
+    # Turning off caching for a module clears the cached values of the
+    # nodes which depend on it.
+    _reset()
+    template = _template(BRANCHES)
+    process_template(template, {}, target=(4, "output"))
+    module = df.lookup_module(INSTRUMENT+".scale")
+    del CALLS[:]
+    module.action.cached = False
+    try:
+        result = process_template(template, {}, target=(4, "output"))
+    finally:
+        del module.action.cached
+    assert [v.x for v in result.values] == [2*(1+2+3) + 3*(10+11+12)]
+    assert sorted(c[0] for c in CALLS) == ["scale"]*6 + ["total"]
+    assert find_calculated(template, {}) == [True, True, False, False, True]
+
+def test_demand_driven():
+    # A cached target is retrieved without touching its ancestors.
+    _reset()
+    template = _template(BRANCHES)
+    process_template(template, {}, target=(4, "output"))
+    cache = get_cache()
+    retrieved = []
+    retrieve_many = cache.retrieve_many
+    def counting_retrieve_many(keys, stats=None):
+        keys = list(keys)
+        retrieved.extend(keys)
+        return retrieve_many(keys, stats)
+    cache.retrieve_many = counting_retrieve_many
+    try:
+        process_template(template, {}, target=(4, "output"))
+        assert len(retrieved) == 1
+        # Changing one branch computes that branch, and only retrieves
+        # the cached result at the head of the other branch.
+        del retrieved[:]
+        del CALLS[:]
+        result = process_template(template, {"3": {"factor": 1}},
+                                  target=(4, "output"))
+    finally:
+        del cache.retrieve_many
+    assert [v.x for v in result.values] == [2*(1+2+3) + (10+11+12)]
+    assert [c[0] for c in CALLS] == ["scale"]*3 + ["total"]
+    assert "load" not in [c[0] for c in CALLS]
+
+def test_release_intermediates():
+    # Intermediate results are dropped once their consumers have started,
+    # but the target and any nodes in keep are retained.
+    _reset()
+    diagram = [
+        ["load", {"start": 1, "count": 3}],
+        ["scale => s1", {"data": "-.output"}],
+        ["scale => s2", {"data": "-.output"}],
+        ["total", {"data": "-.output"}],
+    ]
+    template = _template(diagram)
+    import dataflow.calc as calc
+    held = []
+    consume_results = calc._get_inputs
+    def spy(results, input_wires, input_terminals):
+        held.append(sorted(results.keys()))
+        return consume_results(results, input_wires, input_terminals)
+    calc._get_inputs = spy
+    try:
+        result = process_template(template, {}, target=(3, "output"), keep=[1])
+    finally:
+        calc._get_inputs = consume_results
+    assert [v.x for v in result.values] == [4*(1+2+3)]
+    assert held == [[], ["0:output"], ["1:output"], ["1:output", "2:output"]]
+
+def test_template_graph():
+    template = _template(BRANCHES)
+    assert template.order() == [0, 1, 2, 3, 4]
+    assert template.order(target=2) == [0, 2]
+    assert template.dependents(1) == set([1, 3, 4])
+    assert [w['source'][0] for w in template.inputs(4)] == [2, 3]
+    assert template.inputs(0) == []
+    # The wiring index is not part of the template definition.
+    assert '_graph_index' not in template.dumps()
+    # Adding a wire rebuilds the index.
+    template.modules.append(dict(template.modules[3]))
+    template.wires.append({'source': [1, 'output'], 'target': [5, 'data']})
+    assert template.order(target=5) == [1, 5]
+    assert template.dependents(1) == set([1, 3, 4, 5])
+
+def test_profile():
+    from dataflow.profile import Profile
+    _reset()
+    diagram = [
+        ["load", {"start": 1, "count": 3}],
+        ["scale => s1", {"data": "-.output"}],
+        ["total", {"data": "-.output"}],
+    ]
+    template = _template(diagram)
+    profile = Profile()
+    process_template(template, {}, target=(2, "output"), profile=profile)
+    assert [(r.node, r.status) for r in profile.nodes] == [
+        (0, "computed"), (1, "computed"), (2, "computed")]
+    assert profile.nodes[1].datasets_computed == 3
+    assert all(r.stored_bytes > 0 and r.result_bytes > 0
+               for r in profile.nodes)
+    # A cached target is retrieved without touching the other nodes.
+    profile = Profile()
+    process_template(template, {}, target=(2, "output"), profile=profile)
+    assert [(r.node, r.status) for r in profile.nodes] == [(2, "cached")]
+    state = profile.todict()
+    assert state['nodes'][0]['cache_hit']
+    assert state['nodes'][0]['retrieved_bytes'] > 0
+    assert "cached" in profile.summary()
+
+def test_profile_write_behind():
+    # Store counters from the cache writer thread reach the profile once
+    # the values have been written.
+    from dataflow.profile import Profile
+    _reset()
+    cache = get_cache()
+    cache.use_write_behind(10**8)
+    release = threading.Event()
+    try:
+        # Hold the writer until the evaluation is complete.
+        cache._writer.call(release.wait)
+        template = _template([
+            ["load", {"start": 1, "count": 3}],
+            ["scale", {"data": "-.output"}],
+        ])
+        profile = Profile()
+        process_template(template, {}, target=(1, "output"), profile=profile)
+        assert all(r.stored_bytes == 0 for r in profile.nodes)
+        release.set()
+        cache.flush()
+        assert [r.status for r in profile.nodes] == ["computed", "computed"]
+        assert all(r.stored_bytes > 0 for r in profile.nodes)
+    finally:
+        release.set()
+        cache.use_write_behind(0)
+
+def test_single_flight():
+    # Concurrent requests for the same node compute it once, with the
+    # late arrivals waiting for the result.
+    _reset()
+    diagram = [
+        ["load", {"start": 1, "count": 3, "delay": 0.5}],
+        ["scale", {"data": "-.output"}],
+    ]
+    template = _template(diagram)
+    outputs = []
+    def request():
+        result = process_template(template, {}, target=(1, "output"))
+        outputs.append([v.x for v in result.values])
+    threads = [threading.Thread(target=request) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert outputs == [[2, 4, 6]]*3
+    assert [c[0] for c in CALLS].count("load") == 1
+
+def test_abandoned_lease():
+    # If the worker holding the lease gives up without storing a result,
+    # a waiting worker takes over the computation.
+    _reset()
+    diagram = [["load", {"start": 1, "count": 2}]]
+    template = _template(diagram)
+    cache = get_cache()
+    from dataflow.calc import fingerprint_template
+    fp = fingerprint_template(template, {})[0]
+    token = cache.acquire_lease(fp)
+    assert token is not None and cache.acquire_lease(fp) is None
+    timer = threading.Timer(0.3, cache.release_lease, (fp, token))
+    timer.start()
+    result = process_template(template, {}, target=(0, "output"))
+    timer.join()
+    assert [v.x for v in result.values] == [1, 2]
+    assert CALLS == [("load", 1, 2)]
+
+def test_common_subgraph():
+    # Identical branches are computed once and their results shared.
+    _reset()
+    diagram = [
+        ["load => a", {"start": 1, "count": 2}],
+        ["load => b", {"start": 1, "count": 2}],
+        ["scale => sa", {"data": "a.output"}],
+        ["scale => sb", {"data": "b.output"}],
+        ["total", {"data": "sa.output, sb.output"}],
+    ]
+    template = _template(diagram)
+    result = process_template(template, {}, target=(4, "output"))
+    assert [v.x for v in result.values] == [2*2*(1+2)]
+    assert [c[0] for c in CALLS] == ["load", "scale", "scale", "total"]
+    _reset()
+    results = process_template(template, {})
+    assert results["1:output"] is results["0:output"]
+    assert [c[0] for c in CALLS] == ["load", "scale", "scale", "total"]
+    # Different configurations are computed separately.
+    results = process_template(template, {"1": {"count": 3}})
+    assert [v.x for v in results["4:output"].values] == [2*(1+2)+2*(1+2+3)]
+
+def test_cache_tags():
+    # Cached results are tagged with the instrument and module that made
+    # them, so they can be summarized and purged.
+    _reset()
+    template = _template(BRANCHES)
+    process_template(template, {}, target=(4, "output"))
+    cache = get_cache()
+    usage = cache.usage(group_by=["module"])
+    assert usage["groups"]["test.calc.load"]["entries"] == 2
+    assert cache.purge(module="test.calc.total") == 1
+    assert find_calculated(template, {}) == [True]*4 + [False]
+
+def test_collect_garbage():
+    # Results from an old module version are removed.
+    from dataflow.calc import collect_garbage
+    _reset()
+    template = _template(BRANCHES)
+    process_template(template, {}, target=(4, "output"))
+    module = df.lookup_module(INSTRUMENT+".total")
+    assert collect_garbage()[0] == 0
+    get_cache().store("stale", 1, tags={'instrument': INSTRUMENT,
+                                         'module': module.id, 'version': "old"})
+    get_cache().store("other", 1, tags={'instrument': "not.loaded",
+                                         'module': "x", 'version': "old"})
+    assert collect_garbage()[0] == 1
+    assert get_cache().exists_many(["stale", "other"]) == [False, True]
+
+def test_fingerprint_format():
+    # Configs are hashed in the same form as str(_format_ordered(config)),
+    # and primitives are formatted as themselves on every python version.
+    from dataflow.calc import _format_ordered, _Ordered, generate_fingerprint
+    configs = [
+        {},
+        {"b": [1, 2.5, None], "a": ("x",), "c": {"z": True, "y": b"raw"}},
+        {"nested": [{"k": (1, 2)}, "text"], "value": Value(3)},
+        {"fn": scale},
+    ]
+    for config in configs:
+        assert (generate_fingerprint(["id", _Ordered(config)])
+                == generate_fingerprint(["id", str(_format_ordered(config))]))
+    assert _format_ordered({"s": "abc", "n": 1}) == [("n", 1), ("s", "abc")]
+    assert (generate_fingerprint([_Ordered({"s": "abc"})])
+            != generate_fingerprint([_Ordered({"s": "abd"})]))
+
+def test_fingerprint_memo():
+    # Functions in the config are memoized by their source, not their name.
+    from dataflow import calc
+    config = {"fn": scale, "factor": 2}
+    key = calc._config_key(config)
+    assert key is not None and key == calc._config_key(dict(config))
+    getsource = calc._getsource
+    calc._getsource = lambda fn: "def scale(data): pass"
+    try:
+        assert calc._config_key(config) != key
+    finally:
+        calc._getsource = getsource
+    assert calc._config_key({"fn": scale_each, "factor": 2}) != key
@@ -0,0 +1,186 @@
+"""
+Tests for fetching data files in dataflow.fetch.
+
+A local HTTP server stands in for the data source, serving files with
+Last-Modified and ETag headers and answering conditional requests, so
+that the download and revalidation logic can be checked offline.
+"""
+from __future__ import print_function
+
+import threading
+import uuid
+from email.utils import formatdate
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from dataflow import fetch
+from dataflow.cache import set_test_cache
+
+MTIME = 1500000000
+
+# path => (contents, mtime) for the files served
+FILES = {}
+# (method, path, status) for each request received
+REQUESTS = []
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.lstrip("/")
+        if path not in FILES:
+            self._respond(404)
+            return
+        contents, mtime = FILES[path]
+        etag = '"%d-%d"'%(mtime, len(contents))
+        modified = formatdate(mtime, usegmt=True)
+        if (self.headers.get("If-None-Match", None) == etag
+                or self.headers.get("If-Modified-Since", None) == modified):
+            self._respond(304)
+            return
+        self._respond(200, {"ETag": etag, "Last-Modified": modified,
+                            "Content-Length": str(len(contents))})
+        self.wfile.write(contents)
+
+    def _respond(self, status, headers={}):
+        REQUESTS.append(("GET", self.path.lstrip("/"), status))
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve():
+    server = HTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    set_test_cache()
+    fetch.DATA_SOURCES = [{
+        "name": "test",
+        "url": "http://127.0.0.1:%d/"%server.server_address[1],
+        "start_path": "",
+        }]
+    return server
+
+def _file(contents, mtime=MTIME):
+    # Use a new path for each test since the file cache outlives the test.
+    path = "data/%s.nxs"%uuid.uuid4().hex
+    FILES[path] = (contents, mtime)
+    return path
+
+def _statuses(path):
+    return [status for _, p, status in REQUESTS if p == path]
+
+def test_mtime_check():
+    server = _serve()
+    try:
+        path = _file(b"abc")
+        fileinfo = {"source": "test", "path": path, "mtime": MTIME}
+        assert bytes(fetch.url_get(fileinfo)) == b"abc"
+        # Files with an mtime are not fetched again.
+        assert bytes(fetch.url_get(fileinfo)) == b"abc"
+        assert _statuses(path) == [200]
+        # A file which doesn't match the requested mtime is not cached.
+        stale = {"source": "test", "path": path, "mtime": MTIME - 10}
+        try:
+            fetch.url_get(stale)
+        except ValueError as exc:
+            assert "older" in str(exc)
+        else:
+            raise AssertionError("mtime mismatch not detected")
+        assert not fetch.get_cache().file_exists(
+            fetch._fileinfo_fingerprint(stale))
+    finally:
+        server.shutdown()
+
+def test_revalidate():
+    server = _serve()
+    try:
+        path = _file(b"first")
+        fileinfo = {"source": "test", "path": path}
+        assert bytes(fetch.url_get(fileinfo)) == b"first"
+        # Files without an mtime are revalidated with a conditional request.
+        assert bytes(fetch.url_get(fileinfo)) == b"first"
+        assert _statuses(path) == [200, 304]
+        # Changed files are downloaded again.
+        FILES[path] = (b"second", MTIME + 60)
+        assert bytes(fetch.url_get(fileinfo)) == b"second"
+        assert bytes(fetch.url_get(fileinfo)) == b"second"
+        assert _statuses(path) == [200, 304, 200, 304]
+    finally:
+        server.shutdown()
+
+def test_url_get_many():
+    server = _serve()
+    try:
+        paths = [_file(("file %d"%k).encode()) for k in range(5)]
+        files = [{"source": "test", "path": path, "mtime": MTIME}
+                 for path in paths + paths[:1]]
+        contents = fetch.url_get_many(files, workers=3)
+        assert [bytes(v) for v in contents] == [
+            b"file 0", b"file 1", b"file 2", b"file 3", b"file 4", b"file 0"]
+        assert all(_statuses(path) == [200] for path in paths)
+    finally:
+        server.shutdown()
+
+PARSED = []
+
+def _parse(name, fid, entries=None, scale=1):
+    PARSED.append(name)
+    return [fid.read().decode()*scale, entries]
+
+def test_url_parse_many():
+    server = _serve()
+    try:
+        path, other = _file(b"ab"), _file(b"cd")
+        files = [{"source": "test", "path": path, "mtime": MTIME},
+                 {"source": "test", "path": other, "entries": ["entry1"]}]
+        del PARSED[:]
+        first = fetch.url_parse_many(files, _parse, with_entries=True, scale=2)
+        assert first == [["abab", None], ["cdcd", ["entry1"]]]
+        # Parsed results are reused without fetching files with an mtime,
+        # and after revalidating files without one.
+        second = fetch.url_parse_many(files, _parse, with_entries=True, scale=2)
+        assert second == first and len(PARSED) == 2
+        assert _statuses(path) == [200] and _statuses(other) == [200, 304]
+        # Different parser arguments or file contents are parsed again.
+        fetch.url_parse_many(files[:1], _parse, scale=3)
+        FILES[other] = (b"ef", MTIME + 60)
+        third = fetch.url_parse_many(files[1:], _parse)
+        assert third == [["ef", None]] and len(PARSED) == 4
+    finally:
+        server.shutdown()
+
+def test_stream_download():
+    server = _serve()
+    try:
+        # Larger than a chunk, so the body is written to the cache in pieces.
+        contents = bytes(bytearray(range(256)))*(fetch.CHUNK_SIZE//100)
+        path = _file(contents)
+        fileinfo = {"source": "test", "path": path, "mtime": MTIME}
+        first = fetch.url_get(fileinfo)
+        assert isinstance(first, memoryview) and bytes(first) == contents
+        assert bytes(fetch.url_get(fileinfo)) == contents
+        assert _statuses(path) == [200]
+        # The loader sees a file without a copy of the contents.
+        with fetch.open_content(first) as fid:
+            assert fid.read(3) == b"\x00\x01\x02"
+            fid.seek(-2, 2)
+            assert fid.read() == b"\xfe\xff" and fid.read(5) == b""
+            fid.seek(256*1000 + 5)
+            assert fid.tell() == 256000 + 5 and fid.read(2) == b"\x05\x06"
+    finally:
+        server.shutdown()
+
+def test_parser_package_version():
+    # Parsed results depend on the whole package of the parser, since the
+    # parser usually calls readers in other modules of the package.
+    import sansred.steps
+    import sansred.loader
+    steps = fetch._package_version("sansred.steps")
+    assert steps == fetch._package_version("sansred.loader")
+    assert steps != fetch._package_version("vsansred.steps")
@@ -86,19 +86,23 @@ def LoadRawUSANS(filelist=None, check_timestamps=True, det_deadtime=7e-6, trans_
 
     2020-01-29 Brian Maranville
     """
-    from dataflow.fetch import url_get
+    from dataflow.fetch import url_parse_many
     from .loader import readUSANSNexus
     from .usansdata import USansData
     if filelist is None:
         filelist = []
     data = []
-    for fileinfo in filelist:
-        path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-        name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
-        entries = readUSANSNexus(name, fid, det_deadtime=det_deadtime, trans_deadtime=trans_deadtime)
-        
-        data.extend(entries)
+    parsed = url_parse_many(filelist, readUSANSNexus,
+                            mtime_check=check_timestamps,
+                            det_deadtime=det_deadtime,
+                            trans_deadtime=trans_deadtime)
+    for entries in parsed:
+        # The parsed entries are shared through the cache, so give later
+        # steps copies whose metadata they can update.
+        for entry in entries:
+            entry = copy(entry)
+            entry.metadata = entry.metadata.copy()
+            data.append(entry)
 
     return data
 
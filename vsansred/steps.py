@@ -1,6 +1,5 @@
 from posixpath import basename, join
 from copy import copy, deepcopy
-from io import BytesIO
 import sys
 import numpy as np
 
@@ -95,17 +94,19 @@ def _LoadVSANS(filelist=None, check_timestamps=True):
     | 2018-04-29 Brian Maranville
     | 2020-10-01 Brian Maranville adding fileinfo to metadata
     """
-    from dataflow.fetch import url_get
+    from dataflow.fetch import url_parse_many
     from .loader import readVSANSNexuz
     if filelist is None:
         filelist = []
     data = []
-    for fileinfo in filelist:
-        path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-        name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
-        entries = readVSANSNexuz(name, fid)
+    parsed = url_parse_many(filelist, readVSANSNexuz,
+                            mtime_check=check_timestamps)
+    for fileinfo, entries in zip(filelist, parsed):
+        # The parsed entries are shared through the cache, so update the
+        # metadata on copies.
+        entries = [copy(entry) for entry in entries]
         for entry in entries:
+            entry.metadata = entry.metadata.copy()
             if fileinfo['path'].endswith("DIV.h5"):
                 print('div file...')
                 entry.metadata['analysis.filepurpose'] = "Sensitivity"
@@ -215,17 +216,21 @@ def LoadVSANSHe3(filelist=None, check_timestamps=True):
 
     2018-04-29 Brian Maranville
     """
-    from dataflow.fetch import url_get
+    from dataflow.fetch import url_parse_many
     from .loader import readVSANSNexuz, he3_metadata_lookup
     if filelist is None:
         filelist = []
     data = []
-    for fileinfo in filelist:
-        path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
-        name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
-        entries = readVSANSNexuz(name, fid, metadata_lookup=he3_metadata_lookup)
-        data.extend(entries)
+    parsed = url_parse_many(filelist, readVSANSNexuz,
+                            mtime_check=check_timestamps,
+                            metadata_lookup=he3_metadata_lookup)
+    for entries in parsed:
+        # The parsed entries are shared through the cache, so give later
+        # steps copies whose metadata they can update.
+        for entry in entries:
+            entry = copy(entry)
+            entry.metadata = entry.metadata.copy()
+            data.append(entry)
 
     return data
 
@@ -294,7 +299,7 @@ def LoadVSANSDIV(filelist=None, check_timestamps=True):
 
     2019-10-30 Brian Maranville
     """
-    from dataflow.fetch import url_get
+    from dataflow.fetch import url_get_many, open_content
     from .loader import readVSANSNexuz
     
 
@@ -302,10 +307,11 @@ def LoadVSANSDIV(filelist=None, check_timestamps=True):
         filelist = []
 
     data = []
-    for fileinfo in filelist:
+    contents = url_get_many(filelist, mtime_check=check_timestamps)
+    for fileinfo, content in zip(filelist, contents):
         path, mtime, entries = fileinfo['path'], fileinfo.get('mtime', None), fileinfo.get('entries', None)
         name = basename(path)
-        fid = BytesIO(url_get(fileinfo, mtime_check=check_timestamps))
+        fid = open_content(content)
         entries = readVSANSNexuz(name, fid) # metadata_lookup=div_metadata_lookup)
         for entry in entries:
             div_entries = _loadDivData(entry)
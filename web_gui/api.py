@@ -12,12 +12,16 @@ from dataflow.core import Template, load_instrument, lookup_instrument
 from dataflow.core import list_instruments as _list_instruments
 from dataflow.cache import get_cache
 from dataflow.calc import process_template
+from dataflow.profile import Profile
 from dataflow.rev import revision_info
 from dataflow import configure
 from dataflow import fetch
 
 api_methods = []
 
+# Allow cache_purge from the api; set from "cache_admin" in the config.
+CACHE_ADMIN = False
+
 def expose(action):
     """
     Decorator which adds function to the list of methods to expose in the api.
@@ -130,12 +134,18 @@ def calc_terminal(template_def, config, nodenum, terminal_id, return_type='full'
 
     terminal_id is the id of the terminal for that module, that you want to get the value from
     (output terminals only).
+
+    return_type is one of 'full', 'plottable', 'metadata' or 'export' for
+    the value, or 'profile' for the time, memory and cache traffic of
+    each node in the evaluation.
     """
     template = Template(**template_def)
+    profile = Profile()
     #print "template_def:", template_def, "config:", config, "target:",nodenum,terminal_id
     #print "modules","\n".join(m for m in df._module_registry.keys())
     try:
-        retval = process_template(template, config, target=(nodenum, terminal_id))
+        retval = process_template(template, config, target=(nodenum, terminal_id),
+                                  profile=profile)
     except Exception:
         print("==== template ===="); pprint(template_def)
         print("==== config ===="); pprint(config)
@@ -143,6 +153,10 @@ def calc_terminal(template_def, config, nodenum, terminal_id, return_type='full'
         raise
     if return_type == 'full':
         return retval.todict()
+    elif return_type == 'profile':
+        # Wait for queued cache writes so that their counters are included.
+        get_cache().flush()
+        return profile.todict()
     elif return_type == 'plottable':
         return retval.get_plottable()
     elif return_type == 'metadata':
@@ -167,7 +181,7 @@ def calc_terminal(template_def, config, nodenum, terminal_id, return_type='full'
 
         return to_export
 
-    raise KeyError(return_type + " not a valid return_type (should be one of ['full', 'plottable', 'metadata', 'export'])")
+    raise KeyError(return_type + " not a valid return_type (should be one of ['full', 'plottable', 'metadata', 'export', 'profile'])")
 
 @expose
 def calc_template(template_def, config):
@@ -189,6 +203,42 @@ def calc_template(template_def, config):
         output[module_key][terminal_id] = rv.todict()
     return output
 
+@expose
+def cache_usage(group_by=("instrument", "module")):
+    """
+    Summarize the cache contents, with the number of entries, total bytes
+    and oldest and newest entry times for each instrument and module, and
+    the cache hit and miss counts for this server process.
+    """
+    return get_cache().usage(group_by=group_by)
+
+@expose
+def cache_purge(module=None, version=None, instrument=None):
+    """
+    Remove the cached results for a module, module version or instrument.
+
+    Only available if "cache_admin" is set in the server configuration.
+    Returns the number of entries removed.
+    """
+    if not CACHE_ADMIN:
+        raise PermissionError("cache administration is not enabled on this server")
+    tags = dict((k, v) for k, v in
+                (("module", module), ("version", version), ("instrument", instrument))
+                if v is not None)
+    return get_cache().purge(**tags)
+
+@expose
+def cache_gc():
+    """
+    Remove cached results from module versions no longer on the server.
+
+    Only available if "cache_admin" is set in the server configuration.
+    Returns the number of entries and bytes removed.
+    """
+    if not CACHE_ADMIN:
+        raise PermissionError("cache administration is not enabled on this server")
+    return dataflow.calc.collect_garbage()
+
 @expose
 def list_datasources():
     return fetch.DATA_SOURCES
@@ -198,9 +248,11 @@ def list_instruments():
     return _list_instruments()
 
 def initialize(config=None):
+    global CACHE_ADMIN
     if config is None:
         config = configure.load_config('config')
     configure.apply_config(user_config=config)
+    CACHE_ADMIN = config.get('cache_admin', False)
 
 if __name__ == '__main__':
     initialize()
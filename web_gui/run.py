@@ -9,6 +9,7 @@ def main():
     parser.add_argument('-p', '--port', default=8002, type=int, help='port on which to start the server')
     parser.add_argument('-c', '--config-file', type=str, help='path to JSON configuration to load')
     parser.add_argument('-i','--instruments', nargs='+', help='instruments to load (overrides config)')
+    parser.add_argument('--gc', action='store_true', help='remove cached results from old module versions and exit')
     args = parser.parse_args()
     if args.config_file is not None:
         import json
@@ -25,6 +26,14 @@ def main():
             if d["name"] != "local"
         ]
 
+    if args.gc:
+        from dataflow.configure import apply_config
+        from dataflow.calc import collect_garbage
+        apply_config(user_config=config)
+        removed, nbytes = collect_garbage()
+        print("removed %d cache entries, %.1f MiB"%(removed, nbytes/2**20))
+        return
+
     from web_gui.server_flask import create_app
     app = create_app(config)
     if not args.headless: